@@ -0,0 +1,84 @@
+# ==============================================================================
+# AI SECURITY CAM - RELLENO DE 'owner_email' EN EVENTOS ANTIGUOS
+# ==============================================================================
+# main3.py guarda cada evento nuevo con el email de su dueño ('owner_email') y
+# consulta el historial por ese campo. Este script recorre la colección 'events'
+# una sola vez y añade 'owner_email' a los eventos que se crearon antes del cambio,
+# usando el mapeo dispositivo -> dueño de la colección 'usuarios'.
+# Al terminar, arranca main3.py con EVENTS_QUERY_BY_OWNER=1 para consultar por dueño.
+#
+# Uso:  python backfill_event_owners.py [--dry-run]
+# ------------------------------------------------------------------------------
+
+import os
+import sys
+from google.cloud import firestore
+
+# ========== CONFIGURACIÓN ==========
+os.environ.setdefault("GOOGLE_APPLICATION_CREDENTIALS", "security-cam-f322b-8adcddbcb279.json")
+PAGE_SIZE = 500        # Eventos leídos por página (paginamos para no mantener un stream abierto mucho tiempo)
+BATCH_SIZE = 400       # Actualizaciones por lote (Firestore admite hasta 500 operaciones)
+
+
+def construir_mapa_dispositivos(db):
+    """Devuelve { device_id: owner_email } a partir de la colección 'usuarios'."""
+    device_owner = {}
+    for user_doc in db.collection('usuarios').stream():
+        for device_id in user_doc.to_dict().get('devices', []):
+            device_owner[device_id] = user_doc.id
+    print(f"[INFO] {len(device_owner)} dispositivo(s) con dueño conocido.")
+    return device_owner
+
+
+def rellenar_eventos(db, device_owner, dry_run=False):
+    """Recorre todos los eventos por páginas y añade 'owner_email' donde falte."""
+    scanned, updated, orphans = 0, 0, 0
+    batch, pending = db.batch(), 0
+    last_doc = None
+
+    while True:
+        query = db.collection('events').order_by('__name__').limit(PAGE_SIZE)
+        if last_doc is not None:
+            query = query.start_after(last_doc)
+        page = list(query.stream())
+        if not page:
+            break
+
+        for doc in page:
+            scanned += 1
+            event_data = doc.to_dict()
+            if event_data.get('owner_email'):
+                continue
+            owner_email = device_owner.get(event_data.get('device_id'))
+            if not owner_email:
+                orphans += 1
+                continue
+
+            updated += 1
+            if dry_run:
+                continue
+            batch.update(doc.reference, {'owner_email': owner_email})
+            pending += 1
+            if pending >= BATCH_SIZE:
+                batch.commit()
+                batch, pending = db.batch(), 0
+
+        last_doc = page[-1]
+        print(f"[INFO] Revisados {scanned} eventos, {updated} por actualizar...", end='\r')
+
+    if pending:
+        batch.commit()
+
+    print(f"\n[OK] Revisados: {scanned}. Actualizados: {updated}. Sin dueño conocido: {orphans}."
+          + (" (dry-run, no se escribió nada)" if dry_run else ""))
+
+
+def main():
+    dry_run = '--dry-run' in sys.argv
+    db = firestore.Client()
+    device_owner = construir_mapa_dispositivos(db)
+    rellenar_eventos(db, device_owner, dry_run=dry_run)
+
+
+if __name__ == '__main__':
+    main()
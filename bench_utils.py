@@ -0,0 +1,19 @@
+# ==============================================================================
+# AI SECURITY CAM - UTILIDADES COMUNES DE LOS BENCHMARKS
+# ==============================================================================
+# Lo usan benchmark_event_queries.py, benchmark_fi2_replay.py, loadtest_main3.py y
+# simulate_camera_fleet.py para que todos calculen p50, p95 y p99 igual.
+# ------------------------------------------------------------------------------
+
+import math
+
+
+def percentil(valores, p):
+    """
+    Percentil 'p' (0-100] por rango más cercano: el menor valor que deja al menos
+    el p % de las muestras por debajo o igual. Siempre es una de las muestras.
+    """
+    valores = sorted(valores)
+    rango = max(1, math.ceil(p / 100 * len(valores)))
+    return valores[rango - 1]
+
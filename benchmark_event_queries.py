@@ -0,0 +1,92 @@
+# ==============================================================================
+# AI SECURITY CAM - BENCHMARK DE CONSULTAS DE EVENTOS (EMULADOR DE FIRESTORE)
+# ==============================================================================
+# Compara la latencia de la consulta antigua del historial
+#     where('device_id', 'in', devices).order_by('timestamp')
+# contra la consulta por dueño
+#     where('owner_email', '==', email).order_by('timestamp')
+# a medida que crece el número de cámaras del usuario.
+#
+# Solo corre contra el emulador local, nunca contra producción:
+#   gcloud emulators firestore start --host-port=localhost:8080
+#   FIRESTORE_EMULATOR_HOST=localhost:8080 python benchmark_event_queries.py
+# ------------------------------------------------------------------------------
+
+import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from google.cloud import firestore
+
+from bench_utils import percentil
+
+# ========== CONFIGURACIÓN ==========
+PROJECT_ID = "demo-security-cam"         # Proyecto ficticio, solo existe en el emulador
+DEVICE_COUNTS = [1, 2, 5, 10, 20, 30]     # 30 es el máximo de valores que admite 'in'
+EVENTS_PER_DEVICE = 200
+PAGE_SIZE = 100                           # Igual que /api/events/history
+REPEATS = 30
+
+
+def sembrar_escenario(db, device_count):
+    """
+    Crea un usuario de prueba con 'device_count' cámaras y EVENTS_PER_DEVICE eventos por cámara.
+    Devuelve (owner_email, devices).
+    """
+    owner_email = f"bench{device_count}@example.com"
+    devices = [f"bench{device_count}cam{d:03d}" for d in range(device_count)]
+    print(f"[INFO] Sembrando {device_count * EVENTS_PER_DEVICE} eventos para {owner_email}...")
+    base_time = datetime.now(timezone.utc)
+    batch, pending = db.batch(), 0
+    for d, device_id in enumerate(devices):
+        for i in range(EVENTS_PER_DEVICE):
+            batch.set(db.collection('events').document(), {
+                "person_name": "Desconocido",
+                "timestamp": base_time - timedelta(seconds=i * device_count + d),
+                "event_type": "unknown_person",
+                "image_url": "",
+                "event_details": "evento de benchmark",
+                "device_id": device_id,
+                "owner_email": owner_email,
+            })
+            pending += 1
+            if pending >= 400:
+                batch.commit()
+                batch, pending = db.batch(), 0
+    if pending:
+        batch.commit()
+    return owner_email, devices
+
+
+def medir(query):
+    """Ejecuta la consulta REPEATS veces y devuelve (p50, p95) en milisegundos."""
+    samples = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        list(query.stream())
+        samples.append((time.perf_counter() - start) * 1000)
+    return percentil(samples, 50), percentil(samples, 95)
+
+
+def main():
+    if not os.environ.get("FIRESTORE_EMULATOR_HOST"):
+        print("[ERROR] Define FIRESTORE_EMULATOR_HOST: este benchmark solo corre contra el emulador local.")
+        sys.exit(1)
+
+    db = firestore.Client(project=PROJECT_ID)
+    scenarios = [(count, *sembrar_escenario(db, count)) for count in DEVICE_COUNTS]
+
+    print(f"\n{'cámaras':>8} | {'in p50':>9} | {'in p95':>9} | {'dueño p50':>10} | {'dueño p95':>10}")
+    print("-" * 58)
+    for count, owner_email, devices in scenarios:
+        in_query = db.collection('events').where('device_id', 'in', devices) \
+                     .order_by('timestamp', direction=firestore.Query.DESCENDING).limit(PAGE_SIZE)
+        owner_query = db.collection('events').where('owner_email', '==', owner_email) \
+                        .order_by('timestamp', direction=firestore.Query.DESCENDING).limit(PAGE_SIZE)
+        in_p50, in_p95 = medir(in_query)
+        owner_p50, owner_p95 = medir(owner_query)
+        print(f"{count:>8} | {in_p50:>7.1f}ms | {in_p95:>7.1f}ms | {owner_p50:>8.1f}ms | {owner_p95:>8.1f}ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+# ==============================================================================
+# AI SECURITY CAM - BENCHMARK DE REPRODUCCIÓN OFFLINE DEL WORKER DE INFERENCIA
+# ==============================================================================
+# Ejecuta el pipeline de decisión de fi2.py (YOLO -> MTCNN -> FaceNet -> comparación
+# -> evento) sobre una carpeta local de JPEGs, sin Firebase ni red:
+#   - Storage, Firestore, FCM y /events/add se sustituyen por listas en memoria.
+#   - La galería de rostros conocidos sale de una carpeta local:
+#       <galeria>/*.npy          -> mismo formato que embeddings_clientes/ ({'name', 'embeddings'})
+#       <galeria>/<nombre>/*.jpg -> fotos de la persona; se calculan sus embeddings al arrancar
+#   - El nombre de cada frame sigue el formato de main3.py: <device_id>_<AAAAMMDD>_<HHMMSS>.jpg
+#   - fi2 corre con un reloj simulado que toma la hora del nombre de cada frame, así la
+#     presencia (PRESENCE_ABSENCE_SECONDS) y los contadores de rostro cubierto avanzan
+#     como en producción aunque la reproducción dure unos segundos.
+#
+# Informa percentiles de latencia por etapa, frames/s, pico de memoria (RSS) y las
+# decisiones tomadas. Con --json se guarda el resultado para comparar entre ejecuciones.
+#
+# Uso:  python benchmark_fi2_replay.py --frames ./frames --gallery ./galeria [--repeat 3] [--json run.json]
+# ------------------------------------------------------------------------------
+
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import resource
+from types import SimpleNamespace
+from datetime import datetime, timezone
+from collections import Counter
+
+import cv2
+import numpy as np
+
+import fi2
+from bench_utils import percentil
+
+STAGES = ['decode', 'yolo', 'mtcnn', 'facenet', 'match', 'encode', 'total']
+
+
+def cargar_galeria(gallery_dir):
+    """Devuelve (embeddings, labels) a partir de la carpeta de galería."""
+    embs, labels = [], []
+    for npy_path in sorted(glob.glob(os.path.join(gallery_dir, '*.npy'))):
+        data = np.load(npy_path, allow_pickle=True).item()
+        if 'embeddings' in data and 'name' in data:
+            embs.extend(data['embeddings'])
+            labels.extend([data['name']] * len(data['embeddings']))
+
+    for person_dir in sorted(d for d in glob.glob(os.path.join(gallery_dir, '*')) if os.path.isdir(d)):
+        name = os.path.basename(person_dir)
+        for photo_path in sorted(glob.glob(os.path.join(person_dir, '*.jpg'))):
+            img_rgb = cv2.cvtColor(cv2.imread(photo_path), cv2.COLOR_BGR2RGB)
+            faces = fi2.detector.detect_faces(img_rgb)
+            if not faces:
+                print(f"[WARN] Sin rostro en {photo_path}, se omite.")
+                continue
+            x, y, w, h = [abs(int(v)) for v in max(faces, key=lambda f: f['confidence'])['box']]
+            face_rgb = cv2.resize(img_rgb[y:y+h, x:x+w], (160, 160))
+            embs.append(fi2.embedder.embeddings(np.expand_dims(face_rgb, 0))[0])
+            labels.append(name)
+
+    print(f"[INFO] Galería: {len(embs)} embedding(s) de {len(set(labels))} persona(s).")
+    return embs, labels
+
+
+def hora_del_frame(nombre_archivo):
+    """Hora (epoch) del nombre <device_id>_<AAAAMMDD>_<HHMMSS>.jpg, o None si no la tiene."""
+    partes = os.path.splitext(nombre_archivo)[0].split('_')
+    try:
+        return datetime.strptime(partes[-2] + partes[-1], '%Y%m%d%H%M%S').replace(tzinfo=timezone.utc).timestamp()
+    except (IndexError, ValueError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reproduce frames locales a través del pipeline de fi2.")
+    parser.add_argument('--frames', required=True, help="Carpeta con los JPEG a procesar.")
+    parser.add_argument('--gallery', required=True, help="Carpeta con la galería de rostros conocidos.")
+    parser.add_argument('--repeat', type=int, default=1, help="Veces que se recorre la carpeta de frames.")
+    parser.add_argument('--json', help="Archivo donde guardar el resultado.")
+    args = parser.parse_args()
+
+    frame_paths = sorted(glob.glob(os.path.join(args.frames, '*.jpg')))
+    if not frame_paths:
+        print(f"[ERROR] No hay archivos .jpg en {args.frames}")
+        sys.exit(1)
+
+    # --- Sustitutos en memoria de Storage, Firestore, FCM y /events/add ---
+    storage_en_memoria = {}
+    eventos_registrados = []
+    notificaciones = []
+    fi2.registrar_evento = eventos_registrados.append
+    fi2.send_fcm = lambda user_email, event_data, fcm_tokens=None: notificaciones.append(event_data)
+
+    # Reloj simulado: fi2.time.time() devuelve la hora del frame en curso. Solo se sustituye
+    # el módulo 'time' que ve fi2; perf_counter sigue siendo el real para medir latencias.
+    # Los frames sin hora en el nombre avanzan FRAME_SIN_HORA_SECONDS sobre el anterior, y
+    # cada repetición empieza después de que todos hayan "salido" en la anterior.
+    FRAME_SIN_HORA_SECONDS = 5
+    reloj = {'ahora': 0.0}
+    fi2.time = SimpleNamespace(time=lambda: reloj['ahora'], perf_counter=time.perf_counter, sleep=time.sleep)
+
+    fi2.iniciar_modelos()
+    known_embs, known_labels = cargar_galeria(args.gallery)
+
+    muestras = {stage: [] for stage in STAGES}
+    decisiones = Counter()
+    inicio_total = time.perf_counter()
+    frames_procesados = 0
+
+    desfase = 0.0
+    for _ in range(args.repeat):
+        for frame_path in frame_paths:
+            nombre_archivo = os.path.basename(frame_path)
+            device_id = nombre_archivo.split('_')[0] if '_' in nombre_archivo else 'unknown'
+            hora = hora_del_frame(nombre_archivo)
+            reloj['ahora'] = max(reloj['ahora'], hora + desfase) if hora is not None else reloj['ahora'] + FRAME_SIN_HORA_SECONDS
+            tiempos = {stage: 0.0 for stage in STAGES}
+            inicio_frame = time.perf_counter()
+
+            fi2.revisar_salidas(reloj['ahora'])
+
+            inicio = time.perf_counter()
+            img = cv2.imread(frame_path)
+            img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+            tiempos['decode'] = time.perf_counter() - inicio
+
+            evento, title, body, _ = fi2.analizar_imagen(img, img_rgb, device_id, known_embs, known_labels, tiempos)
+
+            if evento:
+                inicio = time.perf_counter()
+                ok, buff = cv2.imencode('.jpg', img)
+                tiempos['encode'] = time.perf_counter() - inicio
+                if ok:
+                    storage_en_memoria[nombre_archivo.replace('.jpg', '_proc.jpg')] = buff.tobytes()
+                evento.update({'device_id': device_id, 'event_details': body})
+                fi2.registrar_evento(evento)
+                fi2.send_fcm('replay@example.com', {'title': title, 'body': body, **evento})
+
+            tiempos['total'] = time.perf_counter() - inicio_frame
+            for stage in STAGES:
+                muestras[stage].append(tiempos[stage] * 1000)
+            frames_procesados += 1
+
+        # Las personas que seguían presentes "se van" al terminar cada recorrido de la carpeta
+        fi2.revisar_salidas(float('inf'))
+        desfase = reloj['ahora'] - (hora_del_frame(os.path.basename(frame_paths[0])) or 0) + fi2.PRESENCE_ABSENCE_SECONDS
+
+    segundos = time.perf_counter() - inicio_total
+    for evento in eventos_registrados:
+        decisiones[evento['event_type']] += 1
+
+    # ru_maxrss está en KB en Linux y en bytes en macOS
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+    resultado = {
+        'frames': frames_procesados,
+        'seconds': round(segundos, 3),
+        'frames_per_second': round(frames_procesados / segundos, 2),
+        'peak_rss_mb': round(peak_rss_mb, 1),
+        'stages_ms': {stage: {'p50': round(percentil(muestras[stage], 50), 2),
+                              'p95': round(percentil(muestras[stage], 95), 2),
+                              'p99': round(percentil(muestras[stage], 99), 2)} for stage in STAGES},
+        'decisions': dict(decisiones),
+        'uploads': len(storage_en_memoria),
+        'notifications': len(notificaciones),
+    }
+
+    print(f"\n{'etapa':>8} | {'p50':>9} | {'p95':>9} | {'p99':>9}")
+    print("-" * 45)
+    for stage in STAGES:
+        s = resultado['stages_ms'][stage]
+        print(f"{stage:>8} | {s['p50']:>7.1f}ms | {s['p95']:>7.1f}ms | {s['p99']:>7.1f}ms")
+    print(f"\n[OK] {frames_procesados} frames en {segundos:.1f}s ({resultado['frames_per_second']} frames/s), "
+          f"pico de RSS {resultado['peak_rss_mb']} MB.")
+    print(f"[OK] Decisiones: {dict(decisiones)}. Subidas: {resultado['uploads']}. Notificaciones: {resultado['notifications']}.")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(resultado, f, indent=2)
+        print(f"[OK] Resultado guardado en {args.json}")
+
+
+if __name__ == '__main__':
+    main()
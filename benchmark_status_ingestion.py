@@ -0,0 +1,107 @@
+# ==============================================================================
+# AI SECURITY CAM - BENCHMARK DE INGESTA DE ESTADO DE CÁMARAS (MQTT -> REDIS)
+# ==============================================================================
+# Simula una flota de cámaras publicando su estado en 'camera/status/<id>' y mide
+# cuánto tarda main3.py (el proceso líder de estados) en dejarlo escrito en Redis.
+# Cada ronda publica un mensaje por cámara con un modo distinto ("BENCH_R<n>")
+# y espera a que todas las cámaras muestren ese modo en camera_status:<id>.
+#
+# Necesita un broker MQTT, Redis y main3.py corriendo en local:
+#   python benchmark_status_ingestion.py [--cameras 10000] [--rounds 5] [--legacy]
+# --legacy publica el formato antiguo en texto ("Modo: X; Power: ON") en lugar del JSON compacto.
+# ------------------------------------------------------------------------------
+
+import sys
+import time
+import json
+import argparse
+import statistics
+import redis
+import paho.mqtt.client as mqtt
+
+# ========== CONFIGURACIÓN ==========
+MQTT_BROKER_IP = "localhost"
+MQTT_BROKER_PORT = 1883
+MQTT_QOS = 1                         # Igual que las cámaras reales
+REDIS_HOST = "localhost"
+CAMERA_PREFIX = "benchcam"           # Las cámaras simuladas no chocan con las reales
+WAIT_TIMEOUT_SECONDS = 120           # Máximo que esperamos a que una ronda llegue a Redis
+POLL_INTERVAL_SECONDS = 0.05
+
+
+def construir_payload(mode, legacy):
+    if legacy:
+        return f"Modo: {mode}; Power: ON"
+    return json.dumps({"m": mode, "p": 1}, separators=(",", ":"))
+
+
+def camaras_pendientes(redis_client, camera_ids, expected_mode):
+    """Devuelve cuántas cámaras todavía no muestran 'expected_mode' en Redis."""
+    pipe = redis_client.pipeline(transaction=False)
+    for camera_id in camera_ids:
+        pipe.hget(f"camera_status:{camera_id}", "mode")
+    return sum(1 for mode in pipe.execute() if mode != expected_mode.encode("utf-8"))
+
+
+def ejecutar_ronda(mqtt_client, redis_client, camera_ids, round_number, legacy):
+    """Publica un estado por cámara y devuelve (segundos publicando, segundos hasta verlo todo en Redis)."""
+    mode = f"BENCH_R{round_number}"
+    payload = construir_payload(mode, legacy)
+
+    start = time.perf_counter()
+    infos = [mqtt_client.publish(f"camera/status/{camera_id}", payload=payload, qos=MQTT_QOS)
+             for camera_id in camera_ids]
+    for info in infos:
+        info.wait_for_publish()
+    publish_seconds = time.perf_counter() - start
+
+    while camaras_pendientes(redis_client, camera_ids, mode):
+        if time.perf_counter() - start > WAIT_TIMEOUT_SECONDS:
+            raise TimeoutError(f"La ronda {round_number} no llegó completa a Redis en {WAIT_TIMEOUT_SECONDS} s. "
+                               "¿Está main3.py corriendo y es el líder de estados?")
+        time.sleep(POLL_INTERVAL_SECONDS)
+    return publish_seconds, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de ingesta de estado de cámaras.")
+    parser.add_argument("--cameras", type=int, default=10000)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--legacy", action="store_true", help="Publicar el formato de texto antiguo.")
+    args = parser.parse_args()
+
+    redis_client = redis.Redis(host=REDIS_HOST, port=6379, db=0)
+    mqtt_client = mqtt.Client(client_id="status_ingestion_benchmark", clean_session=True)
+    mqtt_client.max_inflight_messages_set(1000)
+    mqtt_client.max_queued_messages_set(0)
+    mqtt_client.connect(MQTT_BROKER_IP, MQTT_BROKER_PORT, 60)
+    mqtt_client.loop_start()
+
+    camera_ids = [f"{CAMERA_PREFIX}{i:05d}" for i in range(args.cameras)]
+    print(f"[INFO] {args.cameras} cámaras, {args.rounds} rondas, formato {'texto' if args.legacy else 'compacto'}.")
+
+    totals = []
+    try:
+        for round_number in range(1, args.rounds + 1):
+            publish_seconds, total_seconds = ejecutar_ronda(mqtt_client, redis_client, camera_ids, round_number, args.legacy)
+            totals.append(total_seconds)
+            print(f"  Ronda {round_number}: publicado en {publish_seconds:.2f}s, en Redis en {total_seconds:.2f}s "
+                  f"({args.cameras / total_seconds:,.0f} mensajes/s)")
+    except TimeoutError as e:
+        print(f"[ERROR] {e}")
+        sys.exit(1)
+    finally:
+        mqtt_client.loop_stop()
+        mqtt_client.disconnect()
+        pipe = redis_client.pipeline(transaction=False)
+        for camera_id in camera_ids:
+            pipe.delete(f"camera_status:{camera_id}")
+        pipe.execute()
+
+    median_seconds = statistics.median(totals)
+    print(f"\n[OK] Mediana por ronda: {median_seconds:.2f}s -> {args.cameras / median_seconds:,.0f} mensajes/s. "
+          f"Con un reporte cada 20 s, la flota de {args.cameras} cámaras necesita {args.cameras / 20:,.0f} mensajes/s.")
+
+
+if __name__ == '__main__':
+    main()
@@ -8,6 +8,7 @@
 
 import cv2
 import time
+import json
 import requests
 import paho.mqtt.client as mqtt
 
@@ -25,12 +26,21 @@ CAMERA_FPS = 10                    # Fotogramas por segundo para el modo de vide
 MQTT_BROKER_IP = "34.69.206.32"    # IP pública de tu Máquina Virtual donde corre Mosquitto.
 MQTT_BROKER_PORT = 1883
 VM_STREAM_UPLOAD_URL = "https://tesisdeteccion.ddns.net/api/stream_upload" # URL completa del endpoint en el servidor.
+VM_STREAM_UPLOAD_RAW_URL = f"https://tesisdeteccion.ddns.net/api/stream_upload_raw/{CAMERA_ID_PC}" # Endpoint ligero (JPEG crudo).
+USE_RAW_UPLOAD = True              # True: envía el JPEG crudo; False: usa el formulario multipart clásico.
 
 # --- Tópicos MQTT ---
 # Canales de comunicación para comandos y estado.
 MQTT_COMMAND_TOPIC = f"camera/commands/{CAMERA_ID_PC}" # Canal para recibir órdenes.
 MQTT_STATUS_TOPIC = f"camera/status/{CAMERA_ID_PC}"     # Canal para reportar su estado.
+MQTT_VIEWERS_TOPIC = f"camera/viewers/{CAMERA_ID_PC}"   # Canal donde el servidor publica cuántos la están viendo.
+MQTT_NONCE_TOPIC = f"camera/command_nonce/{CAMERA_ID_PC}" # Nonce de un comando masivo, publicado justo antes del comando.
 MQTT_QOS = 1 # Calidad de Servicio: 1 asegura que los mensajes lleguen al menos una vez.
+USE_COMPACT_STATUS = True # True: estado en JSON compacto {"m": modo, "p": 0|1}; False: texto "Modo: X; Power: ON".
+
+# --- Sesión HTTP ---
+# Se reutiliza la misma conexión (keep-alive) para todos los envíos de frames.
+http_session = requests.Session()
 
 # ==============================================================================
 # SECCIÓN DE VARIABLES DE ESTADO
@@ -39,18 +49,32 @@ MQTT_QOS = 1 # Calidad de Servicio: 1 asegura que los mensajes lleguen al menos
 
 current_mode = "STREAMING_MODE"  # Modo inicial: 'STREAMING_MODE' o 'CAPTURE_MODE'.
 is_camera_on = True              # Estado inicial de encendido/apagado.
+viewer_count = None              # Espectadores activos según el servidor (None = aún no se sabe, se transmite normal).
+last_command_nonce = None        # Nonce del último comando masivo (MQTT_NONCE_TOPIC); se devuelve en el estado como confirmación.
 
 # --- Variables para controlar el tiempo ---
 last_capture_time = 0            # Registra cuándo se tomó la última foto en modo captura.
 CAPTURE_INTERVAL_SECONDS = 5     # Intervalo en segundos para el modo captura.
 last_status_publish_time = 0     # Registra cuándo se envió el último reporte de estado.
 STATUS_PUBLISH_INTERVAL_SECONDS = 20 # Intervalo para enviar reportes de estado.
+last_stream_send_time = 0        # Registra cuándo se envió el último frame en modo streaming.
+STREAM_IDLE_INTERVAL_SECONDS = 5 # Sin espectadores, se envía un frame cada N segundos (0 = no enviar nada).
 
 # ==============================================================================
 # SECCIÓN DE FUNCIONES DE MQTT (CALLBACKS)
 # ------------------------------------------------------------------------------
 # Estas funciones se ejecutan automáticamente cuando ocurren eventos de MQTT.
 
+def construir_payload_estado():
+    """Devuelve el mensaje de estado de la cámara en el formato configurado."""
+    if USE_COMPACT_STATUS:
+        status = {"m": current_mode, "p": 1 if is_camera_on else 0}
+        if last_command_nonce:
+            status["n"] = last_command_nonce
+        return json.dumps(status, separators=(",", ":"))
+    status = f"Modo: {current_mode}; Power: {'ON' if is_camera_on else 'OFF'}"
+    return f"{status}; Ack: {last_command_nonce}" if last_command_nonce else status
+
 def on_connect(client, userdata, flags, rc):
     """Se ejecuta cuando el cliente se conecta exitosamente al broker MQTT."""
     if rc == 0:
@@ -58,9 +82,11 @@ def on_connect(client, userdata, flags, rc):
         # Se suscribe a los tópicos de comandos para poder recibir órdenes.
         client.subscribe(MQTT_COMMAND_TOPIC, qos=MQTT_QOS)
         client.subscribe(f"camera/power/{CAMERA_ID_PC}", qos=MQTT_QOS)
+        client.subscribe(MQTT_VIEWERS_TOPIC, qos=MQTT_QOS)
+        client.subscribe(MQTT_NONCE_TOPIC, qos=MQTT_QOS)
         print(f"[MQTT] Suscrito a los tópicos de comandos.")
         # Publica su estado inicial inmediatamente después de conectar.
-        status_payload = f"Modo: {current_mode}; Power: {'ON' if is_camera_on else 'OFF'}"
+        status_payload = construir_payload_estado()
         client.publish(MQTT_STATUS_TOPIC, payload=status_payload, qos=MQTT_QOS, retain=True)
     else:
         print(f"[MQTT] Falló la conexión, código de retorno: {rc}")
@@ -72,7 +98,23 @@ def on_disconnect(client, userdata, rc):
 
 def on_message(client, userdata, msg):
     """Se ejecuta cada vez que llega un mensaje en un tópico al que estamos suscritos."""
-    global current_mode, is_camera_on
+    global current_mode, is_camera_on, viewer_count, last_command_nonce
+
+    # El conteo de espectadores no es un comando: solo ajusta la tasa de envío.
+    if msg.topic == MQTT_VIEWERS_TOPIC:
+        try:
+            viewer_count = int(msg.payload.decode("utf-8").strip())
+            print(f"[MQTT] Espectadores activos: {viewer_count}")
+        except ValueError:
+            print(f"[WARN] Conteo de espectadores inválido: {msg.payload!r}")
+        return
+
+    # Nonce de un comando masivo: se guarda y se devuelve en los siguientes estados.
+    # No se publica estado aquí; lo hace el comando que llega justo después.
+    if msg.topic == MQTT_NONCE_TOPIC:
+        last_command_nonce = msg.payload.decode("utf-8").strip()
+        return
+
     command = msg.payload.decode("utf-8").strip().upper()
     print(f"[MQTT] Comando recibido en '{msg.topic}': '{command}'")
 
@@ -97,7 +139,7 @@ def on_message(client, userdata, msg):
             print(f"[WARN] Comando de encendido desconocido: {command}")
     
     # Después de cualquier comando, publica inmediatamente el nuevo estado.
-    status_payload = f"Modo: {current_mode}; Power: {'ON' if is_camera_on else 'OFF'}"
+    status_payload = construir_payload_estado()
     client.publish(MQTT_STATUS_TOPIC, payload=status_payload, qos=MQTT_QOS, retain=True)
 
 # ==============================================================================
@@ -108,7 +150,7 @@ def camera_operation_loop(mqtt_client):
     """
     Bucle principal que se ejecuta constantemente para manejar la cámara y enviar imágenes.
     """
-    global last_capture_time, current_mode, is_camera_on, last_status_publish_time
+    global last_capture_time, current_mode, is_camera_on, last_status_publish_time, last_stream_send_time
     camera = None
 
     while True:
@@ -117,7 +159,7 @@ def camera_operation_loop(mqtt_client):
 
             # --- Reporte de Estado Periódico ---
             if (current_time - last_status_publish_time) >= STATUS_PUBLISH_INTERVAL_SECONDS:
-                status_payload = f"Modo: {current_mode}; Power: {'ON' if is_camera_on else 'OFF'}"
+                status_payload = construir_payload_estado()
                 mqtt_client.publish(MQTT_STATUS_TOPIC, payload=status_payload, qos=MQTT_QOS, retain=True)
                 print(f"[MQTT] Reporte de estado periódico enviado: {status_payload}")
                 last_status_publish_time = current_time
@@ -149,7 +191,16 @@ def camera_operation_loop(mqtt_client):
             # Decidimos si debemos enviar este frame al servidor.
             should_send = False
             if current_mode == "STREAMING_MODE":
-                should_send = True
+                # Con espectadores (o sin dato del servidor) se envían todos los frames.
+                # Sin espectadores se baja a la tasa de reposo; como el bucle sigue girando
+                # a CAMERA_FPS, la tasa completa vuelve en el siguiente frame tras el aviso.
+                if viewer_count is None or viewer_count > 0:
+                    should_send = True
+                elif STREAM_IDLE_INTERVAL_SECONDS > 0 and \
+                        (current_time - last_stream_send_time) >= STREAM_IDLE_INTERVAL_SECONDS:
+                    should_send = True
+                if should_send:
+                    last_stream_send_time = current_time
             elif current_mode == "CAPTURE_MODE":
                 if (current_time - last_capture_time) >= CAPTURE_INTERVAL_SECONDS:
                     should_send = True
@@ -161,10 +212,13 @@ def camera_operation_loop(mqtt_client):
                     jpeg_bytes = buffer.tobytes()
                     try:
                         # Lógica de envío unificada: siempre se envía al servidor.
-                        files = {'frame': ('frame.jpg', jpeg_bytes, 'image/jpeg')}
-                        data = {'camera_id': CAMERA_ID_PC, 'mode': current_mode}
-                        
-                        response = requests.post(VM_STREAM_UPLOAD_URL, files=files, data=data)
+                        if USE_RAW_UPLOAD:
+                            headers = {'Content-Type': 'application/octet-stream', 'X-Camera-Mode': current_mode}
+                            response = http_session.post(VM_STREAM_UPLOAD_RAW_URL, data=jpeg_bytes, headers=headers, timeout=5)
+                        else:
+                            files = {'frame': ('frame.jpg', jpeg_bytes, 'image/jpeg')}
+                            data = {'camera_id': CAMERA_ID_PC, 'mode': current_mode}
+                            response = http_session.post(VM_STREAM_UPLOAD_URL, files=files, data=data, timeout=5)
                         response.raise_for_status() # Lanza un error si la respuesta no es 200 OK.
                         
                         print(f"[OK] Frame enviado al servidor en modo: {current_mode}")
@@ -0,0 +1,100 @@
+# ==============================================================================
+# AI SECURITY CAM - COMPROBACIÓN OFFLINE DEL ENVÍO DE NOTIFICACIONES DE fi2.py
+# ==============================================================================
+# Ejecuta la cola de notificaciones de fi2.py con el sustituto local de FCM
+# (FCM_LOCAL_STANDIN=1) y un Firestore en memoria, sin red ni credenciales, y comprueba:
+#   - que los tokens del usuario se envían en lotes de FCM_MULTICAST_MAX_TOKENS,
+#   - que los tokens no registrados se borran con un único ArrayRemove,
+#   - que la caché de tokens queda actualizada y la siguiente notificación no lee Firestore.
+#
+# Uso:  python check_fcm_multicast.py
+# ------------------------------------------------------------------------------
+
+import os
+import sys
+
+os.environ['FCM_LOCAL_STANDIN'] = '1'   # Debe fijarse antes de importar fi2
+
+import fi2
+
+USER_EMAIL = 'check@example.com'
+TOTAL_TOKENS = 1200
+TOKENS_NO_REGISTRADOS = {f'unregistered-{i}' for i in range(0, TOTAL_TOKENS, 100)}
+
+
+# ========== FIRESTORE EN MEMORIA ==========
+class DocumentoFalso:
+    def __init__(self, datos):
+        self.datos = datos
+        self.lecturas = 0
+        self.actualizaciones = []
+
+    # Imita lo que fi2 usa de DocumentReference y DocumentSnapshot
+    def get(self):
+        self.lecturas += 1
+        return self
+
+    @property
+    def exists(self):
+        return self.datos is not None
+
+    def to_dict(self):
+        return dict(self.datos)
+
+    def update(self, cambios):
+        self.actualizaciones.append(cambios)
+
+
+class FirestoreFalso:
+    def __init__(self, documentos):
+        self.documentos = documentos
+
+    def collection(self, nombre):
+        return self
+
+    def document(self, doc_id):
+        return self.documentos[doc_id]
+
+
+def comprobar(condicion, mensaje):
+    if not condicion:
+        print(f"[ERROR] {mensaje}")
+        sys.exit(1)
+    print(f"[OK] {mensaje}")
+
+
+def main():
+    tokens = [f'unregistered-{i}' if f'unregistered-{i}' in TOKENS_NO_REGISTRADOS else f'token-{i}'
+              for i in range(TOTAL_TOKENS)]
+    usuario = DocumentoFalso({'fcm_tokens': tokens})
+    fi2.db = FirestoreFalso({USER_EMAIL: usuario})
+
+    # --- Primera notificación: lee los tokens de Firestore y limpia los no registrados ---
+    fi2.send_fcm(USER_EMAIL, {'title': 'Prueba', 'body': 'Primera', 'device_id': 'cam1', 'event_type': 'unknown_person'})
+    fi2.flush_notificaciones_al_salir()
+
+    lotes = [len(m.tokens) for m in fi2.fcm_mensajes_locales]
+    esperados = [min(fi2.FCM_MULTICAST_MAX_TOKENS, TOTAL_TOKENS - i) for i in range(0, TOTAL_TOKENS, fi2.FCM_MULTICAST_MAX_TOKENS)]
+    comprobar(lotes == esperados, f"Tokens enviados en lotes {lotes} (esperado {esperados})")
+    comprobar(usuario.lecturas == 1, f"Documento del usuario leído {usuario.lecturas} vez/veces (esperado 1)")
+    comprobar(len(usuario.actualizaciones) == 1, f"{len(usuario.actualizaciones)} actualización(es) de Firestore (esperado 1)")
+    eliminados = set(usuario.actualizaciones[0]['fcm_tokens'].values)
+    comprobar(eliminados == TOKENS_NO_REGISTRADOS, f"ArrayRemove con {len(eliminados)} token(s) no registrado(s)")
+    en_cache = set(fi2.fcm_tokens_cache[USER_EMAIL][0])
+    comprobar(en_cache == set(tokens) - TOKENS_NO_REGISTRADOS, f"Caché con {len(en_cache)} token(s) válidos")
+
+    # --- Segunda notificación (otra cámara, sin agrupación): usa la caché ---
+    fi2.fcm_mensajes_locales.clear()
+    fi2.send_fcm(USER_EMAIL, {'title': 'Prueba', 'body': 'Segunda', 'device_id': 'cam2', 'event_type': 'unknown_person'})
+    fi2.flush_notificaciones_al_salir()
+
+    enviados = sum(len(m.tokens) for m in fi2.fcm_mensajes_locales)
+    comprobar(enviados == len(en_cache), f"Segunda notificación enviada a {enviados} token(s) válidos")
+    comprobar(usuario.lecturas == 1, "La segunda notificación no volvió a leer Firestore")
+    comprobar(len(usuario.actualizaciones) == 1, "La segunda notificación no tuvo tokens que borrar")
+
+    print("\n[OK] Envío de notificaciones correcto.")
+
+
+if __name__ == '__main__':
+    main()
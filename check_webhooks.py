@@ -0,0 +1,129 @@
+# ==============================================================================
+# AI SECURITY CAM - COMPROBACIÓN OFFLINE DE LOS WEBHOOKS DE fire7.py
+# ==============================================================================
+# Levanta un servidor HTTP local que hace de IFTTT, apunta webhooks.py a él
+# (WEBHOOK_IFTTT_BASE_URL) y comprueba, sin red:
+#   - que cada tipo de evento llega a su endpoint con value1..3,
+#   - que un 5xx se reintenta y un 4xx no,
+#   - que nunca hay más envíos simultáneos por endpoint que 'max_concurrentes',
+#   - que las conexiones se reutilizan (keep-alive) sin que urllib3 descarte ninguna
+#     por tener el pool lleno.
+#
+# Uso:  python check_webhooks.py
+# ------------------------------------------------------------------------------
+
+import os
+import sys
+import time
+import logging
+import threading
+from collections import Counter
+from urllib.parse import parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+RESPUESTA_SEGUNDOS = 0.05      # Lo que tarda el servidor local en responder cada aviso
+AVISOS_POR_TIPO = 20
+
+# ========== SERVIDOR LOCAL QUE HACE DE IFTTT ==========
+recibidos = []                 # (ruta, value1) de cada petición
+conexiones = set()             # Puertos de cliente distintos = conexiones TCP abiertas
+en_curso = Counter()           # Peticiones simultáneas por ruta en este momento
+max_en_curso = Counter()       # Máximo de peticiones simultáneas por ruta
+respuestas_forzadas = {}       # value1 -> lista de códigos a devolver antes del 200
+estado_lock = threading.Lock()
+
+
+class StubIFTTT(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'   # Keep-alive, como IFTTT
+
+    def do_POST(self):
+        ruta = self.path.split('/with/')[0]
+        datos = parse_qs(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode())
+        value1 = datos.get('value1', [''])[0]
+        with estado_lock:
+            conexiones.add(self.client_address[1])
+            en_curso[ruta] += 1
+            max_en_curso[ruta] = max(max_en_curso[ruta], en_curso[ruta])
+            pendientes = respuestas_forzadas.get(value1)
+            codigo = pendientes.pop(0) if pendientes else 200
+            recibidos.append((ruta, value1, codigo))
+        time.sleep(RESPUESTA_SEGUNDOS)
+        with estado_lock:
+            en_curso[ruta] -= 1
+        cuerpo = b'Congratulations!' if codigo == 200 else b'Error'
+        self.send_response(codigo)
+        self.send_header('Content-Length', str(len(cuerpo)))
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+    def log_message(self, *args):
+        pass
+
+
+class AvisosPoolLleno(logging.Handler):
+    """Cuenta los avisos de urllib3 "Connection pool is full, discarding connection"."""
+    def __init__(self):
+        super().__init__()
+        self.total = 0
+
+    def emit(self, record):
+        if 'pool is full' in record.getMessage():
+            self.total += 1
+
+
+def comprobar(condicion, mensaje):
+    if not condicion:
+        print(f"[ERROR] {mensaje}")
+        sys.exit(1)
+    print(f"[OK] {mensaje}")
+
+
+def main():
+    servidor = ThreadingHTTPServer(('127.0.0.1', 0), StubIFTTT)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    os.environ['WEBHOOK_IFTTT_BASE_URL'] = f'http://127.0.0.1:{servidor.server_port}'  # Antes de importar webhooks
+
+    import webhooks
+    webhooks.WEBHOOK_BACKOFF_SECONDS = 0.01
+    pool_lleno = AvisosPoolLleno()
+    logging.getLogger('urllib3.connectionpool').addHandler(pool_lleno)
+    webhooks.iniciar_webhooks()
+
+    # --- Rutas, reintentos y concurrencia ---
+    respuestas_forzadas['reintento'] = [503, 503]
+    respuestas_forzadas['rechazo'] = [400]
+    webhooks.encolar_webhook('unknown_person', 'reintento', 'http://img', 'detalles')
+    webhooks.encolar_webhook('unknown_person', 'rechazo', 'http://img', 'detalles')
+    for i in range(AVISOS_POR_TIPO):
+        webhooks.encolar_webhook('unknown_person', f'alarma-{i}', 'http://img', 'detalles')
+        webhooks.encolar_webhook('person_no_face_alarm', f'sin-rostro-{i}', 'http://img', 'detalles')
+    webhooks.encolar_webhook('known_person', 'sin-ruta', 'http://img', 'detalles')
+    for cola in webhooks.webhook_colas.values():
+        cola.join()
+
+    por_ruta = Counter(ruta for ruta, value1, codigo in recibidos if codigo == 200)
+    comprobar(por_ruta['/trigger/send_alarm'] == AVISOS_POR_TIPO + 1,
+              f"send_alarm recibió {por_ruta['/trigger/send_alarm']} aviso(s) (esperado {AVISOS_POR_TIPO + 1})")
+    comprobar(por_ruta['/trigger/persona_sin_rostro'] == AVISOS_POR_TIPO,
+              f"persona_sin_rostro recibió {por_ruta['/trigger/persona_sin_rostro']} aviso(s) (esperado {AVISOS_POR_TIPO})")
+    comprobar(not any(value1 == 'sin-ruta' for _, value1, _ in recibidos), "Un tipo sin ruta no se envía")
+    intentos = Counter(value1 for _, value1, _ in recibidos)
+    comprobar(intentos['reintento'] == 3, f"Un 503 se reintenta ({intentos['reintento']} intentos, esperado 3)")
+    comprobar(intentos['rechazo'] == 1, f"Un 400 no se reintenta ({intentos['rechazo']} intento)")
+
+    for endpoint, cfg in webhooks.WEBHOOK_ENDPOINTS.items():
+        ruta = cfg['url'].replace(webhooks.WEBHOOK_IFTTT_BASE_URL, '').split('/with/')[0]
+        comprobar(max_en_curso[ruta] <= cfg['max_concurrentes'],
+                  f"'{endpoint}': como mucho {max_en_curso[ruta]} envío(s) simultáneo(s) (límite {cfg['max_concurrentes']})")
+
+    # --- Pool de conexiones ---
+    hilos = sum(cfg['max_concurrentes'] for cfg in webhooks.WEBHOOK_ENDPOINTS.values())
+    comprobar(len(conexiones) <= hilos, f"{len(conexiones)} conexión(es) TCP para {len(recibidos)} petición(es) (como mucho {hilos})")
+    comprobar(pool_lleno.total == 0, f"{pool_lleno.total} conexión(es) descartadas por pool lleno")
+
+    servidor.shutdown()
+    print("\n[OK] Webhooks correctos.")
+
+
+if __name__ == '__main__':
+    main()
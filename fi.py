@@ -3,6 +3,8 @@ import time
 import cv2
 import numpy as np
 import threading # Necesario para embeddings_cache_lock
+import queue
+import atexit
 from datetime import datetime, timezone, timedelta 
 
 # Librerías de Google Cloud y Firebase
@@ -11,11 +13,10 @@ from firebase_admin import credentials, storage, messaging
 from firebase_admin import firestore 
 import requests 
 
-# Librerías de IA
-from mtcnn import MTCNN
-from keras_facenet import FaceNet
+# Librerías de IA (torch y TensorFlow se importan dentro de model_store al cargar los modelos)
 from scipy.spatial.distance import cosine
-import torch 
+import model_store
+import storage_urls # URL de las imágenes procesadas (común a todos los workers)
 
 # ========== CONFIGURACIÓN GLOBAL ==========
 # -- Configuración de la Cámara (referencia para ID, fi.py no controla la cámara) --
@@ -70,14 +71,17 @@ except Exception as e:
 
 
 # ========== INICIALIZAR MODELOS DE IA ==========
-embedder = FaceNet()
-detector = MTCNN()
+# Desde el almacén local de modelos (model_store.py), sin descargar nada de GitHub.
+model_store.limpiar_listo('fi')
 try:
-    model = torch.hub.load('ultralytics/yolov5', 'yolov5x') # O 'yolov5n' si es más ligero
+    embedder = model_store.cargar_facenet()
+    detector = model_store.cargar_mtcnn()
+    model = model_store.cargar_yolo('yolov5x') # O 'yolov5n' si es más ligero (debe estar en el manifiesto)
     class_names = model.names
+    model_store.calentar(model, detector, embedder)
     print("[INFO] Modelos de IA (FaceNet, MTCNN, YOLOv5) inicializados correctamente.")
 except Exception as e:
-    print(f"[ERROR] Error al cargar modelos de IA: {e}. Asegúrate de tener PyTorch y YOLOv5 configurados.")
+    print(f"[ERROR] Error al cargar modelos de IA: {e}. Prepara los modelos con: python model_store.py --download")
     model = None
     class_names = []
     # Si los modelos de IA no cargan, el script no puede hacer su trabajo
@@ -152,48 +156,70 @@ def descargar_fotos_firebase():
     print(f"[INFO] Descargadas {len(imagenes)} imágenes.")
     return imagenes
 
-# ========== ENVÍO DE NOTIFICACIONES FCM DIRECTAMENTE (Individual) ==========
-def send_fcm_notification_direct(user_email, title, body, image_url=None, custom_data=None):
+# ========== ENVÍO DE NOTIFICACIONES FCM (en segundo plano) ==========
+# Igual que en fi2.py: el bucle de procesamiento solo encola la notificación y un hilo la envía
+# con send_each_for_multicast. Los tokens de cada usuario se cachean FCM_TOKEN_CACHE_SECONDS
+# para no leer su documento de Firestore en cada notificación.
+FCM_TOKEN_CACHE_SECONDS = 300
+FCM_MULTICAST_MAX_TOKENS = 500   # Límite de tokens por llamada multicast de FCM
+fcm_tokens_cache = {}            # {'user_email': (tokens, timestamp)}
+notificaciones_pendientes = queue.Queue()
+
+def obtener_tokens_fcm(user_email):
+    """Tokens FCM del usuario desde la caché o, si caducó, desde Firestore."""
+    cached = fcm_tokens_cache.get(user_email)
+    if cached and time.time() - cached[1] < FCM_TOKEN_CACHE_SECONDS:
+        return cached[0]
+    user_doc = db.collection('usuarios').document(user_email).get()
+    if not user_doc.exists:
+        print(f"DEBUG_FCM: Usuario {user_email} no encontrado en Firestore.")
+        return []
+    tokens = user_doc.to_dict().get('fcm_tokens', [])
+    fcm_tokens_cache[user_email] = (tokens, time.time())
+    return tokens
+
+def send_fcm_notification(user_email, title, body, image_url=None, custom_data=None):
+    """Encola la notificación; la envía fcm_sender_loop sin frenar el procesamiento de imágenes."""
+    notificaciones_pendientes.put((user_email, title, body, image_url, custom_data))
+
+def enviar_notificacion_fcm(user_email, title, body, image_url=None, custom_data=None):
     success_count = 0
     failure_count = 0
     try:
-        print(f"DEBUG_FCM: Intentando obtener tokens FCM para el usuario: {user_email}")
-        user_doc_ref = db.collection('usuarios').document(user_email)
-        user_doc = user_doc_ref.get()
-
-        if not user_doc.exists:
-            print(f"DEBUG_FCM: Usuario {user_email} no encontrado en Firestore.")
-            return False
-        
-        user_data = user_doc.to_dict()
-        fcm_tokens = user_data.get('fcm_tokens', [])
-        
-        print(f"DEBUG_FCM: Tokens FCM obtenidos de Firestore para {user_email}: {fcm_tokens}")
-
+        fcm_tokens = obtener_tokens_fcm(user_email)
         if not fcm_tokens:
             print(f"DEBUG_FCM: No hay tokens FCM registrados para el usuario {user_email}.")
             return False
 
-        for token in fcm_tokens:
-            try:
-                message = messaging.Message(
-                    token=token, 
-                    notification=messaging.Notification(
-                        title=title,
-                        body=body,
-                        image=image_url 
-                    ),
-                    data=custom_data or {}
-                )
-                print(f"DEBUG_FCM: Enviando mensaje a token: {token[:10]}...")
-                response = messaging.send(message) 
-                print(f"DEBUG_FCM: Respuesta FCM para {token[:10]}: {response}")
-                success_count += 1
-            except Exception as token_e:
-                failure_count += 1
-                print(f"❌ Fallo al enviar notificación a token {token[:10]}: {token_e}")
-                import traceback
-                traceback.print_exc() 
+        # Un solo envío multicast para todos los tokens del usuario (FCM admite hasta 500 por llamada)
+        invalid_tokens = []
+        for i in range(0, len(fcm_tokens), FCM_MULTICAST_MAX_TOKENS):
+            tokens = fcm_tokens[i:i + FCM_MULTICAST_MAX_TOKENS]
+            message = messaging.MulticastMessage(
+                tokens=tokens,
+                notification=messaging.Notification(
+                    title=title,
+                    body=body,
+                    image=image_url 
+                ),
+                data=custom_data or {}
+            )
+            response = messaging.send_each_for_multicast(message)
+            success_count += response.success_count
+            failure_count += response.failure_count
+            for token, result in zip(tokens, response.responses):
+                if result.success:
+                    continue
+                print(f"❌ Fallo al enviar notificación a token {token[:10]}: {result.exception}")
+                if isinstance(result.exception, messaging.UnregisteredError):
+                    invalid_tokens.append(token)
+        print(f"DEBUG_FCM: {success_count} enviada(s), {failure_count} fallida(s) para {user_email}.")
+
+        # Los tokens no registrados (app desinstalada) se eliminan en una sola escritura
+        if invalid_tokens:
+            db.collection('usuarios').document(user_email).update({'fcm_tokens': firestore.ArrayRemove(invalid_tokens)})
+            fcm_tokens_cache[user_email] = ([t for t in fcm_tokens if t not in invalid_tokens], time.time())
+            print(f"DEBUG_FCM: {len(invalid_tokens)} token(s) inválido(s) eliminado(s) para {user_email}.")
         return success_count > 0 
 
     except Exception as e:
@@ -202,6 +228,16 @@ def send_fcm_notification_direct(user_email, title, body, image_url=None, custom
         traceback.print_exc()
         return False
 
+def fcm_sender_loop():
+    """Hilo que envía las notificaciones encoladas por send_fcm_notification()."""
+    while True:
+        enviar_notificacion_fcm(*notificaciones_pendientes.get())
+
+def flush_notificaciones_al_salir():
+    """Al terminar el proceso, envía las notificaciones que quedaron en la cola."""
+    while not notificaciones_pendientes.empty():
+        enviar_notificacion_fcm(*notificaciones_pendientes.get_nowait())
+
 # ========== GESTIÓN DE EVENTOS PARA EL BACKEND DE LA APP ==========
 def enviar_evento_a_main3(event_data):
     try:
@@ -382,8 +418,7 @@ def procesar_imagenes():
 
                 blob_processed = bucket_fi.blob(FIREBASE_PATH_ALARMAS + nombre_archivo.replace('.jpg', '_processed.jpg')) 
                 blob_processed.upload_from_string(img_bytes, content_type='image/jpeg') 
-                blob_processed.make_public() 
-                image_public_url = blob_processed.public_url
+                image_public_url = storage_urls.url_imagen_procesada(blob_processed)
                 print(f"[INFO] Imagen procesada subida a: {image_public_url}")
 
                 # --- Notificación y Registro de Eventos (Persona Conocida) ---
@@ -397,7 +432,7 @@ def procesar_imagenes():
                         "device_id": device_id
                     }
                     enviar_evento_a_main3(event_data) 
-                    send_fcm_notification_direct( 
+                    send_fcm_notification( 
                         owner_email,
                         "Persona Conocida Detectada",
                         f"{nombre_conocido} fue detectado/a por la cámara {device_id}.",
@@ -421,7 +456,7 @@ def procesar_imagenes():
                                 if item['contador'] >= DETECCIONES_REQUERIDAS and \
                                    (current_utc_time - item.get('ultima_alarma', datetime.min.replace(tzinfo=timezone.utc))).total_seconds() > COOLDOWN_SECONDS:
                                     
-                                    send_fcm_notification_direct( 
+                                    send_fcm_notification( 
                                         owner_email,
                                         "¡ALERTA DE INTRUSO!",
                                         f"Rostro desconocido detectado en la cámara {device_id}. Detecciones: {item['contador']}.",
@@ -447,7 +482,7 @@ def procesar_imagenes():
                             })
                     
                     if is_new_unknown_alarm: 
-                         send_fcm_notification_direct( 
+                         send_fcm_notification( 
                             owner_email,
                             "Persona Desconocida Detectada",
                             f"Se detectó un rostro no identificado en la cámara {device_id}.",
@@ -470,7 +505,7 @@ def procesar_imagenes():
                 print(f"[INFO] Persona(s) sin rostro detectada ({persona_sin_rostro_contador}/{DETECCIONES_REQUERIDAS})")
                 if persona_sin_rostro_contador >= DETECCIONES_REQUERIDAS:
                     persona_sin_rostro_contador = 0
-                    send_fcm_notification_direct( 
+                    send_fcm_notification( 
                         owner_email,
                         "Alerta: Persona sin Rostro",
                         f"Persona detectada sin rostro en cámara {device_id}.",
@@ -498,4 +533,7 @@ def procesar_imagenes():
         time.sleep(10)
 
 if __name__ == "__main__":
+    threading.Thread(target=fcm_sender_loop, daemon=True).start()
+    atexit.register(flush_notificaciones_al_salir)
+    model_store.marcar_listo('fi')
     procesar_imagenes()
\ No newline at end of file
@@ -1,17 +1,21 @@
 # ======== IMPORTS ========
 import io, os, time
+import atexit, queue, threading
+from types import SimpleNamespace
 from datetime import datetime, timezone
 
 import cv2
 import numpy as np
 from scipy.spatial.distance import cosine
-import torch
-from mtcnn import MTCNN
-from keras_facenet import FaceNet
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
 import firebase_admin
 from firebase_admin import credentials, initialize_app, storage, messaging, firestore
+
+import model_store
+import storage_urls
 # =========================
 
 # ======== CONFIG =========
@@ -27,24 +31,51 @@ MAIN3_API_BASE_URL   = 'https://tesisdeteccion.ddns.net/api'
 
 NO_FACE_THRESHOLD = 3 
 NO_FACE_TIMEOUT_SECONDS = 120 
+PRESENCE_ABSENCE_SECONDS = 60   # Un conocido "se fue" de la cámara si no se le ve durante este tiempo
 DIST_THRESHOLD   = 0.50
 SIM_THRESHOLD    = 0.40
 REPEAT_THRESHOLD = 3
 COOLDOWN_SECONDS = 30
 EMB_REFRESH_SEC  = 600
 CACHE_EXPIRATION_SECONDS = 600  # 10 minutos
+
+# Envío de eventos a main3 por lotes
+EVENT_BATCH_SIZE      = 20    # Se envía el lote al juntar estos eventos (máximo EVENTS_BATCH_MAX=200 de main3)...
+EVENT_FLUSH_SECONDS   = 1.0   # ...o cuando el evento más viejo lleva este tiempo esperando
+EVENT_MAX_RETRIES     = 3     # Reintentos por lote (con espera exponencial) antes de guardarlo para luego
+EVENT_BUFFER_MAX      = 1000  # Si main3 no responde, se guardan como mucho estos eventos en memoria
+
+# Agrupación de notificaciones por (usuario, cámara)
+NOTIFY_COALESCE_WINDOW_SECONDS = 60  # Repeticiones dentro de esta ventana se envían como un solo resumen (0 = desactivado)
+NOTIFY_SEVERITY = {                  # Un tipo más grave que todo lo notificado en la ventana la reinicia
+    'known_person': 0,
+    'unknown_person': 1,
+    'person_no_face_alarm': 1,
+    'unknown_group': 2,
+    'unknown_person_repeated_alarm': 2,
+}
+
+# Métricas en formato Prometheus en http://localhost:METRICS_PORT/metrics
+METRICS_PORT = 9101
 # =========================
 
 
 # ===== FIREBASE INIT =====
-cred = credentials.Certificate(SERVICE_ACCOUNT_FILE)
-firebase_admin.initialize_app(cred, {
-    'projectId': PROJECT_ID,
-    'storageBucket': BUCKET_ID,
-})
-bucket = storage.bucket()
-db     = firestore.client()
-print('[OK] Firebase inicializado')
+# Se inicializa al arrancar el worker (no al importar el módulo), así el pipeline de decisión
+# se puede importar y medir sin credenciales ni red (ver benchmark_fi2_replay.py).
+bucket = None
+db     = None
+
+def iniciar_firebase():
+    global bucket, db
+    cred = credentials.Certificate(SERVICE_ACCOUNT_FILE)
+    firebase_admin.initialize_app(cred, {
+        'projectId': PROJECT_ID,
+        'storageBucket': BUCKET_ID,
+    })
+    bucket = storage.bucket()
+    db     = firestore.client()
+    print('[OK] Firebase inicializado')
 # =========================
 
 # --- Caché para los embeddings de los usuarios ---
@@ -53,12 +84,53 @@ embeddings_cache = {}
 # --- Memoria" para rastrear estas detecciones ---
 # Formato: {'camera_id': {'count': N, 'timestamp': ...}}
 no_face_tracker = {}
+# --- Presencia de personas conocidas por cámara ---
+# Formato: {'camera_id': {'nombre': {'llegada': ts, 'ultima_vista': ts, 'image_url': url}}}
+presencia = {}
+
+# ======== MÉTRICAS =======
+# Solo se actualizan contadores en memoria; el texto se genera cuando alguien consulta /metrics.
+# Los tamaños de colas y caché se calculan en ese momento (set_function), sin coste por frame.
+STAGE_SECONDS = Histogram('fi2_stage_seconds', 'Duración de cada etapa del worker de inferencia', ['stage'],
+                          buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+FRAMES_TOTAL = Counter('fi2_frames_total', 'Frames procesados por resultado (processed, no_owner, undecodable, failed)', ['result'])
+EVENTS_TOTAL = Counter('fi2_events_total', 'Eventos registrados por tipo', ['event_type'])
+NOTIFICATIONS_TOTAL = Counter('fi2_notifications_total', 'Notificaciones FCM por token y resultado (sent, failed, error = FCM no respondió)', ['result'])
+UPLOAD_BACKLOG = Gauge('fi2_upload_backlog', 'Imágenes pendientes en uploads/ en el último listado')
+EVENT_QUEUE_DEPTH = Gauge('fi2_event_queue_depth', 'Eventos esperando a enviarse a main3')
+NOTIFICATION_QUEUE_DEPTH = Gauge('fi2_notification_queue_depth', 'Notificaciones esperando a enviarse')
+GALLERY_CACHE_USERS = Gauge('fi2_gallery_cache_users', 'Usuarios con embeddings en caché')
+GALLERY_CACHE_EMBEDDINGS = Gauge('fi2_gallery_cache_embeddings', 'Embeddings en caché (todos los usuarios)')
+WORKER_READY = Gauge('fi2_ready', '1 cuando los modelos están cargados y calentados')
+STARTUP_SECONDS = Gauge('fi2_startup_seconds', 'Duración de cada paso del arranque', ['step'])
+GALLERY_CACHE_USERS.set_function(lambda: len(embeddings_cache))
+GALLERY_CACHE_EMBEDDINGS.set_function(lambda: sum(len(c['embeddings']) for c in list(embeddings_cache.values())))
+# =========================
 
 # ====== MODELOS ==========
-detector = MTCNN()
-embedder = FaceNet()
-yolo     = torch.hub.load('ultralytics/yolov5', 'yolov5x', trust_repo=True)
-NAMES    = yolo.names
+# Se cargan una sola vez al arrancar el worker, desde el almacén local (model_store.py), sin red.
+# torch y TensorFlow se importan recién ahí: importar el módulo (p. ej. desde un benchmark) es rápido.
+detector = None
+embedder = None
+yolo     = None
+NAMES    = {}
+
+def iniciar_modelos():
+    """Carga YOLO (torch) en paralelo con MTCNN y FaceNet (TensorFlow) y los calienta con una inferencia."""
+    global detector, embedder, yolo, NAMES
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        futuro_yolo = pool.submit(model_store.cargar_yolo, 'yolov5x')
+        detector = model_store.cargar_mtcnn()
+        embedder = model_store.cargar_facenet()
+        yolo = futuro_yolo.result()
+    NAMES = yolo.names
+    STARTUP_SECONDS.labels('models').set(time.perf_counter() - inicio)
+
+    inicio = time.perf_counter()
+    model_store.calentar(yolo, detector, embedder)
+    STARTUP_SECONDS.labels('warmup').set(time.perf_counter() - inicio)
+    print('[OK] Modelos cargados y calentados')
 # =========================
 
 def cargar_embeddings_por_usuario(user_email):
@@ -101,7 +173,6 @@ def cargar_embeddings_por_usuario(user_email):
 
 # ===== UTILIDADES ========
 
-
 # Pega esta función al principio de tu archivo fi.py
 
 def draw_text_with_outline(img, text, position, font_scale, color, thickness):
@@ -159,60 +230,515 @@ def cargar_embeddings_por_usuario(user_email):
     return embs, labels
 
 
-def send_fcm(user_email, event_data):
-    user_doc_ref = db.collection('usuarios').document(user_email)
+# ===== ENVÍO DE NOTIFICACIONES =====
+# Las notificaciones tampoco se envían en el hilo de inferencia: send_fcm() las encola y un hilo
+# las manda con una sola llamada send_each_for_multicast por usuario (todos sus tokens a la vez).
+# Los tokens que FCM reporta como no registrados se borran de Firestore en un único ArrayRemove.
+# Los tokens se reutilizan de la lectura del usuario que ya hace main() o de una caché con TTL.
+#
+# 'fcm_client' es cualquier objeto con send_each_for_multicast(message): por defecto el módulo
+# messaging de firebase_admin; con FCM_LOCAL_STANDIN=1 se usa un sustituto local que no sale a la red.
+FCM_TOKEN_CACHE_SECONDS = 300
+FCM_MULTICAST_MAX_TOKENS = 500   # Límite de tokens por llamada multicast de FCM
+
+fcm_mensajes_locales = []        # Mensajes "enviados" por el sustituto local, para inspeccionarlos
+
+def enviar_multicast_local(message):
+    """Sustituto local de send_each_for_multicast: los tokens 'unregistered*' fallan como no registrados."""
+    fcm_mensajes_locales.append(message)
+    responses = []
+    for token in message.tokens:
+        if token.startswith('unregistered'):
+            error = messaging.UnregisteredError(f'Token no registrado (simulado): {token}')
+            responses.append(SimpleNamespace(success=False, exception=error, message_id=None))
+        else:
+            responses.append(SimpleNamespace(success=True, exception=None, message_id=f'local-{len(fcm_mensajes_locales)}'))
+    return SimpleNamespace(responses=responses,
+                           success_count=sum(1 for r in responses if r.success),
+                           failure_count=sum(1 for r in responses if not r.success))
+
+if os.environ.get('FCM_LOCAL_STANDIN') == '1':
+    fcm_client = SimpleNamespace(send_each_for_multicast=enviar_multicast_local)
+else:
+    fcm_client = messaging
+fcm_tokens_cache = {}                # {'user_email': (tokens, timestamp)}
+notificaciones_pendientes = queue.Queue()
+
+def obtener_tokens_fcm(user_email):
+    """Tokens FCM del usuario desde la caché o, si caducó, desde Firestore."""
+    cached = fcm_tokens_cache.get(user_email)
+    if cached and time.time() - cached[1] < FCM_TOKEN_CACHE_SECONDS:
+        return cached[0]
+    user_doc = db.collection('usuarios').document(user_email).get()
+    if not user_doc.exists:
+        print(f"[ERROR] FCM: No se encontró el documento del usuario: {user_email}")
+        return []
+    tokens = user_doc.to_dict().get('fcm_tokens', [])
+    fcm_tokens_cache[user_email] = (tokens, time.time())
+    return tokens
+
+def send_fcm(user_email, event_data, fcm_tokens=None):
+    """
+    Encola una notificación. Si quien llama ya leyó el documento del usuario,
+    puede pasar sus 'fcm_tokens' para evitar otra lectura de Firestore.
+    """
+    if fcm_tokens is not None:
+        fcm_tokens_cache[user_email] = (list(fcm_tokens), time.time())
+    notificaciones_pendientes.put((user_email, event_data))
+
+def enviar_notificacion(user_email, event_data):
+    """Envía la notificación a todos los tokens del usuario y limpia los que ya no son válidos."""
+    fcm_tokens = obtener_tokens_fcm(user_email)
+    if not fcm_tokens:
+        print(f"[INFO] FCM: El usuario {user_email} no tiene tokens FCM registrados.")
+        return
+
+    invalid_tokens = []
+    for i in range(0, len(fcm_tokens), FCM_MULTICAST_MAX_TOKENS):
+        tokens = fcm_tokens[i:i + FCM_MULTICAST_MAX_TOKENS]
+        message = messaging.MulticastMessage(
+            tokens=tokens,
+            notification=messaging.Notification(
+                title=event_data['title'],
+                body=event_data['body'],
+            ),
+            android=messaging.AndroidConfig(priority='high'),
+            data={'image_url': event_data.get('image_url') or '', 'count': str(event_data.get('count', 1))}
+        )
+        try:
+            with STAGE_SECONDS.labels('fcm').time():
+                response = fcm_client.send_each_for_multicast(message)
+        except Exception as e:
+            # Caída de FCM (red, credenciales, cuota): no llega a ningún token de este lote ni de
+            # los siguientes. Se cuentan como 'error' para que la caída se vea en las métricas.
+            NOTIFICATIONS_TOTAL.labels('error').inc(len(fcm_tokens) - i)
+            print(f"[ERROR] FCM: Fallo al enviar a {user_email} ({len(fcm_tokens) - i} token(s) sin notificar): {e}")
+            break
+        NOTIFICATIONS_TOTAL.labels('sent').inc(response.success_count)
+        NOTIFICATIONS_TOTAL.labels('failed').inc(response.failure_count)
+        for token, result in zip(tokens, response.responses):
+            if result.success:
+                continue
+            if isinstance(result.exception, messaging.UnregisteredError):
+                # El token es inválido porque la app fue desinstalada o los datos borrados.
+                invalid_tokens.append(token)
+            else:
+                # Cualquier otro error (ej. de red) no elimina el token.
+                print(f"[WARN] FCM: Fallo al enviar al token ...{token[-6:]}. Error: {result.exception}")
+        print(f"[SUCCESS] FCM: {response.success_count}/{len(tokens)} notificación(es) enviada(s) a {user_email}.")
+
+    if invalid_tokens:
+        print(f"[CLEANUP] FCM: {len(invalid_tokens)} token(s) inválido(s) para {user_email}. Eliminándolos de la base de datos.")
+        try:
+            db.collection('usuarios').document(user_email).update({
+                'fcm_tokens': firestore.ArrayRemove(invalid_tokens)
+            })
+            fcm_tokens_cache[user_email] = ([t for t in fcm_tokens if t not in invalid_tokens], time.time())
+        except Exception as e:
+            print(f"[ERROR] FCM: Fallo al intentar eliminar los tokens inválidos: {e}")
+
+# --- Agrupación (debounce) por usuario y cámara ---
+# En CAPTURE_MODE una persona frente a la puerta genera un evento cada 5 s. Solo se agrupan
+# eventos del mismo tipo: la primera notificación de cada tipo en la ventana sale de inmediato;
+# sus repeticiones se cuentan y, al cerrar la ventana, se envía un único resumen por tipo con
+# el número de detecciones. Si el tipo nuevo es más grave que todo lo ya notificado
+# (NOTIFY_SEVERITY), además se reinicia la ventana, para que sus repeticiones esperen una completa.
+# Solo lo usa el hilo de notificaciones, así que no necesita lock.
+# Formato: {(user_email, device_id): {'inicio': ts, 'severidad': int, 'tipos': {event_type: {'count', 'event_data'}}}}
+# 'tipos' son los tipos ya notificados en la ventana; 'count' son sus repeticiones pendientes.
+ventanas_notificacion = {}
+
+def enviar_notificacion_segura(user_email, event_data):
     try:
-        user_doc = user_doc_ref.get()
-        if not user_doc.exists:
-            print(f"[ERROR] FCM: No se encontró el documento del usuario: {user_email}")
-            return
+        enviar_notificacion(user_email, event_data)
     except Exception as e:
-        print(f"[ERROR] FCM: No se pudo obtener el documento del usuario: {e}")
+        # Por ejemplo, no se pudieron leer los tokens del usuario: cuenta como un 'error'
+        NOTIFICATIONS_TOTAL.labels('error').inc()
+        print(f"[ERROR] FCM: No se pudo enviar la notificación a {user_email}: {e}")
+
+def procesar_notificacion(user_email, event_data):
+    """Envía la notificación ahora o la acumula en la ventana de su (usuario, cámara)."""
+    if NOTIFY_COALESCE_WINDOW_SECONDS <= 0:
+        enviar_notificacion_segura(user_email, event_data)
         return
 
-    fcm_tokens = user_doc.to_dict().get('fcm_tokens', [])
-    if not fcm_tokens:
-        print(f"[INFO] FCM: El usuario {user_email} no tiene tokens FCM registrados.")
+    key = (user_email, event_data.get('device_id', 'unknown'))
+    event_type = event_data.get('event_type')
+    severidad = NOTIFY_SEVERITY.get(event_type, 0)
+    ventana = ventanas_notificacion.get(key)
+
+    if ventana is None:
+        ventana = ventanas_notificacion[key] = {'inicio': time.time(), 'severidad': severidad, 'tipos': {}}
+    elif severidad > ventana['severidad']:
+        # Escalada: la ventana se reinicia. Las repeticiones ya acumuladas se conservan para el resumen.
+        print(f"[INFO] FCM: Escalada a '{event_type}' en {key[1]}, se reinicia la ventana.")
+        ventana['inicio'] = time.time()
+        ventana['severidad'] = severidad
+
+    tipo = ventana['tipos'].get(event_type)
+    if tipo is None:
+        # Primer evento de este tipo en la ventana: sale de inmediato
+        enviar_notificacion_segura(user_email, event_data)
+        ventana['tipos'][event_type] = {'count': 0, 'event_data': None}
         return
 
-    # Creamos una copia de la lista para iterar, por si la modificamos durante el bucle
-    for token in list(fcm_tokens):
+    tipo['count'] += 1
+    tipo['event_data'] = event_data
+
+def cerrar_ventanas_notificacion(forzar=False):
+    """Envía los resúmenes de las ventanas vencidas (o de todas, si 'forzar')."""
+    ahora = time.time()
+    for key, ventana in list(ventanas_notificacion.items()):
+        if not forzar and ahora - ventana['inicio'] < NOTIFY_COALESCE_WINDOW_SECONDS:
+            continue
+        # Los tipos sin repeticiones salen de la ventana: su próxima detección se notifica de inmediato
+        repetidos = {event_type: tipo for event_type, tipo in ventana['tipos'].items() if tipo['count']}
+        if not repetidos:
+            del ventanas_notificacion[key]
+            continue
+
+        user_email, device_id = key
+        for event_type, tipo in repetidos.items():
+            resumen = dict(tipo['event_data'])
+            resumen['count'] = tipo['count']
+            resumen['body'] = f"{resumen['body']} ({tipo['count']} detección(es) más en {NOTIFY_COALESCE_WINDOW_SECONDS} s)"
+            enviar_notificacion_segura(user_email, resumen)
+        # La persona sigue ahí: mantenemos la ventana abierta para seguir agrupando esos tipos
+        ventana['inicio'] = ahora
+        ventana['severidad'] = max(NOTIFY_SEVERITY.get(event_type, 0) for event_type in repetidos)
+        ventana['tipos'] = {event_type: {'count': 0, 'event_data': None} for event_type in repetidos}
+
+def notification_loop():
+    """Hilo que procesa las notificaciones encoladas por send_fcm() y cierra las ventanas vencidas."""
+    while True:
         try:
-            message = messaging.Message(
-                token=token,
-                notification=messaging.Notification(
-                    title=event_data['title'],
-                    body=event_data['body'],
-                ),
-                android=messaging.AndroidConfig(priority='high'),
-                data={'image_url': event_data.get('image_url', '')}
-            )
-            messaging.send(message)
-            print(f"[SUCCESS] FCM: Notificación enviada exitosamente al token que termina en ...{token[-6:]}")
-
-        except messaging.UnregisteredError:
-            # ESTE ES EL CASO: El token es inválido porque la app fue desinstalada o los datos borrados.
-            print(f"[CLEANUP] FCM: Token inválido detectado (...{token[-6:]}). Eliminándolo de la base de datos.")
-            try:
-                # Usamos ArrayRemove para eliminar el token específico de la lista en Firestore.
-                user_doc_ref.update({
-                    'fcm_tokens': firestore.ArrayRemove([token])
-                })
-                print(f"[SUCCESS] FCM: Token inválido eliminado para el usuario {user_email}.")
-            except Exception as e:
-                print(f"[ERROR] FCM: Fallo al intentar eliminar el token inválido: {e}")
+            user_email, event_data = notificaciones_pendientes.get(timeout=1)
+            procesar_notificacion(user_email, event_data)
+        except queue.Empty:
+            pass
+        cerrar_ventanas_notificacion()
+
+def flush_notificaciones_al_salir():
+    """Al terminar el proceso, envía las notificaciones de la cola y los resúmenes pendientes."""
+    while not notificaciones_pendientes.empty():
+        user_email, event_data = notificaciones_pendientes.get_nowait()
+        procesar_notificacion(user_email, event_data)
+    cerrar_ventanas_notificacion(forzar=True)
+
+NOTIFICATION_QUEUE_DEPTH.set_function(notificaciones_pendientes.qsize)
+# =========================
 
-        except Exception as e:
-            # Captura cualquier otro tipo de error (ej. de red) sin eliminar el token.
-            print(f"[WARN] FCM: Fallo al enviar al token ...{token[-6:]} por otra razón. Error: {e}")
+
+# ===== PRESENCIA DE CONOCIDOS =====
+# En CAPTURE_MODE llega un frame cada 5 s mientras alguien está frente a la cámara. En vez de un
+# evento 'known_person' (subida + escritura + push) por frame, se registra un evento al llegar y
+# otro 'known_person_left' cuando deja de vérsele durante PRESENCE_ABSENCE_SECONDS. Mientras
+# sigue presente solo se actualiza 'ultima_vista' en memoria; el evento de salida lleva el tiempo
+# de permanencia ('dwell_seconds') y reutiliza la imagen de la llegada (o '' si no se subió).
+# Es un evento aparte y no una actualización del de llegada porque el worker no conoce el id que
+# main3 le asigna en /events/add_batch; main3 no lo cuenta como entrada en el total diario.
+
+def actualizar_presencia(device_id, nombres, ahora, registrar_llegadas=True):
+    """
+    Marca como vistos a 'nombres' en la cámara. Devuelve los que acaban de llegar.
+    Con registrar_llegadas=False solo refresca a los que ya estaban presentes
+    (la imagen genera otro evento y la llegada se registrará cuando se les vea solos).
+    """
+    camara = presencia.setdefault(device_id, {})
+    llegados = []
+    for nombre in nombres:
+        estado = camara.get(nombre)
+        if estado is not None:
+            estado['ultima_vista'] = ahora
+        elif registrar_llegadas:
+            camara[nombre] = {'llegada': ahora, 'ultima_vista': ahora, 'image_url': None}
+            llegados.append(nombre)
+    return sorted(llegados)
+
+def revisar_salidas(ahora):
+    """Registra 'known_person_left' para cada conocido que no se ve hace PRESENCE_ABSENCE_SECONDS."""
+    for device_id, camara in list(presencia.items()):
+        for nombre, estado in list(camara.items()):
+            if ahora - estado['ultima_vista'] < PRESENCE_ABSENCE_SECONDS:
+                continue
+            del camara[nombre]
+            dwell = int(estado['ultima_vista'] - estado['llegada'])
+            print(f"[INFO] {nombre} salió de {device_id} tras {dwell} s.")
+            registrar_evento({
+                'person_name': nombre,
+                'event_type': 'known_person_left',
+                'timestamp': datetime.fromtimestamp(estado['ultima_vista'], timezone.utc).isoformat(),
+                'device_id': device_id,
+                'image_url': estado['image_url'] or '',
+                'event_details': f'{nombre} salió de la cámara {device_id} tras {dwell // 60} min {dwell % 60} s.',
+                'dwell_seconds': dwell,
+            })
+        if not camara:
+            del presencia[device_id]
+# =========================
 
 
+# ===== ENVÍO DE EVENTOS ===
+# Los eventos no se envían uno por uno: registrar_evento() los encola y un hilo los manda
+# en lotes a /events/add_batch por una sesión HTTP persistente (keep-alive). Si el envío
+# falla, se reintenta con espera exponencial y, si sigue fallando, el lote se conserva para
+# el siguiente envío (hasta EVENT_BUFFER_MAX eventos).
+# Los reintentos se hacen sin tener tomado eventos_lock: el lote se saca del buffer, se envía
+# y lo que no se pudo enviar se devuelve al principio del buffer.
+http_session = requests.Session()
+eventos_pendientes = queue.Queue()
+eventos_en_buffer = []              # Eventos sacados de la cola que aún no se han enviado
+eventos_en_envio = 0                # Eventos fuera del buffer mientras se envían (para la métrica)
+eventos_lock = threading.Lock()     # Protege eventos_en_buffer; solo se toma para mover eventos
+envio_lock = threading.Lock()       # Un solo envío a la vez (hilo de envío o salida del proceso)
+
 def registrar_evento(ev):
-    try:
-        requests.post(f'{MAIN3_API_BASE_URL}/events/add',
-                      json=ev, timeout=5)
-    except Exception as e:
-        print(f'[WARN] registrar_evento: {e}')
+    """Encola un evento para enviarlo a main3 en el próximo lote."""
+    EVENTS_TOTAL.labels(ev.get('event_type', 'unknown')).inc()
+    eventos_pendientes.put(ev)
+
+def enviar_lote_eventos(lote):
+    """
+    Envía un lote a main3 con reintentos. Devuelve True si el lote ya no hay que reenviarlo
+    (aceptado o descartado por inválido) y False si hay que conservarlo para más tarde.
+    """
+    for intento in range(EVENT_MAX_RETRIES):
+        try:
+            with STAGE_SECONDS.labels('event_post').time():
+                resp = http_session.post(f'{MAIN3_API_BASE_URL}/events/add_batch',
+                                         json={'events': lote}, timeout=10)
+            if resp.status_code == 201:
+                rechazados = resp.json().get('rejected', [])
+                if rechazados:
+                    print(f'[WARN] registrar_evento: main3 rechazó {len(rechazados)} evento(s): {rechazados}')
+                print(f'[OK] Lote de {len(lote)} evento(s) registrado en main3.')
+                return True
+            if resp.status_code == 413 and len(lote) > 1:
+                # Lote demasiado grande para main3: se envía en dos mitades
+                mitad = len(lote) // 2
+                print(f'[WARN] registrar_evento: lote de {len(lote)} demasiado grande, se divide en dos.')
+                return enviar_lote_eventos(lote[:mitad]) and enviar_lote_eventos(lote[mitad:])
+            if resp.status_code in (400, 401, 403, 413):
+                # Lote inválido o sin permiso: reintentar no va a ayudar
+                print(f'[ERROR] registrar_evento: lote descartado ({resp.status_code}): {resp.text}')
+                return True
+            print(f'[WARN] registrar_evento: respuesta {resp.status_code} (intento {intento + 1})')
+        except Exception as e:
+            print(f'[WARN] registrar_evento: {e} (intento {intento + 1})')
+        time.sleep(2 ** intento)
+    return False
+
+def vaciar_eventos():
+    """
+    Saca el buffer, lo envía en lotes de EVENT_BATCH_SIZE y devuelve al buffer lo que no se pudo
+    enviar. eventos_lock solo se toma para mover los eventos, nunca durante el envío.
+    """
+    global eventos_en_envio
+    with envio_lock:
+        with eventos_lock:
+            por_enviar = eventos_en_buffer[:]
+            eventos_en_buffer.clear()
+            eventos_en_envio = len(por_enviar)
+        while por_enviar:
+            lote = por_enviar[:EVENT_BATCH_SIZE]
+            if not enviar_lote_eventos(lote):
+                break
+            del por_enviar[:len(lote)]
+            eventos_en_envio = len(por_enviar)
+        with eventos_lock:
+            eventos_en_buffer[:0] = por_enviar
+            eventos_en_envio = 0
+            if len(eventos_en_buffer) > EVENT_BUFFER_MAX:
+                print(f'[ERROR] registrar_evento: buffer lleno, se descartan {len(eventos_en_buffer) - EVENT_BUFFER_MAX} evento(s) antiguos.')
+                del eventos_en_buffer[:len(eventos_en_buffer) - EVENT_BUFFER_MAX]
+            return len(eventos_en_buffer)
+
+def event_sink_loop():
+    """Hilo que junta eventos y los envía por tamaño o por tiempo."""
+    primero_en = None
+    while True:
+        timeout = EVENT_FLUSH_SECONDS if primero_en is None else max(0, primero_en + EVENT_FLUSH_SECONDS - time.time())
+        try:
+            ev = eventos_pendientes.get(timeout=timeout)
+            with eventos_lock:
+                eventos_en_buffer.append(ev)
+            if primero_en is None:
+                primero_en = time.time()
+        except queue.Empty:
+            pass
+        with eventos_lock:
+            listo = eventos_en_buffer and (len(eventos_en_buffer) >= EVENT_BATCH_SIZE or time.time() - primero_en >= EVENT_FLUSH_SECONDS)
+        if listo:
+            primero_en = time.time() if vaciar_eventos() else None
+
+def flush_eventos_al_salir():
+    """Al terminar el proceso, envía los eventos que quedaron en la cola o en el buffer."""
+    with eventos_lock:
+        while not eventos_pendientes.empty():
+            eventos_en_buffer.append(eventos_pendientes.get_nowait())
+    vaciar_eventos()
+
+EVENT_QUEUE_DEPTH.set_function(lambda: eventos_pendientes.qsize() + len(eventos_en_buffer) + eventos_en_envio)
+
+def iniciar_hilos():
+    """
+    Arranca los hilos de envío de eventos y notificaciones y registra sus vaciados al salir.
+    Se llama desde __main__ para que importar fi2 (p. ej. desde benchmark_fi2_replay.py) no
+    arranque hilos ni envíe nada al terminar.
+    """
+    threading.Thread(target=event_sink_loop, daemon=True).start()
+    threading.Thread(target=notification_loop, daemon=True).start()
+    atexit.register(flush_eventos_al_salir)
+    atexit.register(flush_notificaciones_al_salir)
+# =========================
+
+
+# ===== PIPELINE DE DECISIÓN =====
+def registrar_tiempo(tiempos, etapa, inicio):
+    """Suma a tiempos[etapa] los segundos desde 'inicio' (si se están midiendo tiempos)."""
+    if tiempos is not None:
+        tiempos[etapa] = tiempos.get(etapa, 0.0) + (time.perf_counter() - inicio)
+
+def analizar_imagen(img, img_rgb, device_id, known_embs, known_labels, tiempos=None):
+    """
+    Ejecuta YOLO -> MTCNN -> FaceNet -> comparación y decide el evento de una imagen.
+    Dibuja los recuadros sobre 'img'. No toca Storage, Firestore ni FCM, así que también
+    se puede usar sin conexión (ver benchmark_fi2_replay.py).
+    Devuelve (evento o None, título, cuerpo, conocidos que acaban de llegar).
+    Si se pasa 'tiempos', acumula ahí los segundos de cada etapa.
+    """
+    evento, title, body = None, '', ''
+    llegados = []
+
+    # 4. EJECUTAR MODELOS DE IA
+    # --- INICIO DE LA CORRECCIÓN ---
+    # Primero, detectamos personas con YOLO y llenamos la lista 'personas'
+    print(f"[INFO] Ejecutando YOLO para detectar personas...")
+    personas = []
+    # Asegúrate de que 'yolo' y 'NAMES' estén definidos globalmente al inicio del script
+    inicio = time.perf_counter()
+    yolo_results = yolo(img_rgb) 
+    for *xywh, conf, cls in yolo_results.xywh[0]:
+        if conf > 0.5 and NAMES[int(cls)] == 'person':
+            personas.append(xywh)
+            x_yolo, y_yolo, w_yolo, h_yolo = map(int, xywh)
+            px, py = x_yolo - w_yolo//2, y_yolo - h_yolo//2
+            # El color amarillo en formato BGR (Blue, Green, Red) es (0, 255, 255)
+            cv2.rectangle(img, (px, py), (px + w_yolo, py + h_yolo), (0, 255, 255), 2)
+
+    registrar_tiempo(tiempos, 'yolo', inicio)
+    print(f"[INFO] YOLO encontró {len(personas)} persona(s).")
+
+    # Segundo, detectamos rostros con MTCNN
+    print(f"[INFO] Ejecutando MTCNN para detectar rostros...")
+    inicio = time.perf_counter()
+    faces = detector.detect_faces(img_rgb)
+    registrar_tiempo(tiempos, 'mtcnn', inicio)
+    print(f"[INFO] MTCNN encontró {len(faces)} rostro(s).")
+    # --- FIN DE LA CORRECCIÓN ---
+
+    # 5. ÁRBOL DE DECISIÓN: ¿Qué tipo de evento es esta imagen?
+
+    # --- CASO A: PERSONA(S) DETECTADA(S), PERO NINGÚN ROSTRO VISIBLE ---
+    # Esta condición es la clave: hay "personas" pero no "rostros".
+    if len(personas) > 0 and len(faces) == 0:
+        print(f"[INFO] Detección de persona sin rostro en {device_id}.")
+
+        now = time.time()
+        # Si es la primera vez que vemos esto en esta cámara o ha pasado mucho tiempo, (re)iniciamos el contador
+        if (device_id not in no_face_tracker or 
+            (now - no_face_tracker[device_id]['timestamp']) > NO_FACE_TIMEOUT_SECONDS):
+            no_face_tracker[device_id] = {'count': 1, 'timestamp': now}
+            print(f"[INFO] Iniciando seguimiento de rostro cubierto para {device_id}.")
+        else:
+            # Si es una detección reciente en la misma cámara, incrementamos el contador
+            no_face_tracker[device_id]['count'] += 1
+            no_face_tracker[device_id]['timestamp'] = now
+            print(f"[INFO] Detección consecutiva de rostro cubierto para {device_id}. Conteo: {no_face_tracker[device_id]['count']}.")
+
+        # Comprobamos si hemos alcanzado el umbral para disparar la alarma
+        if no_face_tracker[device_id]['count'] >= NO_FACE_THRESHOLD:
+            print(f"[ALARM] Umbral de rostro cubierto alcanzado para {device_id}!")
+            title = "¡ALERTA DE SEGURIDAD!"
+            body = f"Posible intruso cubriendo su rostro en la cámara {device_id}."
+            evento = {
+                'person_name': 'Rostro Cubierto',
+                'event_type': 'person_no_face_alarm'
+            }
+            # Reiniciamos el contador para esta cámara para no enviar la misma alarma repetidamente
+            no_face_tracker.pop(device_id, None)
+
+    # --- CASO B: SÍ SE DETECTARON ROSTROS ---
+    elif len(faces) > 0:
+        print(f"[INFO] Condición cumplida: Procesando {len(faces)} rostro(s) encontrado(s).")
+        unknowns, known_set = [], set()
+        detected_names = set()
+
+
+        for face in faces:
+            x, y, w, h = [abs(int(v)) for v in face['box']]
+            if w < 30 or h < 30: continue
+
+            face_rgb = cv2.resize(img_rgb[y:y+h, x:x+w], (160, 160))
+            inicio = time.perf_counter()
+            emb = embedder.embeddings(np.expand_dims(face_rgb, 0))[0]
+            registrar_tiempo(tiempos, 'facenet', inicio)
+
+            inicio = time.perf_counter()
+            name = "Desconocido"
+            if known_embs: # Solo comparar si el usuario tiene rostros registrados
+                best_dist = 1.0
+                for kv, kn in zip(known_embs, known_labels):
+                    dist = cosine(emb, kv)
+                    if dist < best_dist:
+                        best_dist = dist
+                        if dist < DIST_THRESHOLD:
+                            name = kn
+
+            registrar_tiempo(tiempos, 'match', inicio)
+
+            color = (0, 255, 0) if name != 'Desconocido' else (0, 0, 255)
+            cv2.rectangle(img, (x, y), (x + w, y + h), color, 2)
+
+            if name == 'Desconocido':
+                unknowns.append({'emb': emb})
+            else:
+                known_set.add(name)
+
+            detected_names.add(name)
+
+        if detected_names:
+            display_text = ", ".join(sorted(list(detected_names)))
+
+            # Calculamos el tamaño del texto para posicionarlo bien
+            font_scale = 0.7
+            thickness = 2
+            (text_width, text_height), _ = cv2.getTextSize(display_text, cv2.FONT_HERSHEY_SIMPLEX, font_scale, thickness)
+
+            # Posición en la esquina superior derecha con un margen de 10px
+            image_height, image_width, _ = img.shape
+            position = (image_width - text_width - 10, text_height + 10)
+
+            # Llamamos a nuestra nueva función para dibujar
+            draw_text_with_outline(img, display_text, position, font_scale, (255, 255, 255), thickness)
+
+        # Decisión basada en los rostros encontrados
+        # Los conocidos solo generan evento al llegar; si ya estaban, se actualiza su presencia.
+        llegados = actualizar_presencia(device_id, known_set, time.time(), registrar_llegadas=not unknowns)
+        if len(unknowns) >= 2:
+            title, body = '¡ALERTA GRUPAL!', f'{len(unknowns)} desconocidos en {device_id}.'
+            evento = {'person_name': 'Desconocidos (Grupo)', 'event_type': 'unknown_group'}
+        elif len(unknowns) == 1:
+            title, body = 'Persona desconocida detectada', f'Rostro no identificado en {device_id}.'
+            evento = {'person_name': 'Desconocido', 'event_type': 'unknown_person'}
+        elif llegados:
+            personas_txt = ', '.join(llegados)
+            title, body = 'Persona conocida detectada', f'{personas_txt} llegó a la cámara {device_id}.'
+            evento = {'person_name': personas_txt, 'event_type': 'known_person'}
+        elif known_set:
+            print(f"[INFO] {', '.join(sorted(known_set))} sigue(n) en {device_id}. Sin evento nuevo.")
+
+    return evento, title, body, llegados
 # =========================
 
 
@@ -225,8 +751,12 @@ def main():
     history = [] # Para el seguimiento de desconocidos recurrentes
 
     while True:
+        revisar_salidas(time.time())
+
         # Busca nuevos archivos en la carpeta de subidas
-        blobs = [b for b in bucket.list_blobs(prefix=PREF_UPLOADS) if not b.name.endswith('/')]
+        with STAGE_SECONDS.labels('storage_list').time():
+            blobs = [b for b in bucket.list_blobs(prefix=PREF_UPLOADS) if not b.name.endswith('/')]
+        UPLOAD_BACKLOG.set(len(blobs))
         if not blobs:
             time.sleep(5)
             continue
@@ -242,6 +772,7 @@ def main():
                 
                 if not owner_snap:
                     print(f"[WARN] No se encontró propietario para {device_id}. Borrando imagen.")
+                    FRAMES_TOTAL.labels('no_owner').inc()
                     blob.delete()
                     continue
                 
@@ -251,128 +782,23 @@ def main():
                 known_embs, known_labels = cargar_embeddings_por_usuario(owner_id)
 
                 # 3. PROCESAR LA IMAGEN
-                img_np = np.frombuffer(blob.download_as_bytes(), np.uint8)
+                with STAGE_SECONDS.labels('download').time():
+                    img_np = np.frombuffer(blob.download_as_bytes(), np.uint8)
                 img = cv2.imdecode(img_np, cv2.IMREAD_COLOR)
+                if img is None:
+                    print(f"[WARN] No se pudo decodificar {nombre_archivo}. Borrando imagen.")
+                    FRAMES_TOTAL.labels('undecodable').inc()
+                    blob.delete()
+                    continue
                 img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
                 
-                # Inicializar variables para el evento
-                evento, title, body = None, '', ''
                 utc_now_obj = datetime.now(timezone.utc)
 
-                # 4. EJECUTAR MODELOS DE IA
-                # --- INICIO DE LA CORRECCIÓN ---
-                # Primero, detectamos personas con YOLO y llenamos la lista 'personas'
-                print(f"[INFO] Ejecutando YOLO para detectar personas...")
-                personas = []
-                # Asegúrate de que 'yolo' y 'NAMES' estén definidos globalmente al inicio del script
-                yolo_results = yolo(img_rgb) 
-                for *xywh, conf, cls in yolo_results.xywh[0]:
-                    if conf > 0.5 and NAMES[int(cls)] == 'person':
-                        personas.append(xywh)
-                        x_yolo, y_yolo, w_yolo, h_yolo = map(int, xywh)
-                        px, py = x_yolo - w_yolo//2, y_yolo - h_yolo//2
-                        # El color amarillo en formato BGR (Blue, Green, Red) es (0, 255, 255)
-                        cv2.rectangle(img, (px, py), (px + w_yolo, py + h_yolo), (0, 255, 255), 2)
-               
-                print(f"[INFO] YOLO encontró {len(personas)} persona(s).")
-
-                # Segundo, detectamos rostros con MTCNN
-                print(f"[INFO] Ejecutando MTCNN para detectar rostros...")
-                faces = detector.detect_faces(img_rgb)
-                print(f"[INFO] MTCNN encontró {len(faces)} rostro(s).")
-                # --- FIN DE LA CORRECCIÓN ---
-                
-                # 5. ÁRBOL DE DECISIÓN: ¿Qué tipo de evento es esta imagen?
-                
-                # --- CASO A: PERSONA(S) DETECTADA(S), PERO NINGÚN ROSTRO VISIBLE ---
-                # Esta condición es la clave: hay "personas" pero no "rostros".
-                if len(personas) > 0 and len(faces) == 0:
-                    print(f"[INFO] Detección de persona sin rostro en {device_id}.")
-                    
-                    now = time.time()
-                    # Si es la primera vez que vemos esto en esta cámara o ha pasado mucho tiempo, (re)iniciamos el contador
-                    if (device_id not in no_face_tracker or 
-                        (now - no_face_tracker[device_id]['timestamp']) > NO_FACE_TIMEOUT_SECONDS):
-                        no_face_tracker[device_id] = {'count': 1, 'timestamp': now}
-                        print(f"[INFO] Iniciando seguimiento de rostro cubierto para {device_id}.")
-                    else:
-                        # Si es una detección reciente en la misma cámara, incrementamos el contador
-                        no_face_tracker[device_id]['count'] += 1
-                        no_face_tracker[device_id]['timestamp'] = now
-                        print(f"[INFO] Detección consecutiva de rostro cubierto para {device_id}. Conteo: {no_face_tracker[device_id]['count']}.")
-
-                    # Comprobamos si hemos alcanzado el umbral para disparar la alarma
-                    if no_face_tracker[device_id]['count'] >= NO_FACE_THRESHOLD:
-                        print(f"[ALARM] Umbral de rostro cubierto alcanzado para {device_id}!")
-                        title = "¡ALERTA DE SEGURIDAD!"
-                        body = f"Posible intruso cubriendo su rostro en la cámara {device_id}."
-                        evento = {
-                            'person_name': 'Rostro Cubierto',
-                            'event_type': 'person_no_face_alarm'
-                        }
-                        # Reiniciamos el contador para esta cámara para no enviar la misma alarma repetidamente
-                        no_face_tracker.pop(device_id, None)
-
-                # --- CASO B: SÍ SE DETECTARON ROSTROS ---
-                elif len(faces) > 0:
-                    print(f"[INFO] Condición cumplida: Procesando {len(faces)} rostro(s) encontrado(s).")
-                    unknowns, known_set = [], set()
-                    detected_names = set()
-
-
-                    for face in faces:
-                        x, y, w, h = [abs(int(v)) for v in face['box']]
-                        if w < 30 or h < 30: continue
-                        
-                        face_rgb = cv2.resize(img_rgb[y:y+h, x:x+w], (160, 160))
-                        emb = embedder.embeddings(np.expand_dims(face_rgb, 0))[0]
-
-                        name = "Desconocido"
-                        if known_embs: # Solo comparar si el usuario tiene rostros registrados
-                            best_dist = 1.0
-                            for kv, kn in zip(known_embs, known_labels):
-                                dist = cosine(emb, kv)
-                                if dist < best_dist:
-                                    best_dist = dist
-                                    if dist < DIST_THRESHOLD:
-                                        name = kn
-                        
-                        color = (0, 255, 0) if name != 'Desconocido' else (0, 0, 255)
-                        cv2.rectangle(img, (x, y), (x + w, y + h), color, 2)
-
-                        if name == 'Desconocido':
-                            unknowns.append({'emb': emb})
-                        else:
-                            known_set.add(name)
-                        
-                        detected_names.add(name)
-
-                    if detected_names:
-                        display_text = ", ".join(sorted(list(detected_names)))
-                        
-                        # Calculamos el tamaño del texto para posicionarlo bien
-                        font_scale = 0.7
-                        thickness = 2
-                        (text_width, text_height), _ = cv2.getTextSize(display_text, cv2.FONT_HERSHEY_SIMPLEX, font_scale, thickness)
-                        
-                        # Posición en la esquina superior derecha con un margen de 10px
-                        image_height, image_width, _ = img.shape
-                        position = (image_width - text_width - 10, text_height + 10)
-                        
-                        # Llamamos a nuestra nueva función para dibujar
-                        draw_text_with_outline(img, display_text, position, font_scale, (255, 255, 255), thickness)
-
-                    # Decisión basada en los rostros encontrados
-                    if len(unknowns) >= 2:
-                        title, body = '¡ALERTA GRUPAL!', f'{len(unknowns)} desconocidos en {device_id}.'
-                        evento = {'person_name': 'Desconocidos (Grupo)', 'event_type': 'unknown_group'}
-                    elif len(unknowns) == 1:
-                        title, body = 'Persona desconocida detectada', f'Rostro no identificado en {device_id}.'
-                        evento = {'person_name': 'Desconocido', 'event_type': 'unknown_person'}
-                    elif known_set:
-                        personas_txt = ', '.join(sorted(known_set))
-                        title, body = 'Persona conocida detectada', f'{personas_txt} en cámara {device_id}.'
-                        evento = {'person_name': personas_txt, 'event_type': 'known_person'}
+                # 4-5. EJECUTAR MODELOS DE IA Y DECIDIR EL EVENTO
+                tiempos = {}
+                evento, title, body, llegados = analizar_imagen(img, img_rgb, device_id, known_embs, known_labels, tiempos)
+                for etapa, segundos in tiempos.items():
+                    STAGE_SECONDS.labels(etapa).observe(segundos)
 
                 # 6. PUNTO DE ACCIÓN FINAL
                 # Si se generó CUALQUIER tipo de evento en los pasos anteriores, se procesa aquí.
@@ -384,9 +810,13 @@ def main():
                         pref = PREF_GROUPS if evento.get('event_type') == 'unknown_group' else PREF_PROCESSED
                         out_blob_name = pref + nombre_archivo.replace('.jpg', '_proc.jpg')
                         out_blob = bucket.blob(out_blob_name)
-                        out_blob.upload_from_string(buff.tobytes(), content_type='image/jpeg')
-                        out_blob.make_public()
-                        img_url = out_blob.public_url
+                        with STAGE_SECONDS.labels('upload').time():
+                            out_blob.upload_from_string(buff.tobytes(), content_type='image/jpeg')
+                        img_url = storage_urls.url_imagen_procesada(out_blob)
+                    if evento['event_type'] == 'known_person':
+                        # La salida reutilizará esta imagen, sin otra subida
+                        for nombre in llegados:
+                            presencia[device_id][nombre]['image_url'] = img_url
 
                     # Completar y registrar el evento en Firestore
                     evento.update({
@@ -405,15 +835,18 @@ def main():
                     if pref == 'all' or (pref == 'alerts_only' and is_critical):
                         print(f"[INFO] Preferencia '{pref}', enviando notificación para evento '{evento['event_type']}'.")
                         fcm_data = {'title': title, 'body': body, 'image_url': img_url, **evento}
-                        send_fcm(owner_id, fcm_data)
+                        send_fcm(owner_id, fcm_data, user_settings.get('fcm_tokens', []))
                     else:
                         print(f"[INFO] Preferencia '{pref}', notificación suprimida para evento '{evento['event_type']}'.")
 
+                FRAMES_TOTAL.labels('processed').inc()
             except Exception as e:
                 print(f"[CRITICAL] Error procesando el blob {nombre_archivo}: {e}")
-            finally:
-                # Borrar la imagen original de la carpeta 'uploads'
-                blob.delete()
+                FRAMES_TOTAL.labels('failed').inc()
+            # Borrar la imagen original de la carpeta 'uploads'. No va en un 'finally': si el worker
+            # se detiene a mitad de la imagen (SIGTERM -> SystemExit), la imagen se queda en
+            # uploads/ y la procesa el siguiente worker.
+            blob.delete()
         
         time.sleep(3)
 
@@ -422,4 +855,14 @@ def main():
 
 # =========== MAIN =========
 if __name__=='__main__':
+    model_store.limpiar_listo('fi2')
+    start_http_server(METRICS_PORT)
+    print(f'[OK] Métricas disponibles en http://localhost:{METRICS_PORT}/metrics')
+    inicio = time.perf_counter()
+    iniciar_firebase()
+    STARTUP_SECONDS.labels('firebase').set(time.perf_counter() - inicio)
+    iniciar_modelos()
+    iniciar_hilos()
+    WORKER_READY.set(1)
+    model_store.marcar_listo('fi2')
     main()
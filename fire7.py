@@ -5,11 +5,11 @@ import cv2
 import numpy as np
 import random
 from datetime import datetime, timezone 
-from mtcnn import MTCNN
-from keras_facenet import FaceNet
 from scipy.spatial.distance import cosine
 import requests 
-import torch # Asumiendo que esto es necesario para YOLOv5 y está instalado
+import model_store # Carga YOLOv5, MTCNN y FaceNet desde la carpeta local de modelos
+import webhooks    # Avisos a IFTTT y otros webhooks, enviados en segundo plano
+import storage_urls # URL de las imágenes procesadas (común a todos los workers)
 
 import firebase_admin
 from firebase_admin import credentials, storage, messaging
@@ -18,7 +18,6 @@ from firebase_admin import firestore
 # ========== CONFIGURACIÓN FIREBASE ==========
 SERVICE_ACCOUNT_FILE = 'security-cam-f322b-firebase-adminsdk-fbsvc-a3bf0dd37b.json'
 FIREBASE_INIT_BUCKET_NAME = 'security-cam-f322b.firebasestorage.app' # Usando el bucket que funciona para ti
-FIREBASE_STORAGE_BUCKET_DOMAIN = 'security-cam-f322b.firebasestorage.app' # Dominio para construir URLs (consistente)
 
 # Carpeta de imágenes a procesar y de embeddings EN FIREBASE
 FIREBASE_PATH_FOTOS = 'uploads/'             # Fotos subidas por la cámara (ej. uploads/camera001/imagen.jpg)
@@ -52,15 +51,17 @@ bucket = storage.bucket() # Este bucket es el que usa FIREBASE_INIT_BUCKET_NAME
 db = firestore.client() # Inicializa el cliente de Firestore
 
 # ========== INICIALIZAR MODELOS ==========
-embedder = FaceNet()
-detector = MTCNN()
+model_store.limpiar_listo('fire7')
 try:
-    model = torch.hub.load('ultralytics/yolov5', 'yolov5x')
+    embedder = model_store.cargar_facenet()
+    detector = model_store.cargar_mtcnn()
+    model = model_store.cargar_yolo('yolov5x')
     class_names = model.names
+    model_store.calentar(model, detector, embedder)
 except Exception as e:
-    print(f"Error al cargar modelo YOLOv5: {e}. Asegúrate de tener PyTorch y YOLOv5 configurados.")
-    model = None
-    class_names = []
+    print(f"Error al cargar los modelos de IA: {e}. Prepara los modelos con: python model_store.py --download")
+    # Sin modelos el script no puede hacer su trabajo ni marcarse como listo
+    exit()
 
 
 # ========== FUNCIONES AUXILIARES ==========
@@ -135,31 +136,6 @@ def descargar_fotos_firebase():
     print(f"[INFO] Descargadas {len(imagenes)} imágenes.")
     return imagenes
 
-# ========== ALERTA IFTTT ==========
-def enviar_alerta_ifttt(path_local_imagen, event_name, value1, value2_url, value3):
-    nombre_en_firebase = FIREBASE_PATH_ALARMAS + os.path.basename(path_local_imagen)
-    blob = bucket.blob(nombre_en_firebase)
-    blob.upload_from_filename(path_local_imagen)
-    blob.make_public() # Hacer la imagen pública para IFTTT y notificaciones
-    url_publica = blob.public_url
-    print(f"[ALERTA] Imagen subida a {url_publica}")
-
-    ifttt_webhook_url = f"https://maker.ifttt.com/trigger/{event_name}/with/key/lxBuXKITSTN5Gu-bhN_m28waEiJoprM-ClSGvq69n7k"
-    data = {
-        'value1': value1,
-        'value2': value2_url, # Usar la URL pública de la imagen
-        'value3': value3
-    }
-    try:
-        response = requests.post(ifttt_webhook_url, data=data)
-        if response.status_code == 200:
-            print(f"✅ Alerta '{event_name}' enviada correctamente a IFTTT.")
-        else:
-            print(f"❌ Error al enviar el webhook a IFTTT ({event_name}): {response.status_code}, {response.text}")
-    except Exception as e:
-        print(f"❌ Error al enviar a IFTTT ({event_name}): {e}")
-    return url_publica # Devuelve la URL pública para usarla en FCM/Historial
-
 # ========== NO USADO: ENVÍO DE NOTIFICACIONES FCM DIRECTO (AHORA VÍA GCF) ==========
 # def enviar_notificacion_fcm(user_email, title, body, image_url=None, data=None):
 #     """Esta función ya no se llama directamente, ahora se hace vía trigger_fcm_via_main3"""
@@ -340,9 +316,8 @@ def procesar_imagenes():
 
                 # Sube la imagen procesada a Firebase Storage para el historial y notificaciones
                 blob_processed = bucket.blob(FIREBASE_PATH_ALARMAS + output_filename)
-                blob_processed.upload_from_filename(output_local_path)
-                blob_processed.make_public() # Hacerla pública
-                image_public_url = blob_processed.public_url
+                blob_processed.upload_from_filename(output_local_path, content_type='image/jpeg')
+                image_public_url = storage_urls.url_imagen_procesada(blob_processed)
                 print(f"[INFO] Imagen procesada subida a: {image_public_url}")
 
                 # --- Notificación y Registro de Eventos (Persona Conocida) ---
@@ -382,10 +357,10 @@ def procesar_imagenes():
                                    (current_utc_time - item.get('ultima_alarma', datetime.min.replace(tzinfo=timezone.utc))).total_seconds() > cooldown_seconds:
                                     
                                     # ENVIAR ALERTA DE ROSTRO DESCONOCIDO REPETIDO A IFTTT
-                                    alerta_url = enviar_alerta_ifttt(output_local_path, "send_alarm", # Revisa el nombre del evento IFTTT
-                                                                     "Rostro desconocido detectado MÚLTIPLES veces",
-                                                                     image_public_url,
-                                                                     "Alerta por persona desconocida recurrente.")
+                                    webhooks.encolar_webhook("unknown_person_repeated_alarm",
+                                                    "Rostro desconocido detectado MÚLTIPLES veces",
+                                                    image_public_url,
+                                                    "Alerta por persona desconocida recurrente.")
                                     trigger_fcm_via_main3( # <-- ¡Aquí se llama la nueva función!
                                         owner_email,
                                         "¡ALERTA DE INTRUSO!",
@@ -413,10 +388,10 @@ def procesar_imagenes():
                     
                     # Alerta de rostro desconocido (primera detección de un nuevo desconocido)
                     if is_new_unknown_alarm: # Si no fue una recurrente, es una primera detección
-                         alerta_url = enviar_alerta_ifttt(output_local_path, "send_alarm",
-                                                          "Rostro desconocido detectado",
-                                                          image_public_url,
-                                                          "Alerta de primera detección de rostro desconocido.")
+                         webhooks.encolar_webhook("unknown_person",
+                                         "Rostro desconocido detectado",
+                                         image_public_url,
+                                         "Alerta de primera detección de rostro desconocido.")
                          trigger_fcm_via_main3( # <-- ¡Aquí se llama la nueva función!
                             owner_email,
                             "Persona Desconocida Detectada",
@@ -441,10 +416,10 @@ def procesar_imagenes():
                 if persona_sin_rostro_contador >= DETECCIONES_REQUERIDAS:
                     persona_sin_rostro_contador = 0
                     # La imagen procesada ya está en output_local_path y su URL es image_public_url
-                    alerta_url = enviar_alerta_ifttt(output_local_path, "persona_sin_rostro",
-                                                     "Persona detectada sin rostro 3 veces",
-                                                     image_public_url,
-                                                     "Alerta por detección de persona sin rostro")
+                    webhooks.encolar_webhook("person_no_face_alarm",
+                                    "Persona detectada sin rostro 3 veces",
+                                    image_public_url,
+                                    "Alerta por detección de persona sin rostro")
                     trigger_fcm_via_main3( # <-- ¡Aquí se llama la nueva función!
                         owner_email,
                         "Alerta: Persona sin Rostro",
@@ -473,4 +448,6 @@ def procesar_imagenes():
         time.sleep(10)
 
 if __name__ == "__main__":
+    webhooks.iniciar_webhooks()
+    model_store.marcar_listo('fire7')
     procesar_imagenes()
\ No newline at end of file
@@ -0,0 +1,266 @@
+# ==============================================================================
+# AI SECURITY CAM - PRUEBA DE CARGA DE LA API (main3.py) CON SERVICIOS LOCALES
+# ==============================================================================
+# Arranca main3.py con gunicorn contra servicios locales y lo somete a carga:
+#   - N cámaras simuladas enviando frames a /api/stream_upload_raw (o /api/stream_upload con --multipart)
+#   - M espectadores pidiendo /api/latest_frame con su token de sesión
+#   - K clientes de la app alternando dashboard, historial, última alerta y estado de cámara
+# Al final informa, por endpoint, peticiones/s, errores y latencias p50/p95/p99. Con --baseline
+# compara contra un resultado anterior (--json) y termina con código 1 si algún p95 empeora
+# más de --max-regression por ciento.
+#
+# Servicios locales necesarios (nunca se usa producción):
+#   redis-server                                                 (localhost:6379, como main3)
+#   mosquitto                                                    (127.0.0.1:1883, opcional)
+#   gcloud emulators firestore start --host-port=localhost:8080
+#   fake-gcs-server -scheme http -port 4443                      (emulador de Cloud Storage)
+#
+#   FIRESTORE_EMULATOR_HOST=localhost:8080 STORAGE_EMULATOR_HOST=http://localhost:4443 \
+#       python loadtest_main3.py --cameras 20 --viewers 50 --app-clients 10 --duration 60
+# ------------------------------------------------------------------------------
+
+import os
+import sys
+import json
+import time
+import uuid
+import signal
+import argparse
+import threading
+import subprocess
+from collections import defaultdict
+
+import cv2
+import numpy as np
+import requests
+
+from bench_utils import percentil
+
+# ========== CONFIGURACIÓN ==========
+PROJECT_ID = "demo-security-cam"                        # Proyecto ficticio, solo existe en los emuladores
+BUCKET_NAME = "security-cam-f322b.firebasestorage.app"  # El mismo que usa main3.py
+SERVER_PORT = 5055
+CAMERA_FPS = 10                                         # Igual que camera_stream2.py
+VIEWER_FPS = 10
+APP_CLIENT_INTERVAL_SECONDS = 1.0
+SEED_EVENTS = 500                                       # Eventos de historial creados antes de la carga
+JPEG_WIDTH, JPEG_HEIGHT = 640, 480
+
+APP_ENDPOINTS = [
+    ("dashboard_data", "GET", "/api/dashboard_data"),
+    ("events_history", "GET", "/api/events/history?limit=50"),
+    ("latest_alert", "GET", "/api/latest_alert"),
+]
+
+latencias = defaultdict(list)                           # {endpoint: [ms, ...]}
+errores = defaultdict(int)                              # {endpoint: peticiones con error o status >= 400}
+metricas_lock = threading.Lock()
+detener = threading.Event()
+
+
+def registrar(endpoint, inicio, ok):
+    ms = (time.perf_counter() - inicio) * 1000
+    with metricas_lock:
+        latencias[endpoint].append(ms)
+        if not ok:
+            errores[endpoint] += 1
+
+
+def llamar(session, endpoint, method, url, **kwargs):
+    inicio = time.perf_counter()
+    try:
+        resp = session.request(method, url, timeout=10, **kwargs)
+        registrar(endpoint, inicio, resp.status_code < 400)
+        return resp
+    except requests.RequestException:
+        registrar(endpoint, inicio, False)
+        return None
+
+
+# ========== PREPARACIÓN ==========
+def crear_bucket_emulado():
+    """Crea el bucket en el emulador de Storage (main3 lo abre con get_bucket al importar)."""
+    host = os.environ["STORAGE_EMULATOR_HOST"].rstrip('/')
+    resp = requests.post(f"{host}/storage/v1/b", params={"project": PROJECT_ID}, json={"name": BUCKET_NAME}, timeout=10)
+    if resp.status_code not in (200, 409):
+        raise RuntimeError(f"No se pudo crear el bucket en el emulador: {resp.status_code} {resp.text}")
+
+
+def arrancar_servidor(workers, threads):
+    env = dict(os.environ, GOOGLE_CLOUD_PROJECT=PROJECT_ID)
+    cmd = ["gunicorn", "-w", str(workers), "--threads", str(threads), "-b", f"127.0.0.1:{SERVER_PORT}", "main3:app"]
+    print(f"[INFO] Arrancando: {' '.join(cmd)}")
+    server = subprocess.Popen(cmd, env=env, cwd=os.path.dirname(os.path.abspath(__file__)))
+    base_url = f"http://127.0.0.1:{SERVER_PORT}"
+    for _ in range(120):
+        try:
+            requests.get(f"{base_url}/api/latest_frame", params={"camera_id": "warmup", "size": "thumb"}, timeout=1)
+            return server, base_url
+        except requests.RequestException:
+            time.sleep(0.5)
+    server.terminate()
+    raise RuntimeError("main3.py no respondió en 60 s.")
+
+
+def preparar_usuario(base_url, camera_ids):
+    """Registra un usuario de prueba, le asigna las cámaras y siembra historial. Devuelve su JWT."""
+    session = requests.Session()
+    email = f"loadtest-{uuid.uuid4().hex[:8]}@example.com"
+    password = "loadtest-password"
+    session.post(f"{base_url}/api/register", json={"name": "Load Test", "email": email, "password": password}, timeout=10)
+    token = session.post(f"{base_url}/api/login", json={"email": email, "password": password}, timeout=10).json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+    for camera_id in camera_ids:
+        session.post(f"{base_url}/api/add_device", json={"device_id": camera_id}, headers=headers, timeout=10)
+
+    eventos = [{
+        "person_name": "Desconocido",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S+00:00", time.gmtime(time.time() - i * 30)),
+        "event_type": "unknown_person" if i % 3 else "known_person",
+        "image_url": "",
+        "event_details": "evento de prueba de carga",
+        "device_id": camera_ids[i % len(camera_ids)],
+    } for i in range(SEED_EVENTS)]
+    for i in range(0, len(eventos), 200):
+        session.post(f"{base_url}/api/events/add_batch", json={"events": eventos[i:i + 200]}, timeout=30)
+    print(f"[INFO] Usuario {email} con {len(camera_ids)} cámara(s) y {SEED_EVENTS} eventos.")
+    return token
+
+
+# ========== CLIENTES SIMULADOS ==========
+def camara_simulada(base_url, camera_id, jpeg_bytes, multipart):
+    session = requests.Session()
+    intervalo = 1.0 / CAMERA_FPS
+    while not detener.is_set():
+        inicio = time.time()
+        if multipart:
+            llamar(session, "stream_upload", "POST", f"{base_url}/api/stream_upload",
+                   files={"frame": ("frame.jpg", jpeg_bytes, "image/jpeg")},
+                   data={"camera_id": camera_id, "mode": "STREAMING_MODE"})
+        else:
+            llamar(session, "stream_upload_raw", "POST", f"{base_url}/api/stream_upload_raw/{camera_id}",
+                   data=jpeg_bytes, headers={"Content-Type": "application/octet-stream", "X-Camera-Mode": "STREAMING_MODE"})
+        time.sleep(max(0, intervalo - (time.time() - inicio)))
+
+
+def espectador_simulado(base_url, token, camera_id):
+    session = requests.Session()
+    resp = llamar(session, "get_stream_session_token", "POST", f"{base_url}/api/get_stream_session_token",
+                  json={"camera_id": camera_id}, headers={"Authorization": f"Bearer {token}"})
+    session_token = resp.json().get("session_token") if resp is not None and resp.ok else None
+    intervalo = 1.0 / VIEWER_FPS
+    while not detener.is_set():
+        inicio = time.time()
+        llamar(session, "latest_frame", "GET", f"{base_url}/api/latest_frame",
+               params={"camera_id": camera_id, "session_token": session_token})
+        time.sleep(max(0, intervalo - (time.time() - inicio)))
+
+
+def cliente_app_simulado(base_url, token, camera_ids, indice):
+    session = requests.Session()
+    session.headers["Authorization"] = f"Bearer {token}"
+    paso = indice
+    while not detener.is_set():
+        inicio = time.time()
+        endpoint, method, path = APP_ENDPOINTS[paso % len(APP_ENDPOINTS)]
+        llamar(session, endpoint, method, f"{base_url}{path}")
+        llamar(session, "camera_status", "GET", f"{base_url}/api/camera_status/{camera_ids[paso % len(camera_ids)]}")
+        paso += 1
+        time.sleep(max(0, APP_CLIENT_INTERVAL_SECONDS - (time.time() - inicio)))
+
+
+# ========== INFORME ==========
+def resumir(duracion):
+    resultado = {}
+    for endpoint, valores in sorted(latencias.items()):
+        resultado[endpoint] = {
+            "requests": len(valores),
+            "rps": round(len(valores) / duracion, 1),
+            "errors": errores[endpoint],
+            "p50_ms": round(percentil(valores, 50), 1),
+            "p95_ms": round(percentil(valores, 95), 1),
+            "p99_ms": round(percentil(valores, 99), 1),
+        }
+    return resultado
+
+
+def imprimir(resultado):
+    print(f"\n{'endpoint':>26} | {'req/s':>7} | {'errores':>7} | {'p50':>8} | {'p95':>8} | {'p99':>8}")
+    print("-" * 80)
+    for endpoint, r in resultado.items():
+        print(f"{endpoint:>26} | {r['rps']:>7} | {r['errors']:>7} | {r['p50_ms']:>6}ms | {r['p95_ms']:>6}ms | {r['p99_ms']:>6}ms")
+
+
+def comparar_con_baseline(resultado, baseline_path, max_regression):
+    """Devuelve la lista de endpoints cuyo p95 empeoró más de max_regression por ciento."""
+    with open(baseline_path) as f:
+        baseline = json.load(f)["endpoints"]
+    regresiones = []
+    for endpoint, r in resultado.items():
+        anterior = baseline.get(endpoint)
+        if anterior and r["p95_ms"] > anterior["p95_ms"] * (1 + max_regression / 100):
+            regresiones.append(f"{endpoint}: p95 {anterior['p95_ms']}ms -> {r['p95_ms']}ms")
+    return regresiones
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prueba de carga de main3.py con servicios locales.")
+    parser.add_argument("--cameras", type=int, default=10)
+    parser.add_argument("--viewers", type=int, default=20)
+    parser.add_argument("--app-clients", type=int, default=5)
+    parser.add_argument("--duration", type=int, default=60, help="Segundos de carga.")
+    parser.add_argument("--workers", type=int, default=2, help="Procesos de gunicorn.")
+    parser.add_argument("--threads", type=int, default=16, help="Hilos por proceso de gunicorn.")
+    parser.add_argument("--multipart", action="store_true", help="Usar /api/stream_upload en lugar del endpoint crudo.")
+    parser.add_argument("--json", help="Archivo donde guardar el resultado.")
+    parser.add_argument("--baseline", help="Resultado anterior (--json) con el que comparar.")
+    parser.add_argument("--max-regression", type=float, default=20.0, help="Empeoramiento máximo tolerado del p95 (%%).")
+    args = parser.parse_args()
+
+    if not os.environ.get("FIRESTORE_EMULATOR_HOST") or not os.environ.get("STORAGE_EMULATOR_HOST"):
+        print("[ERROR] Define FIRESTORE_EMULATOR_HOST y STORAGE_EMULATOR_HOST: la prueba solo corre contra emuladores locales.")
+        sys.exit(1)
+
+    crear_bucket_emulado()
+    server, base_url = arrancar_servidor(args.workers, args.threads)
+    try:
+        camera_ids = [f"loadcam{i:03d}" for i in range(args.cameras)]
+        token = preparar_usuario(base_url, camera_ids)
+        ruido = np.random.randint(0, 255, (JPEG_HEIGHT, JPEG_WIDTH, 3), dtype=np.uint8)
+        jpeg_bytes = cv2.imencode('.jpg', ruido, [cv2.IMWRITE_JPEG_QUALITY, 80])[1].tobytes()
+        latencias.clear()
+        errores.clear()
+
+        hilos = [threading.Thread(target=camara_simulada, args=(base_url, c, jpeg_bytes, args.multipart)) for c in camera_ids]
+        hilos += [threading.Thread(target=espectador_simulado, args=(base_url, token, camera_ids[i % len(camera_ids)]))
+                  for i in range(args.viewers)]
+        hilos += [threading.Thread(target=cliente_app_simulado, args=(base_url, token, camera_ids, i))
+                  for i in range(args.app_clients)]
+        print(f"[INFO] {args.cameras} cámara(s), {args.viewers} espectador(es), {args.app_clients} cliente(s) de la app "
+              f"durante {args.duration} s...")
+        for hilo in hilos:
+            hilo.start()
+        time.sleep(args.duration)
+        detener.set()
+        for hilo in hilos:
+            hilo.join()
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait(timeout=30)
+
+    resultado = resumir(args.duration)
+    imprimir(resultado)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"config": vars(args), "endpoints": resultado}, f, indent=2)
+        print(f"[OK] Resultado guardado en {args.json}")
+    if args.baseline:
+        regresiones = comparar_con_baseline(resultado, args.baseline, args.max_regression)
+        if regresiones:
+            print("[ERROR] Regresiones de latencia:\n  " + "\n  ".join(regresiones))
+            sys.exit(1)
+        print(f"[OK] Sin regresiones de p95 mayores al {args.max_regression}% respecto a {args.baseline}.")
+
+
+if __name__ == '__main__':
+    main()
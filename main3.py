@@ -1,7 +1,7 @@
 import os
 import re
 import numpy as np
-from flask import Flask, request, render_template, redirect, url_for, session, flash, jsonify, Response
+from flask import Flask, request, render_template, redirect, url_for, session, flash, jsonify, Response, g, stream_with_context
 from google.cloud import storage, firestore
 import paho.mqtt.client as mqtt # <-- ¡Añade esto para MQTT!
 from datetime import datetime, timedelta, timezone 
@@ -16,6 +16,11 @@ import uuid
 import json # Para generar tokens de sesión de stream
 import io 
 import redis
+import cv2
+import socket
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from google.cloud.firestore_v1.bulk_writer import BulkWriterOptions, SendMode
 
 # Inicializaciones básicas
 app = Flask(__name__)
@@ -39,15 +44,25 @@ CLOUD_FUNCTION_FCM_URL = "https://sendfcmnotification-614861377558.us-central1.r
 latest_frames = {}
 frames_lock = threading.Lock()
 
-# Diccionario global para almacenar tokens de sesión de stream activos
-# Formato: { "session_token": {"user_id": <id>, "camera_id": <id>, "expires": <datetime>} }
-stream_sessions = {}
-sessions_lock = threading.Lock()
-
-# Diccionario global para almacenar el estado actual de cada cámara
-# Formato: { "camera_id": {"mode": "STREAMING_MODE", "timestamp": <datetime>} }
-camera_status = {}
-camera_status_lock = threading.Lock()
+# ========== ESTADO COMPARTIDO EN REDIS ==========
+# Las sesiones de stream, el estado de las cámaras y los espectadores viven en Redis para que
+# varios procesos de la API (workers de gunicorn) compartan la misma información.
+# Formato de las claves:
+#   stream_session:<token>    -> hash {"user_id", "camera_id", "expires"}  (expira con el token)
+#   camera_status:<camera_id> -> hash {"mode", "is_on" ("1"/"0"), "timestamp" (epoch), "ack" (último nonce de comando)}
+#   viewers:<camera_id>       -> sorted set {viewer_key: epoch_ultima_actividad}
+#   viewer_cameras            -> set con las cámaras que tienen espectadores
+#   mqtt_status_leader        -> ID del único proceso que procesa los mensajes de estado MQTT
+STREAM_SESSION_TTL_SECONDS = 300 # Token de sesión de stream válido por 5 minutos
+VIEWER_TIMEOUT_SECONDS = 5 # Un espectador deja de contar si no pide frames en este tiempo
+STATUS_LEADER_KEY = "mqtt_status_leader"
+STATUS_LEADER_TTL_SECONDS = 10 # Si el líder muere, otro proceso toma su lugar tras este tiempo
+
+# Identificador de este proceso (para el cliente MQTT y la elección de líder)
+PROCESS_ID = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+is_status_leader = False
+# Último conteo de espectadores publicado por este proceso (para publicar solo cuando cambia)
+published_viewer_counts = {}
 
 # Flag para indicar si hay un stream activo (si se están recibiendo frames de la cámara fuente)
 is_streaming_active = False
@@ -75,67 +90,173 @@ redis_client = redis.Redis(host='localhost', port=6379, db=0)
 # Define la zona horaria de Caracas (o la que te sea relevante)
 CARACAS_TIMEZONE = timezone(timedelta(hours=-4))
 
+# Tipos de evento que cuentan como alarma en las estadísticas del dashboard
+ALARM_EVENT_TYPES = ['alarm', 'unknown_person', 'unknown_person_repeated_alarm', 'person_no_face_alarm']
+# Tipos de evento que se muestran en el banner de "última alerta" de la app
+CRITICAL_ALERT_EVENT_TYPES = ALARM_EVENT_TYPES + ['unknown_group']
+# Tipos de evento que no son una entrada: no suman al 'total' diario (total_entries_today del dashboard)
+NON_ENTRY_EVENT_TYPES = ['known_person_left']
+
 # Inicializar cliente MQTT para Flask
-flask_mqtt_client = mqtt.Client(client_id=MQTT_CLIENT_ID_FLASK, clean_session=True)
+# Cada proceso necesita su propio client_id: el broker desconecta a un cliente si otro usa el mismo.
+flask_mqtt_client = mqtt.Client(client_id=f"{MQTT_CLIENT_ID_FLASK}_{PROCESS_ID}", clean_session=True)
 
 def on_mqtt_connect_flask(client, userdata, flags, rc):
     if rc == 0:
         print(f"MQTT (Flask): Conectado al broker {MQTT_BROKER_IP_INTERNAL}:{MQTT_BROKER_PORT_INTERNAL}")
-        # Suscribirse al tópico de estado de la cámara al conectar
-        client.subscribe("camera/status/#", MQTT_QOS_INTERNAL) # Suscribirse a todos los tópicos de estado
-        print(f"MQTT (Flask): Suscrito a tópicos de estado: camera/status/#")
+        # Solo el proceso líder se suscribe a los tópicos de estado (ver status_leader_loop).
+        # Si nos reconectamos siendo líder, renovamos la suscripción.
+        if is_status_leader:
+            client.subscribe("camera/status/#", MQTT_QOS_INTERNAL) # Suscribirse a todos los tópicos de estado
+            print(f"MQTT (Flask): Suscrito a tópicos de estado: camera/status/#")
     else:
         print(f"MQTT (Flask): Falló la conexión, código de retorno {rc}\n")
 
-def on_mqtt_message_flask(client, userdata, msg):
-    # Usamos 'with app.app_context()' para asegurar que tenemos acceso al logger de Flask
-    with app.app_context():
-        global camera_status
-        topic = msg.topic
-        payload = msg.payload.decode("utf-8")
-        
-        # 1. Nos aseguramos de que solo procesamos mensajes del tópico de estado
-        if not topic.startswith("camera/status/"):
-            return
+# ======================== INGESTA DE ESTADO DE CÁMARAS ========================
+# El callback de MQTT corre en el único hilo de red de paho: si parsea y escribe en Redis
+# cada mensaje, con miles de cámaras reportando cada 20 s se atrasa y retrasa también la
+# publicación de comandos. Por eso el callback solo encola el mensaje crudo y un hilo aparte:
+#   1. saca lotes de la cola,
+#   2. parsea cada payload (compacto JSON {"m": modo, "p": 0|1} o el formato antiguo "Modo: X; Power: ON"),
+#   3. combina los mensajes de una misma cámara (solo cuenta el último),
+#   4. escribe todas las cámaras del lote en un único pipeline de Redis.
+STATUS_QUEUE_MAX = 100000          # Mensajes en espera como máximo; si se llena se descartan (llegará otro en 20 s)
+STATUS_BATCH_MAX = 2000            # Mensajes que el hilo procesa por vuelta
+STATUS_STATS_INTERVAL_SECONDS = 60 # Cada cuánto se registra un resumen de la ingesta
+
+status_queue = queue.Queue(maxsize=STATUS_QUEUE_MAX)
+status_stats = {"received": 0, "written": 0, "dropped": 0, "unrecognized": 0}
+status_stats_lock = threading.Lock() # El callback de MQTT y el hilo de ingesta actualizan status_stats
 
-        camera_id = topic.split('/')[-1]
-
-        app.logger.info(f"MQTT-DEBUG: Mensaje de ESTADO recibido en '{topic}' con payload: '{payload}'")
+def on_mqtt_message_flask(client, userdata, msg):
+    """Solo encola el mensaje: todo el trabajo lo hace status_ingest_loop."""
+    if not msg.topic.startswith("camera/status/"):
+        return
+    try:
+        status_queue.put_nowait((msg.topic[len("camera/status/"):], msg.payload, time.time()))
+    except queue.Full:
+        with status_stats_lock:
+            status_stats["dropped"] += 1
 
-        with camera_status_lock:
-            current_cam_status = camera_status.get(camera_id, {})
+def parsear_estado_camara(payload, received_at):
+    """
+    Convierte un payload de estado en los campos a escribir en camera_status:<id>.
+    Devuelve (status_update, reconocido). Solo se escriben los campos presentes;
+    el resto del hash conserva el último estado conocido.
+    """
+    # El "Testamento" (LWT) marca la cámara como desconectada con un timestamp muy antiguo,
+    # así 'is_active' falla de inmediato. NO cambiamos 'is_on', mantenemos el último estado.
+    if payload == b"LWT_OFFLINE":
+        return {'timestamp': 0}, True
 
-            # --- LÓGICA DE ESTADO REESTRUCTURADA Y CORREGIDA ---
+    # Cualquier otro mensaje significa que la cámara está viva.
+    status_update = {'timestamp': received_at}
 
-            # 2. Manejamos el caso especial del "Testamento" (LWT) para desconexión
-            if payload == "LWT_OFFLINE":
-                app.logger.info(f"MQTT-LWT: LWT recibido de {camera_id}. Marcando como offline.")
-                # Forzamos un timestamp muy antiguo para que 'is_active' falle inmediatamente.
-                # NO cambiamos 'is_on', mantenemos el último estado conocido.
-                current_cam_status['timestamp'] = datetime.fromtimestamp(0)
-            
-            # 3. Para CUALQUIER OTRO mensaje, consideramos la cámara viva y actualizamos el timestamp.
-            else:
-                current_cam_status['timestamp'] = datetime.now()
-                
-                # Ahora, intentamos parsear el estado detallado del mensaje
-                mode_match = re.search(r'Modo:\s*([\w_]+)', payload)
-                power_match = re.search(r'Power:\s*(ON|OFF)', payload, re.IGNORECASE)
-                
-                if mode_match and power_match:
-                    # Si el formato es correcto, actualizamos modo y estado de encendido
-                    current_cam_status['mode'] = mode_match.group(1)
-                    current_cam_status['is_on'] = (power_match.group(1).upper() == "ON")
-                    app.logger.info(f"MQTT-UPDATE: Estado de {camera_id} actualizado a Modo: {current_cam_status['mode']}, Power: {current_cam_status['is_on']}")
-                else:
-                    # Si el formato no es el esperado, lo advertimos, pero la cámara ya se considera online
-                    # porque su timestamp fue actualizado.
-                    app.logger.warning(f"MQTT-WARN: Payload no reconocido para {camera_id}: '{payload}'. Solo se actualizó el timestamp de actividad.")
-
-            # Guardamos el estado actualizado
-            camera_status[camera_id] = current_cam_status
-            
-            app.logger.info(f"MQTT-FINAL_STATE: Estado en memoria para {camera_id} - is_on: {current_cam_status.get('is_on')}, timestamp: {current_cam_status.get('timestamp')}")
+    # Formato compacto: {"m": "CAPTURE_MODE", "p": 1, "n": nonce del último comando (opcional)}
+    if payload[:1] == b"{":
+        try:
+            data = json.loads(payload)
+            status_update['mode'] = str(data['m'])
+            status_update['is_on'] = "1" if data['p'] else "0"
+            if data.get('n'):
+                status_update['ack'] = str(data['n'])
+            return status_update, True
+        except (ValueError, KeyError, TypeError):
+            return status_update, False
+
+    # Formato antiguo en texto: "Modo: CAPTURE_MODE; Power: ON" (y "; Ack: <nonce>" si respondió a un comando masivo)
+    text = payload.decode("utf-8", errors="replace")
+    mode_match = re.search(r'Modo:\s*([\w_]+)', text)
+    power_match = re.search(r'Power:\s*(ON|OFF)', text, re.IGNORECASE)
+    ack_match = re.search(r'Ack:\s*(\w+)', text)
+    if mode_match and power_match:
+        status_update['mode'] = mode_match.group(1)
+        status_update['is_on'] = "1" if power_match.group(1).upper() == "ON" else "0"
+        if ack_match:
+            status_update['ack'] = ack_match.group(1)
+        return status_update, True
+    return status_update, False
+
+def escribir_estados_camaras(messages):
+    """
+    Parsea y combina un lote de mensajes [(camera_id, payload, received_at), ...]
+    y lo escribe en Redis en un solo viaje. Devuelve el número de cámaras escritas.
+    """
+    coalesced = {}
+    unrecognized = 0
+    for camera_id, payload, received_at in messages:
+        status_update, recognized = parsear_estado_camara(payload, received_at)
+        if not recognized:
+            unrecognized += 1
+            app.logger.debug(f"MQTT-WARN: Payload no reconocido para {camera_id}: {payload!r}. Solo se actualizó el timestamp de actividad.")
+        # Los mensajes llegan en orden: los campos del último pisan a los anteriores.
+        coalesced.setdefault(camera_id, {}).update(status_update)
+
+    if unrecognized:
+        with status_stats_lock:
+            status_stats["unrecognized"] += unrecognized
+
+    pipe = redis_client.pipeline(transaction=False)
+    for camera_id, status_update in coalesced.items():
+        pipe.hset(f"camera_status:{camera_id}", mapping=status_update)
+    pipe.execute()
+    return len(coalesced)
+
+def status_ingest_loop():
+    """Hilo que vacía la cola de estados y los escribe por lotes en Redis."""
+    last_stats_time = time.time()
+    while True:
+        try:
+            messages = [status_queue.get(timeout=1)]
+        except queue.Empty:
+            messages = []
+        while messages and len(messages) < STATUS_BATCH_MAX:
+            try:
+                messages.append(status_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        if messages:
+            try:
+                written = escribir_estados_camaras(messages)
+                with status_stats_lock:
+                    status_stats["written"] += written
+                    status_stats["received"] += len(messages)
+            except Exception as e:
+                # Se pierde este lote, pero cada cámara vuelve a reportar en 20 s.
+                app.logger.error(f"Error al escribir {len(messages)} estado(s) de cámara en Redis: {e}")
+
+        if time.time() - last_stats_time >= STATUS_STATS_INTERVAL_SECONDS:
+            with status_stats_lock:
+                stats = dict(status_stats)
+            app.logger.info(f"MQTT-INGESTA: {stats['received']} mensajes, {stats['written']} escrituras, "
+                            f"{stats['unrecognized']} no reconocidos, {stats['dropped']} descartados, "
+                            f"{status_queue.qsize()} en cola.")
+            last_stats_time = time.time()
+
+threading.Thread(target=status_ingest_loop, daemon=True).start()
+# =============================================================================
+
+def leer_estado_camaras(camera_ids):
+    """
+    Lee el estado de varias cámaras desde Redis en un solo viaje (un HMGET por cámara en pipeline).
+    Devuelve { camera_id: {"mode", "is_on", "timestamp" (datetime)} } o None si nunca reportó.
+    """
+    pipe = redis_client.pipeline(transaction=False)
+    for camera_id in camera_ids:
+        pipe.hmget(f"camera_status:{camera_id}", 'mode', 'is_on', 'timestamp')
+
+    statuses = {}
+    for camera_id, (mode, is_on, timestamp) in zip(camera_ids, pipe.execute()):
+        if timestamp is None:
+            statuses[camera_id] = None
+            continue
+        statuses[camera_id] = {
+            'mode': mode.decode('utf-8') if mode else 'UNKNOWN',
+            'is_on': is_on == b"1",
+            'timestamp': datetime.fromtimestamp(float(timestamp))
+        }
+    return statuses
 
 flask_mqtt_client.on_connect = on_mqtt_connect_flask
 flask_mqtt_client.on_message = on_mqtt_message_flask # Añade la función on_message
@@ -147,6 +268,97 @@ try:
 except Exception as e:
     print(f"MQTT (Flask): Error al conectar el cliente MQTT: {e}")
 
+# ==============================================================================
+# SECCIÓN DE ESPECTADORES DEL STREAM (DEMANDA DE VIDEO)
+# ------------------------------------------------------------------------------
+# La cámara solo transmite a tasa completa si alguien está viendo el video.
+# Un espectador se registra al pedir un token de sesión y se mantiene vivo mientras
+# siga pidiendo frames a /api/latest_frame. Cada cambio en el conteo se publica
+# (retenido) en 'camera/viewers/<camera_id>' para que la cámara ajuste su tasa.
+
+# Los espectadores se guardan en Redis, así cualquier proceso que atienda /api/latest_frame
+# los registra y el proceso líder es quien los expira.
+
+# Elimina los espectadores inactivos de una cámara y devuelve cuántos quedan. Si no queda
+# ninguno, la saca de 'viewer_cameras' en la misma operación atómica.
+expire_viewers_script = redis_client.register_script("""
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+local count = redis.call('ZCARD', KEYS[1])
+if count == 0 then
+    redis.call('SREM', KEYS[2], ARGV[2])
+end
+return count
+""")
+
+def publish_viewer_count(camera_id, count, force=False):
+    """Publica el número de espectadores de una cámara si cambió desde la última vez."""
+    if not force and published_viewer_counts.get(camera_id) == count:
+        return
+    published_viewer_counts[camera_id] = count
+    mqtt_topic = f"camera/viewers/{camera_id}"
+    flask_mqtt_client.publish(mqtt_topic, payload=str(count), qos=MQTT_QOS_INTERNAL, retain=True)
+    app.logger.info(f"MQTT-VIEWERS: {camera_id} tiene {count} espectador(es). Publicado en '{mqtt_topic}'.")
+
+def touch_viewer(camera_id, viewer_key):
+    """Registra actividad de un espectador y avisa a la cámara si es el primero."""
+    viewers_key = f"viewers:{camera_id}"
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.zadd(viewers_key, {viewer_key: time.time()})
+    pipe.zcard(viewers_key)
+    pipe.sadd("viewer_cameras", camera_id)
+    is_new, count, _ = pipe.execute()
+    if is_new:
+        # Cualquier proceso puede avisar de un espectador nuevo; no esperamos al líder
+        # para que la cámara suba su tasa cuanto antes.
+        publish_viewer_count(camera_id, count, force=True)
+
+def expirar_espectadores():
+    """Expira espectadores inactivos de todas las cámaras y publica los conteos que cambiaron."""
+    cutoff = time.time() - VIEWER_TIMEOUT_SECONDS
+    for camera_id in redis_client.smembers("viewer_cameras"):
+        camera_id = camera_id.decode('utf-8')
+        count = expire_viewers_script(keys=[f"viewers:{camera_id}", "viewer_cameras"], args=[cutoff, camera_id])
+        publish_viewer_count(camera_id, count)
+
+# ==============================================================================
+# SECCIÓN DE ELECCIÓN DE LÍDER ENTRE PROCESOS
+# ------------------------------------------------------------------------------
+# Con varios workers, solo uno debe procesar los mensajes de estado MQTT y expirar
+# espectadores. El líder mantiene la clave 'mqtt_status_leader' en Redis renovando su
+# TTL; si muere, la clave expira y otro proceso la toma.
+
+# Renueva el TTL del liderazgo solo si la clave sigue siendo de este proceso.
+renew_leader_script = redis_client.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+""")
+
+def status_leader_loop():
+    """Hilo que mantiene (o intenta obtener) el liderazgo y hace las tareas del líder."""
+    global is_status_leader
+    while True:
+        try:
+            if is_status_leader:
+                if not renew_leader_script(keys=[STATUS_LEADER_KEY], args=[PROCESS_ID, STATUS_LEADER_TTL_SECONDS]):
+                    is_status_leader = False
+                    flask_mqtt_client.unsubscribe("camera/status/#")
+                    print(f"LEADER: El proceso {PROCESS_ID} perdió el liderazgo.")
+            elif redis_client.set(STATUS_LEADER_KEY, PROCESS_ID, nx=True, ex=STATUS_LEADER_TTL_SECONDS):
+                is_status_leader = True
+                # Al suscribirnos, el broker nos entrega los estados retenidos de todas las cámaras.
+                flask_mqtt_client.subscribe("camera/status/#", MQTT_QOS_INTERNAL)
+                print(f"LEADER: El proceso {PROCESS_ID} es ahora el líder de estado MQTT.")
+
+            if is_status_leader:
+                expirar_espectadores()
+        except Exception as e:
+            print(f"LEADER: Error en el bucle de liderazgo: {e}")
+        time.sleep(1)
+
+threading.Thread(target=status_leader_loop, daemon=True).start()
+
 # ==============================================================================
 # SECCIÓN DE FUNCIONES AUXILIARES DE FIRESTORE
 # ------------------------------------------------------------------------------
@@ -179,6 +391,77 @@ def firestore_check_user(email, password):
     user = doc.to_dict()
     return check_password_hash(user["password_hash"], password)
 
+# ---------------------- CACHÉ DE PERFILES DE USUARIO --------------------------
+# Casi todos los endpoints leen el documento del usuario solo para ver 'devices', 'fcm_tokens'
+# o 'notification_preference'. Para no pagar una lectura de Firestore en cada llamada, el
+# documento se cachea en dos niveles: durante la petición (flask.g) y entre peticiones y
+# procesos en Redis ('user_cache:<email>') con un TTL corto. Los endpoints que escriben en el
+# documento del usuario deben llamar a invalidar_usuario_cache() después de escribir.
+USER_CACHE_TTL_SECONDS = 30
+USER_CACHE_FIELDS = ('name', 'email', 'devices', 'fcm_tokens', 'notification_preference') # Nunca el password_hash
+
+def obtener_usuario(email):
+    """Devuelve los campos cacheables del documento del usuario, o None si no existe."""
+    request_cache = g.setdefault('usuarios_cache', {})
+    if email in request_cache:
+        return request_cache[email]
+
+    cache_key = f"user_cache:{email}"
+    cached = redis_client.get(cache_key)
+    if cached is not None:
+        user_data = json.loads(cached)
+    else:
+        user_doc = db.collection('usuarios').document(email).get()
+        if not user_doc.exists:
+            user_data = None
+        else:
+            full_data = user_doc.to_dict()
+            user_data = {field: full_data[field] for field in USER_CACHE_FIELDS if field in full_data}
+            redis_client.set(cache_key, json.dumps(user_data), ex=USER_CACHE_TTL_SECONDS)
+
+    request_cache[email] = user_data
+    return user_data
+
+def invalidar_usuario_cache(email):
+    """Descarta el documento cacheado del usuario tras una escritura."""
+    redis_client.delete(f"user_cache:{email}")
+    g.get('usuarios_cache', {}).pop(email, None)
+
+def usuario_tiene_dispositivo(email, camera_id):
+    """Verifica si la cámara pertenece al usuario (usando la caché de perfiles)."""
+    user_data = obtener_usuario(email)
+    return user_data is not None and camera_id in user_data.get('devices', [])
+
+# ---------------------- DUEÑO DE CADA DISPOSITIVO --------------------------
+# Cada evento se guarda con el email de su dueño ('owner_email') para que las consultas
+# filtren por igualdad sobre el dueño en vez de usar 'device_id in [...]', que Firestore
+# limita a pocos valores y se vuelve lento con muchas cámaras. El mapeo dispositivo -> dueño
+# se cachea en Redis ('device_owner:<device_id>') y se invalida al añadir/quitar dispositivos.
+# Requiere el índice compuesto de firestore.indexes.json y haber corrido backfill_event_owners.py:
+# los eventos viejos sin 'owner_email' no aparecerían en historial, dashboard ni borrado.
+# Por eso está apagado por defecto; se activa con EVENTS_QUERY_BY_OWNER=1 después del backfill.
+EVENTS_QUERY_BY_OWNER = os.environ.get('EVENTS_QUERY_BY_OWNER') == '1'
+DEVICE_OWNER_CACHE_TTL_SECONDS = 300
+
+def obtener_dueno_dispositivo(device_id):
+    """Devuelve el email del usuario que tiene registrado el dispositivo, o None."""
+    cache_key = f"device_owner:{device_id}"
+    cached = redis_client.get(cache_key)
+    if cached is not None:
+        return cached.decode('utf-8') or None
+
+    owner_snap = next(db.collection('usuarios').where('devices', 'array_contains', device_id).limit(1).stream(), None)
+    owner_email = owner_snap.id if owner_snap else None
+    # También se cachea la ausencia de dueño (cadena vacía) para no repetir la consulta.
+    redis_client.set(cache_key, owner_email or "", ex=DEVICE_OWNER_CACHE_TTL_SECONDS)
+    return owner_email
+
+def consulta_eventos_usuario(email, user_devices):
+    """Consulta base sobre los eventos de un usuario (por dueño o, si no, por sus dispositivos)."""
+    if EVENTS_QUERY_BY_OWNER:
+        return db.collection('events').where('owner_email', '==', email)
+    return db.collection('events').where('device_id', 'in', user_devices)
+
 # ------------------------ FLASK RUTAS WEB (EXISTENTES) -------------------------------
 
 @app.route("/")
@@ -262,6 +545,7 @@ def api_logout():
         user_doc_ref.update({
             'fcm_tokens': firestore.ArrayRemove([fcm_token_to_remove])
         })
+        invalidar_usuario_cache(current_user_email)
         
         app.logger.info(f"Token FCM eliminado para el usuario {current_user_email} al cerrar sesión.")
         return jsonify({"msg": "Token FCM eliminado. Sesión cerrada en este dispositivo."}), 200
@@ -301,6 +585,7 @@ def update_fcm_token():
         if fcm_token not in current_tokens:
             current_tokens.append(fcm_token)
             user_doc_ref.update({'fcm_tokens': current_tokens})
+            invalidar_usuario_cache(current_user_email)
             return jsonify({"msg": "Token FCM registrado/actualizado correctamente."}), 200
         else:
             return jsonify({"msg": "Token FCM ya existente para este usuario."}), 200
@@ -309,64 +594,336 @@ def update_fcm_token():
         return jsonify({"msg": f"Error interno del servidor: {str(e)}"}), 500
 
 #========================================================
+# ---------------------- CONTADORES DIARIOS DE EVENTOS --------------------------
+# El dashboard muestra cuántos eventos y alarmas hubo hoy. En vez de recorrer todos los
+# eventos del día, add_event mantiene un documento contador por dispositivo y día local
+# (CARACAS_TIMEZONE) en la colección 'daily_event_counts', con id '<device_id>_<AAAA-MM-DD>'.
+def daily_counter_ref(device_id, local_date):
+    """Referencia al documento contador de un dispositivo para un día local."""
+    return db.collection('daily_event_counts').document(f"{device_id}_{local_date.isoformat()}")
+
+# ---------------------- REGISTRO DE EVENTOS --------------------------
+EVENT_REQUIRED_FIELDS = ["person_name", "timestamp", "event_type", "image_url", "device_id"]
+EVENTS_BATCH_MAX = 200 # Máximo por lote: 200 eventos + sus contadores caben en un batch de Firestore (500 escrituras)
+
+def preparar_evento(data):
+    """
+    Valida el JSON de un evento recibido de un worker y devuelve el documento a guardar.
+    Lanza ValueError con el mensaje para el cliente si el evento no es válido.
+    """
+    if not isinstance(data, dict) or not all(field in data for field in EVENT_REQUIRED_FIELDS):
+        raise ValueError("Faltan campos obligatorios para el evento.")
+
+    try:
+        event_timestamp = datetime.fromisoformat(data["timestamp"].replace('Z', '+00:00'))
+    except (ValueError, AttributeError):
+        raise ValueError("Formato de timestamp inválido. Usa ISO 8601.")
+    if event_timestamp.tzinfo is None:
+        event_timestamp = event_timestamp.replace(tzinfo=timezone.utc)
+
+    event_data = {
+        "person_name": data["person_name"],
+        "timestamp": event_timestamp,
+        "event_type": data["event_type"],
+        "image_url": data["image_url"],
+        "event_details": data.get("event_details", ""),
+        "device_id": data.get("device_id", "unknown"),
+        "recorded_at": firestore.SERVER_TIMESTAMP
+    }
+    # Tiempo de permanencia de los eventos 'known_person_left' de fi2
+    if isinstance(data.get("dwell_seconds"), int):
+        event_data["dwell_seconds"] = data["dwell_seconds"]
+
+    owner_email = obtener_dueno_dispositivo(event_data["device_id"])
+    if owner_email:
+        event_data["owner_email"] = owner_email
+    return event_data
+
+# ======================== PUNTERO A LA ÚLTIMA ALERTA ========================
+# La app consulta /api/latest_alert continuamente para mostrar el banner de alerta.
+# En lugar de lanzar una consulta a Firestore en cada petición, guardamos en Redis
+# la última alerta crítica de cada usuario al registrarla:
+#   latest_alert:<email> -> hash {"ts": epoch en ms, "data": JSON de la alerta ("" si no tiene ninguna)}
+# La clave se reconstruye con la consulta original si no existe (arranque en frío, expiración).
+LATEST_ALERT_TTL_SECONDS = 7 * 86400
+
+# Solo sustituye la alerta guardada si la nueva es más reciente: los eventos pueden
+# llegar desordenados (reintentos del worker, lotes) y no deben pisar una alerta posterior.
+set_latest_alert_script = redis_client.register_script("""
+local current_ts = tonumber(redis.call('HGET', KEYS[1], 'ts') or '-1')
+if current_ts >= tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'ts', ARGV[1], 'data', ARGV[2])
+redis.call('EXPIRE', KEYS[1], tonumber(ARGV[3]))
+return 1
+""")
+
+def evento_a_json(event_id, event_data):
+    """Convierte un evento en el diccionario JSON que devuelven /api/latest_alert y /api/events/stream."""
+    alert_data = {k: v for k, v in event_data.items() if k != 'recorded_at'}
+    alert_data['id'] = event_id
+    # Aseguramos que el timestamp sea un string en formato ISO para JSON
+    if isinstance(alert_data.get('timestamp'), datetime):
+        alert_data['timestamp'] = alert_data['timestamp'].isoformat()
+    return alert_data
+
+def guardar_ultima_alerta(user_email, alert_data, timestamp):
+    """Guarda la alerta (o None si el usuario no tiene ninguna) si es más reciente que la actual."""
+    ts_ms = int(timestamp.timestamp() * 1000) if timestamp else 0
+    payload = json.dumps(alert_data) if alert_data else ""
+    set_latest_alert_script(keys=[f"latest_alert:{user_email}"], args=[ts_ms, payload, LATEST_ALERT_TTL_SECONDS])
+
+def leer_ultima_alerta(user_email):
+    """
+    Devuelve (encontrada, alerta). 'encontrada' es False si Redis no tiene el puntero
+    y hay que recurrir a la consulta de Firestore.
+    """
+    cached = redis_client.hget(f"latest_alert:{user_email}", "data")
+    if cached is None:
+        return False, None
+    return True, (json.loads(cached) if cached else None)
+# =============================================================================
+
+def guardar_eventos(eventos):
+    """
+    Escribe los eventos y sus contadores diarios en un solo lote atómico de Firestore.
+    Los contadores se agregan primero por (dispositivo, día) para escribir cada uno una sola vez.
+    Después actualiza el puntero a la última alerta de cada dueño afectado.
+    """
+    batch = db.batch()
+    counters = {}
+    latest_alerts = {}
+    feed_entries = []
+    for event_data in eventos:
+        event_ref = db.collection('events').document()
+        batch.set(event_ref, event_data)
+        owner_email = event_data.get("owner_email")
+        if owner_email:
+            feed_entries.append((owner_email, event_ref.id, event_data))
+        if owner_email and event_data["event_type"] in CRITICAL_ALERT_EVENT_TYPES:
+            previous = latest_alerts.get(owner_email)
+            if previous is None or event_data["timestamp"] > previous[1]["timestamp"]:
+                latest_alerts[owner_email] = (event_ref.id, event_data)
+        local_date = event_data["timestamp"].astimezone(CARACAS_TIMEZONE).date()
+        total, alarms = counters.get((event_data["device_id"], local_date), (0, 0))
+        is_entry = event_data["event_type"] not in NON_ENTRY_EVENT_TYPES
+        is_alarm = event_data["event_type"] in ALARM_EVENT_TYPES
+        counters[(event_data["device_id"], local_date)] = (total + (1 if is_entry else 0), alarms + (1 if is_alarm else 0))
+
+    for (device_id, local_date), (total, alarms) in counters.items():
+        batch.set(daily_counter_ref(device_id, local_date), {
+            "device_id": device_id,
+            "date": local_date.isoformat(),
+            "total": firestore.Increment(total),
+            "alarms": firestore.Increment(alarms)
+        }, merge=True)
+    batch.commit()
+
+    # El evento ya está en Firestore; si Redis falla, el endpoint volverá a la consulta.
+    for owner_email, (event_id, event_data) in latest_alerts.items():
+        try:
+            guardar_ultima_alerta(owner_email, evento_a_json(event_id, event_data), event_data["timestamp"])
+        except redis.RedisError as e:
+            app.logger.warning(f"No se pudo actualizar la última alerta de {owner_email}: {e}")
+
+    publicar_eventos(feed_entries)
+
+# ======================== FEED DE EVENTOS EN TIEMPO REAL (SSE) ========================
+# Cada evento nuevo se añade al stream de Redis de su dueño:
+#   event_feed:<email> -> stream con los últimos EVENT_FEED_MAXLEN eventos ({"event": JSON})
+# /api/events/stream lo lee con XREAD bloqueante y lo reenvía como Server-Sent Events.
+# El ID de cada entrada del stream es el 'id:' del mensaje SSE, así el cliente que se
+# reconecta con Last-Event-ID recibe lo que se perdió mientras estaba desconectado.
+EVENT_FEED_MAXLEN = 200               # Eventos recientes que se pueden recuperar al reconectar
+EVENT_FEED_TTL_SECONDS = 86400        # El feed de un usuario sin actividad desaparece tras un día
+SSE_HEARTBEAT_SECONDS = 15            # Comentario vacío para que proxies y clientes no corten la conexión
+SSE_MAX_CONNECTION_SECONDS = 3600     # Cerramos cada conexión tras una hora; el cliente se reconecta solo
+SSE_RETRY_MS = 3000                   # Espera que indicamos al cliente antes de reconectar
+
+def publicar_eventos(feed_entries):
+    """Añade los eventos [(owner_email, event_id, event_data), ...] al feed de cada dueño."""
+    if not feed_entries:
+        return
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for owner_email, event_id, event_data in feed_entries:
+            feed_key = f"event_feed:{owner_email}"
+            pipe.xadd(feed_key, {"event": json.dumps(evento_a_json(event_id, event_data))},
+                      maxlen=EVENT_FEED_MAXLEN, approximate=True)
+            pipe.expire(feed_key, EVENT_FEED_TTL_SECONDS)
+        pipe.execute()
+    except redis.RedisError as e:
+        # El evento ya está guardado; los clientes lo verán en el historial.
+        app.logger.warning(f"No se pudieron publicar {len(feed_entries)} evento(s) en el feed: {e}")
+
+def sse_eventos_usuario(user_email, last_event_id):
+    """Generador de mensajes SSE con los eventos nuevos del usuario."""
+    feed_key = f"event_feed:{user_email}"
+    if not last_event_id:
+        # Sin Last-Event-ID empezamos después del último evento ya publicado
+        latest = redis_client.xrevrange(feed_key, count=1)
+        last_event_id = latest[0][0].decode('utf-8') if latest else "0-0"
+
+    yield f"retry: {SSE_RETRY_MS}\n\n"
+    deadline = time.time() + SSE_MAX_CONNECTION_SECONDS
+    while time.time() < deadline:
+        response = redis_client.xread({feed_key: last_event_id}, block=SSE_HEARTBEAT_SECONDS * 1000, count=50)
+        if not response:
+            yield ": keepalive\n\n"
+            continue
+        for entry_id, fields in response[0][1]:
+            last_event_id = entry_id.decode('utf-8')
+            yield f"id: {last_event_id}\nevent: new_event\ndata: {fields[b'event'].decode('utf-8')}\n\n"
+
+@app.route('/api/events/stream', methods=['GET'])
+@jwt_required()
+def stream_events():
+    """
+    Stream SSE con los eventos nuevos de los dispositivos del usuario.
+    Acepta la cabecera Last-Event-ID (o el parámetro 'last_event_id') para continuar donde se quedó.
+    """
+    current_user_email = get_jwt_identity()
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    if last_event_id and not re.fullmatch(r"\d+-\d+", last_event_id):
+        return jsonify({"msg": "Last-Event-ID no válido."}), 400
+
+    app.logger.info(f"Cliente SSE conectado para {current_user_email} (desde {last_event_id or 'ahora'}).")
+    return Response(stream_with_context(sse_eventos_usuario(current_user_email, last_event_id)),
+                    mimetype='text/event-stream',
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+# =======================================================================================
+
 @app.route("/api/events/add", methods=["POST"])
 def add_event():
     try:
         data = request.json
         
-        required_fields = ["person_name", "timestamp", "event_type", "image_url", "device_id"]
-        if not all(field in data for field in required_fields):
-            app.logger.warning(f"add_event: Missing required fields: {data}")
-            return jsonify({"msg": "Faltan campos obligatorios para el evento."}), 400
-
         try:
-            event_timestamp = datetime.fromisoformat(data["timestamp"].replace('Z', '+00:00'))
-        except ValueError:
-            app.logger.warning(f"add_event: Invalid timestamp format: {data.get('timestamp')}")
-            return jsonify({"msg": "Formato de timestamp inválido. Usa ISO 8601."}), 400
-
-        event_data = {
-            "person_name": data["person_name"],
-            "timestamp": event_timestamp,
-            "event_type": data["event_type"],
-            "image_url": data["image_url"],
-            "event_details": data.get("event_details", ""),
-            "device_id": data.get("device_id", "unknown"),
-            "recorded_at": firestore.SERVER_TIMESTAMP
-        }
-        
-        db.collection('events').add(event_data)
+            event_data = preparar_evento(data)
+        except ValueError as e:
+            app.logger.warning(f"add_event: {e} Datos: {data}")
+            return jsonify({"msg": str(e)}), 400
+
+        guardar_eventos([event_data])
         
         return jsonify({"msg": "Evento registrado correctamente."}), 201
     except Exception as e:
         app.logger.error(f"Error al añadir evento: {e}")
         return jsonify({"msg": f"Error interno del servidor: {str(e)}"}), 500
 
+@app.route("/api/events/add_batch", methods=["POST"])
+def add_events_batch():
+    """
+    Registra varios eventos en una sola petición y un solo lote de Firestore.
+    Cuerpo: {"events": [<evento>, ...]} con como mucho EVENTS_BATCH_MAX eventos.
+    Los eventos inválidos se informan en 'rejected' y no impiden guardar los demás.
+    """
+    try:
+        data = request.json or {}
+        events = data.get("events")
+        if not isinstance(events, list) or not events:
+            return jsonify({"msg": "Falta la lista 'events'."}), 400
+        if len(events) > EVENTS_BATCH_MAX:
+            return jsonify({"msg": f"Máximo {EVENTS_BATCH_MAX} eventos por lote."}), 413
+
+        accepted, rejected = [], []
+        for index, event in enumerate(events):
+            try:
+                accepted.append(preparar_evento(event))
+            except ValueError as e:
+                rejected.append({"index": index, "msg": str(e)})
+
+        if rejected:
+            app.logger.warning(f"add_events_batch: {len(rejected)} evento(s) rechazado(s): {rejected}")
+        if accepted:
+            guardar_eventos(accepted)
+
+        return jsonify({"msg": f"{len(accepted)} evento(s) registrado(s).", "accepted": len(accepted), "rejected": rejected}), 201
+    except Exception as e:
+        app.logger.error(f"Error al añadir lote de eventos: {e}")
+        return jsonify({"msg": f"Error interno del servidor: {str(e)}"}), 500
+
+# Campos que la app puede pedir en el historial con el parámetro 'fields'
+EVENT_HISTORY_FIELDS = ['person_name', 'timestamp', 'event_type', 'image_url', 'event_details', 'device_id', 'recorded_at', 'dwell_seconds']
+EVENT_HISTORY_MAX_PAGE_SIZE = 100
+
+def codificar_cursor_eventos(timestamp_iso, doc_id):
+    """Cursor opaco para reanudar el historial después de un evento (timestamp + id de documento)."""
+    raw = json.dumps({'ts': timestamp_iso, 'id': doc_id}).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+def decodificar_cursor_eventos(cursor):
+    """Inverso de codificar_cursor_eventos. Lanza ValueError si el cursor no es válido."""
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return datetime.fromisoformat(data['ts']), data['id']
+    except Exception:
+        raise ValueError("Cursor inválido")
+
 @app.route("/api/events/history", methods=["GET"])
 @jwt_required()
 def get_event_history():
+    """
+    Historial de eventos de los dispositivos del usuario, del más reciente al más antiguo.
+    Parámetros opcionales:
+      - limit:  tamaño de página (por defecto y máximo 100).
+      - after:  cursor 'next_cursor' de la respuesta anterior para pedir la siguiente página.
+      - since:  timestamp ISO 8601; solo devuelve eventos más nuevos (refresco incremental).
+      - fields: lista separada por comas de campos a devolver (ej. sin 'event_details').
+    La respuesta incluye 'next_cursor' (null si no hay más páginas).
+    """
     try:
         current_user_email = get_jwt_identity()
 
-        user_doc_ref = db.collection('usuarios').document(current_user_email)
-        user_doc = user_doc_ref.get()
+        user_data = obtener_usuario(current_user_email)
 
-        if not user_doc.exists:
+        if user_data is None:
             app.logger.warning(f"get_event_history: User {current_user_email} not found.")
             return jsonify({"msg": "Usuario no encontrado en la base de datos."}), 404
         
-        user_data = user_doc.to_dict()
         user_devices = user_data.get('devices', [])
 
         if not user_devices:
-            return jsonify({"events": []}), 200
+            return jsonify({"events": [], "next_cursor": None}), 200
 
-        events_ref = db.collection('events') \
-                      .where('device_id', 'in', user_devices) \
+        # --- Validación de parámetros de paginación y proyección ---
+        try:
+            page_size = int(request.args.get('limit', EVENT_HISTORY_MAX_PAGE_SIZE))
+            if not 1 <= page_size <= EVENT_HISTORY_MAX_PAGE_SIZE:
+                raise ValueError
+        except ValueError:
+            return jsonify({"msg": f"'limit' debe ser un entero entre 1 y {EVENT_HISTORY_MAX_PAGE_SIZE}."}), 400
+
+        try:
+            after = decodificar_cursor_eventos(request.args['after']) if request.args.get('after') else None
+            since = datetime.fromisoformat(request.args['since'].replace('Z', '+00:00')) if request.args.get('since') else None
+        except ValueError:
+            return jsonify({"msg": "Parámetros 'after' o 'since' inválidos."}), 400
+
+        fields = None
+        if request.args.get('fields'):
+            fields = [f.strip() for f in request.args['fields'].split(',') if f.strip()]
+            if any(f not in EVENT_HISTORY_FIELDS for f in fields):
+                return jsonify({"msg": f"Campos permitidos: {', '.join(EVENT_HISTORY_FIELDS)}."}), 400
+            # El timestamp siempre se lee porque hace falta para construir el cursor
+            if 'timestamp' not in fields:
+                fields.append('timestamp')
+
+        # El id del documento desempata eventos con el mismo timestamp, así el cursor es exacto.
+        events_ref = consulta_eventos_usuario(current_user_email, user_devices) \
                       .order_by('timestamp', direction=firestore.Query.DESCENDING) \
-                      .limit(100)
+                      .order_by('__name__', direction=firestore.Query.DESCENDING)
+        if since:
+            events_ref = events_ref.where('timestamp', '>', since)
+        if fields:
+            events_ref = events_ref.select(fields)
+        if after:
+            events_ref = events_ref.start_after({'timestamp': after[0], '__name__': after[1]})
+        events_ref = events_ref.limit(page_size)
 
         events = []
+        last_doc_id = None
         for doc in events_ref.stream():
             event_data = doc.to_dict()
             event_data['id'] = doc.id
@@ -378,8 +935,14 @@ def get_event_history():
                 event_data['timestamp'] = event_data['timestamp'].to_datetime().isoformat()
             
             events.append(event_data)
+            last_doc_id = doc.id
+
+        # Solo hay más páginas si esta vino llena
+        next_cursor = None
+        if len(events) == page_size and last_doc_id:
+            next_cursor = codificar_cursor_eventos(events[-1]['timestamp'], last_doc_id)
         
-        return jsonify({"events": events}), 200
+        return jsonify({"events": events, "next_cursor": next_cursor}), 200
     except Exception as e:
         app.logger.error(f"Error al obtener historial de eventos: {e}")
         return jsonify({"msg": f"Error interno del servidor: {str(e)}"}), 500
@@ -390,14 +953,12 @@ def get_event_history():
 def get_dashboard_data():
     current_user_email = get_jwt_identity()
     
-    user_doc_ref = db.collection('usuarios').document(current_user_email)
-    user_doc = user_doc_ref.get()
+    user_data = obtener_usuario(current_user_email)
 
-    if not user_doc.exists:
+    if user_data is None:
         app.logger.warning(f"get_dashboard_data: User {current_user_email} not found.")
         return jsonify({"msg": "Usuario no encontrado en la base de datos."}), 404
     
-    user_data = user_doc.to_dict()
     user_devices = user_data.get('devices', [])
 
     if not user_devices:
@@ -409,8 +970,7 @@ def get_dashboard_data():
 
     # --- Lógica para obtener los últimos eventos ---
     # Filtrar por los dispositivos del usuario y ordenar por timestamp descendente
-    latest_events_query = db.collection('events') \
-                          .where('device_id', 'in', user_devices) \
+    latest_events_query = consulta_eventos_usuario(current_user_email, user_devices) \
                           .order_by('timestamp', direction=firestore.Query.DESCENDING) \
                           .limit(5) # Últimos 5 eventos para el resumen del dashboard
     
@@ -428,28 +988,21 @@ def get_dashboard_data():
         })
 
     # --- Lógica para calcular estadísticas diarias  ---
-    # Obtener la fecha de hoy en la zona horaria de Caracas
-    now_caracas = datetime.now(CARACAS_TIMEZONE)
-    today_start = now_caracas.replace(hour=0, minute=0, second=0, microsecond=0)
-    today_end = now_caracas.replace(hour=23, minute=59, second=59, microsecond=999999)
-
-    # Consulta para todos los eventos de hoy
-    today_events_query = db.collection('events') \
-                          .where('device_id', 'in', user_devices) \
-                          .where('timestamp', '>=', today_start) \
-                          .where('timestamp', '<=', today_end)
+    # Obtener la fecha de hoy en la zona horaria de Caracas y leer los contadores
+    # de todos los dispositivos en una sola llamada (un documento por dispositivo).
+    today_caracas = datetime.now(CARACAS_TIMEZONE).date()
+    counter_refs = [daily_counter_ref(device_id, today_caracas) for device_id in user_devices]
     
     total_entries_today = 0
     alarms_today = 0
 
-    for event in today_events_query.stream():
-        event_data = event.to_dict()
-        total_entries_today += 1
-        if event_data.get('event_type') in ['alarm', 'unknown_person', 'unknown_person_repeated_alarm', 'person_no_face_alarm']:
-            alarms_today += 1
+    for counter_doc in db.get_all(counter_refs):
+        if counter_doc.exists:
+            counter_data = counter_doc.to_dict()
+            total_entries_today += counter_data.get('total', 0)
+            alarms_today += counter_data.get('alarms', 0)
     
     app.logger.info(f"DEBUG_DASHBOARD: latest_events_query found {len(events_list)} events.")
-    app.logger.info(f"DEBUG_DASHBOARD: latest_events_query data: {events_list}") # DEBUG para ver la data exacta
     app.logger.info(f"DEBUG_DASHBOARD: total_entries_today: {total_entries_today}, alarms_today: {alarms_today}") # DEBUG para ver los contadores
     
     return jsonify({
@@ -463,39 +1016,38 @@ def get_dashboard_data():
 @jwt_required()
 def get_user_devices():
     current_user_email = get_jwt_identity()
-    user_doc_ref = db.collection('usuarios').document(current_user_email)
-    user_doc = user_doc_ref.get()
+    user_data = obtener_usuario(current_user_email)
 
-    if not user_doc.exists:
+    if user_data is None:
         return jsonify({"msg": "Usuario no encontrado."}), 404
 
-    user_data = user_doc.to_dict()
     devices_from_firestore = user_data.get('devices', []) 
 
     devices_with_status = []
-    with camera_status_lock:
-        for device_id in devices_from_firestore:
-            status_info = camera_status.get(device_id)
-            
-            # --- INICIO DE LA CORRECCIÓN ---
-            
-            # 1. El estado 'is_on' depende únicamente del último mensaje recibido.
-            is_on = status_info.get('is_on', False) if status_info else False
-            
-            # 2. El estado 'is_active' (Online/Offline) depende únicamente de si el último mensaje es reciente.
-            #    Son dos conceptos independientes.
-            is_active = (
-                status_info is not None and
-                (datetime.now() - status_info['timestamp']).total_seconds() < 20
-            )
-            # --- FIN DE LA CORRECCIÓN ---
-            
-            devices_with_status.append({
-                'id': device_id,
-                'mode': status_info.get('mode', 'UNKNOWN') if status_info else 'UNKNOWN',
-                'is_active': is_active,
-                'is_on': is_on
-            })
+    # Un solo viaje a Redis para el estado de todos los dispositivos
+    statuses = leer_estado_camaras(devices_from_firestore)
+    for device_id in devices_from_firestore:
+        status_info = statuses.get(device_id)
+        
+        # --- INICIO DE LA CORRECCIÓN ---
+        
+        # 1. El estado 'is_on' depende únicamente del último mensaje recibido.
+        is_on = status_info.get('is_on', False) if status_info else False
+        
+        # 2. El estado 'is_active' (Online/Offline) depende únicamente de si el último mensaje es reciente.
+        #    Son dos conceptos independientes.
+        is_active = (
+            status_info is not None and
+            (datetime.now() - status_info['timestamp']).total_seconds() < 20
+        )
+        # --- FIN DE LA CORRECCIÓN ---
+        
+        devices_with_status.append({
+            'id': device_id,
+            'mode': status_info.get('mode', 'UNKNOWN') if status_info else 'UNKNOWN',
+            'is_active': is_active,
+            'is_on': is_on
+        })
 
     return jsonify({"devices": devices_with_status}), 200
 
@@ -526,6 +1078,8 @@ def add_device_to_user():
         
         current_devices.append(device_id_to_add)
         user_doc_ref.update({'devices': current_devices})
+        invalidar_usuario_cache(current_user_email)
+        redis_client.delete(f"device_owner:{device_id_to_add}")
 
         return jsonify({"msg": f"Dispositivo {device_id_to_add} añadido correctamente."}), 200
 
@@ -560,6 +1114,8 @@ def remove_device_from_user():
         
         current_devices.remove(device_id_to_remove) # Elimina el dispositivo de la lista
         user_doc_ref.update({'devices': current_devices})
+        invalidar_usuario_cache(current_user_email)
+        redis_client.delete(f"device_owner:{device_id_to_remove}", f"latest_alert:{current_user_email}")
 
         return jsonify({"msg": f"Dispositivo {device_id_to_remove} eliminado correctamente."}), 200
 
@@ -568,6 +1124,42 @@ def remove_device_from_user():
         return jsonify({"msg": f"Error interno del servidor: {str(e)}"}), 500
 
 # ------------------------ API PARA RECIBIR STREAM DE PC -------------------------------
+MAX_RAW_FRAME_BYTES = 5 * 1024 * 1024 # Tamaño máximo aceptado para un frame JPEG crudo
+LATEST_FRAME_TTL_SECONDS = 15   # Vida del último frame en 'frame:<camera_id>'
+FRAME_BUFFER_SECONDS = 30       # Segundos de historia que se guardan en 'frames:<camera_id>'
+FRAME_BUFFER_MAX_FRAMES = 300   # Tope del buffer (30 s a 10 FPS); Redis lo recorta de forma aproximada
+# Versiones reducidas del último frame, generadas bajo demanda: { "size": ancho_maximo_en_px }
+FRAME_RENDITION_WIDTHS = {'low': 640, 'thumb': 160}
+FRAME_RENDITION_JPEG_QUALITY = 70
+
+def guardar_frame_recibido(camera_id, camera_mode, frame_data):
+    """Guarda un frame recibido de una cámara: siempre en Redis y, en modo captura, en Storage."""
+    # --- Lógica de Redis (para el stream en vivo) ---
+    # Esto se hace siempre, para que el stream en vivo funcione. En un solo viaje a Redis
+    # guardamos el último frame y lo añadimos al buffer circular (un Redis Stream cuyo ID
+    # es el timestamp en milisegundos) para poder "rebobinar" unos segundos tras una alarma.
+    redis_key = f"frame:{camera_id}"
+    buffer_key = f"frames:{camera_id}"
+    # 'frame_seq:<camera_id>' identifica cada frame nuevo para que las versiones reducidas
+    # cacheadas de un frame anterior dejen de usarse. MULTI/EXEC mantiene frame y secuencia
+    # consistentes para quien los lea juntos, sin añadir viajes a Redis.
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.set(redis_key, frame_data, ex=LATEST_FRAME_TTL_SECONDS)
+    pipe.incr(f"frame_seq:{camera_id}")
+    pipe.expire(f"frame_seq:{camera_id}", LATEST_FRAME_TTL_SECONDS)
+    pipe.xadd(buffer_key, {'frame': frame_data}, maxlen=FRAME_BUFFER_MAX_FRAMES, approximate=True)
+    pipe.expire(buffer_key, FRAME_BUFFER_SECONDS)
+    pipe.execute()
+    
+    # --- Lógica de Firebase Storage (SOLO para la IA) ---
+    # Solo guardamos la imagen para la IA si la cámara está en Modo Captura
+    if camera_mode == 'CAPTURE_MODE':
+        now_str = datetime.now(CARACAS_TIMEZONE).strftime('%Y%m%d_%H%M%S')
+        filename = f"{camera_id}_{now_str}.jpg"
+        blob_path = f"uploads/{camera_id}/{filename}"
+        bucket.blob(blob_path).upload_from_string(frame_data, content_type='image/jpeg')
+        app.logger.info(f"Frame de {camera_id} en MODO CAPTURA guardado en Storage para análisis.")
+
 @app.route('/api/stream_upload', methods=['POST'])
 def stream_upload():
     try:
@@ -586,20 +1178,7 @@ def stream_upload():
         if not frame_data:
             return jsonify({"error": "El frame de video está vacío."}), 400
 
-        # --- Lógica de Redis (para el stream en vivo) ---
-        # Esto se hace siempre, para que el stream en vivo funcione
-        redis_key = f"frame:{camera_id}"
-        redis_client.set(redis_key, frame_data)
-        redis_client.expire(redis_key, 15)
-        
-        # --- Lógica de Firebase Storage (SOLO para la IA) ---
-        # Solo guardamos la imagen para la IA si la cámara está en Modo Captura
-        if camera_mode == 'CAPTURE_MODE':
-            now_str = datetime.now(CARACAS_TIMEZONE).strftime('%Y%m%d_%H%M%S')
-            filename = f"{camera_id}_{now_str}.jpg"
-            blob_path = f"uploads/{camera_id}/{filename}"
-            bucket.blob(blob_path).upload_from_string(frame_data, content_type='image/jpeg')
-            app.logger.info(f"Frame de {camera_id} en MODO CAPTURA guardado en Storage para análisis.")
+        guardar_frame_recibido(camera_id, camera_mode, frame_data)
         
         return jsonify({"message": "Frame recibido."}), 200
 
@@ -607,6 +1186,33 @@ def stream_upload():
         app.logger.error(f"Error en stream_upload: {e}")
         return jsonify({"error": "Error interno del servidor."}), 500
 
+@app.route('/api/stream_upload_raw/<string:camera_id>', methods=['POST'])
+def stream_upload_raw(camera_id):
+    """
+    Versión ligera de /api/stream_upload: el cuerpo es el JPEG crudo (application/octet-stream)
+    y el modo viaja en la cabecera 'X-Camera-Mode'. No hay parseo multipart ni FileStorage:
+    el cuerpo se lee una sola vez directamente del socket y se pasa tal cual a Redis.
+    """
+    try:
+        content_length = request.content_length
+        if not content_length:
+            return jsonify({"error": "El frame de video está vacío."}), 400
+        if content_length > MAX_RAW_FRAME_BYTES:
+            return jsonify({"error": "El frame excede el tamaño máximo permitido."}), 413
+
+        camera_mode = request.headers.get('X-Camera-Mode', 'STREAMING_MODE')
+        frame_data = request.stream.read(content_length)
+        if not frame_data:
+            return jsonify({"error": "El frame de video está vacío."}), 400
+
+        guardar_frame_recibido(camera_id, camera_mode, frame_data)
+
+        return jsonify({"message": "Frame recibido."}), 200
+
+    except Exception as e:
+        app.logger.error(f"Error en stream_upload_raw: {e}")
+        return jsonify({"error": "Error interno del servidor."}), 500
+
 # ------------------------ FIN API PARA RECIBIR STREAM DE PC ---------------------------
 
 # ------------------------ API PARA LLAMAR GCF Y ENVIAR FCM (SIMULADA AHORA) --------------------
@@ -646,14 +1252,22 @@ def get_stream_session_token():
     # Por ahora, asumimos que si el usuario está autenticado, puede solicitar un token para cualquier cámara.
 
     session_token = str(uuid.uuid4()) # Genera un UUID único como token
-    expires_at = datetime.now() + timedelta(minutes=5) # Token válido por 5 minutos
+    expires_at = datetime.now() + timedelta(seconds=STREAM_SESSION_TTL_SECONDS) # Token válido por 5 minutos
+
+    # La sesión se guarda en Redis y expira sola, así cualquier proceso puede validarla.
+    session_key = f"stream_session:{session_token}"
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.hset(session_key, mapping={
+        "user_id": user_id,
+        "camera_id": camera_id,
+        "expires": expires_at.isoformat()
+    })
+    pipe.expire(session_key, STREAM_SESSION_TTL_SECONDS)
+    pipe.execute()
 
-    with sessions_lock:
-        stream_sessions[session_token] = {
-            "user_id": user_id,
-            "camera_id": camera_id,
-            "expires": expires_at
-        }
+    # El espectador cuenta desde que pide el token, para que la cámara suba su tasa
+    # antes de que llegue la primera petición de frame.
+    touch_viewer(camera_id, session_token)
     
     return jsonify({"session_token": session_token, "expires_at": expires_at.isoformat()}), 200
 
@@ -673,16 +1287,67 @@ def live_stream_web_page():
 # ------------------------ FIN RUTA WEB PARA EL STREAM ---------------------------
 
 # ------------------------ API PARA SERVIR EL ÚLTIMO FRAME (para polling) ------------------------
+def obtener_frame_reducido(camera_id, size):
+    """
+    Devuelve el último frame de la cámara reducido al tamaño pedido ('low' o 'thumb').
+    Se calcula como mucho una vez por frame nuevo y se guarda en Redis junto a 'frame:<camera_id>'.
+    """
+    frame_seq = redis_client.get(f"frame_seq:{camera_id}")
+    if frame_seq is None:
+        return None
+
+    rendition_key = f"frame:{camera_id}:{size}:{frame_seq.decode('utf-8')}"
+    rendition = redis_client.get(rendition_key)
+    if rendition:
+        return rendition
+
+    # No existe todavía: leemos secuencia y frame juntos (pueden haber cambiado) y lo generamos.
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.get(f"frame_seq:{camera_id}")
+    pipe.get(f"frame:{camera_id}")
+    frame_seq, frame_data = pipe.execute()
+    if not frame_seq or not frame_data:
+        return None
+
+    img = cv2.imdecode(np.frombuffer(frame_data, np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        return None
+
+    max_width = FRAME_RENDITION_WIDTHS[size]
+    height, width = img.shape[:2]
+    if width > max_width:
+        img = cv2.resize(img, (max_width, int(height * max_width / width)), interpolation=cv2.INTER_AREA)
+
+    ok, buffer = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, FRAME_RENDITION_JPEG_QUALITY])
+    if not ok:
+        return None
+
+    rendition = buffer.tobytes()
+    rendition_key = f"frame:{camera_id}:{size}:{frame_seq.decode('utf-8')}"
+    redis_client.set(rendition_key, rendition, ex=LATEST_FRAME_TTL_SECONDS)
+    return rendition
+
 @app.route('/api/latest_frame', methods=['GET'])
 def latest_frame():
     camera_id = request.args.get('camera_id')
     if not camera_id:
         return Response(b'{"error": "Missing camera_id parameter."}', mimetype='application/json', status=400)
 
+    # Tamaño pedido: 'full' (original, por defecto), 'low' o 'thumb'
+    size = request.args.get('size', 'full')
+    if size != 'full' and size not in FRAME_RENDITION_WIDTHS:
+        return Response(b'{"error": "Invalid size parameter. Use full, low or thumb."}', mimetype='application/json', status=400)
+
     # --- LÓGICA CON REDIS ---
     # Buscamos el frame en nuestro "pizarrón" centralizado de Redis
-    redis_key = f"frame:{camera_id}"
-    frame_data = redis_client.get(redis_key)
+    if size == 'full':
+        # Cada petición del video completo mantiene vivo al espectador (por token de sesión o, si no hay, por IP).
+        # Las miniaturas de listas y dashboards no cuentan, para no subir la tasa de la cámara.
+        touch_viewer(camera_id, request.args.get('session_token') or request.remote_addr)
+        redis_key = f"frame:{camera_id}"
+        frame_data = redis_client.get(redis_key)
+    else:
+        frame_data = obtener_frame_reducido(camera_id, size)
     
     response = None
     if frame_data:
@@ -698,6 +1363,74 @@ def latest_frame():
     return response
 # ------------------------ FIN API PARA SERVIR EL ÚLTIMO FRAME --------------------
 
+# ------------------------ API PARA REBOBINAR EL BUFFER DE FRAMES ------------------------
+@app.route('/api/frame_buffer/<string:camera_id>', methods=['GET'])
+@jwt_required()
+def get_frame_buffer(camera_id):
+    """
+    Lista los frames guardados en el buffer circular de una cámara dentro de un rango de tiempo.
+    Parámetros: 'start' y 'end' en milisegundos epoch, o 'seconds' (últimos N segundos, por defecto 10).
+    Cada frame se descarga luego con /api/frame_buffer/<camera_id>/<frame_id>.
+    """
+    try:
+        current_user_email = get_jwt_identity()
+
+        if not usuario_tiene_dispositivo(current_user_email, camera_id):
+            return jsonify({"msg": "Usuario no autorizado para esta cámara o cámara no encontrada."}), 403
+
+        try:
+            if request.args.get('start'):
+                start_ms = int(request.args['start'])
+                end_ms = int(request.args.get('end', int(time.time() * 1000)))
+            else:
+                seconds = min(int(request.args.get('seconds', 10)), FRAME_BUFFER_SECONDS)
+                end_ms = int(time.time() * 1000)
+                start_ms = end_ms - seconds * 1000
+        except ValueError:
+            return jsonify({"msg": "Parámetros de tiempo inválidos. Usa milisegundos epoch."}), 400
+
+        entries = redis_client.xrange(f"frames:{camera_id}", min=start_ms, max=end_ms)
+
+        frames = []
+        for entry_id, _ in entries:
+            frame_id = entry_id.decode('utf-8')
+            timestamp_ms = int(frame_id.split('-')[0])
+            frames.append({
+                'frame_id': frame_id,
+                'timestamp': datetime.fromtimestamp(timestamp_ms / 1000, timezone.utc).isoformat(),
+                'url': url_for('get_buffered_frame', camera_id=camera_id, frame_id=frame_id)
+            })
+
+        return jsonify({"camera_id": camera_id, "frames": frames}), 200
+
+    except Exception as e:
+        app.logger.error(f"Error al obtener buffer de frames de {camera_id}: {e}")
+        return jsonify({"msg": f"Error interno del servidor: {str(e)}"}), 500
+
+@app.route('/api/frame_buffer/<string:camera_id>/<string:frame_id>', methods=['GET'])
+@jwt_required()
+def get_buffered_frame(camera_id, frame_id):
+    """Devuelve un frame concreto del buffer circular como imagen JPEG."""
+    try:
+        current_user_email = get_jwt_identity()
+
+        if not usuario_tiene_dispositivo(current_user_email, camera_id):
+            return jsonify({"msg": "Usuario no autorizado para esta cámara o cámara no encontrada."}), 403
+
+        entries = redis_client.xrange(f"frames:{camera_id}", min=frame_id, max=frame_id, count=1)
+        if not entries:
+            return jsonify({"msg": "El frame ya no está disponible en el buffer."}), 404
+
+        response = Response(entries[0][1][b'frame'], mimetype='image/jpeg')
+        # El contenido de un frame_id nunca cambia, así que el navegador puede cachearlo.
+        response.headers['Cache-Control'] = f'private, max-age={FRAME_BUFFER_SECONDS}'
+        return response
+
+    except Exception as e:
+        app.logger.error(f"Error al obtener frame {frame_id} de {camera_id}: {e}")
+        return jsonify({"msg": f"Error interno del servidor: {str(e)}"}), 500
+# ------------------------ FIN API PARA REBOBINAR EL BUFFER DE FRAMES --------------------
+
 # ------------------------ API PARA RE-TRANSMITIR STREAM A LA APP (via Polling) ------------------------
 # Este endpoint es el que la página web llamará para obtener la última imagen.
 # Ya no es /api/live_feed, es /api/latest_frame
@@ -724,9 +1457,7 @@ def camera_control():
 
         # TODO: Autenticación adicional - Verificar si current_user_email está autorizado para esta camera_id
         # Puedes consultar la colección 'usuarios' para ver si user_email.devices contiene camera_id
-        user_doc_ref = db.collection('usuarios').document(current_user_email)
-        user_doc = user_doc_ref.get()
-        if not user_doc.exists or camera_id not in user_doc.to_dict().get('devices', []):
+        if not usuario_tiene_dispositivo(current_user_email, camera_id):
             return jsonify({"msg": "Usuario no autorizado para esta cámara o cámara no encontrada."}), 403 # Forbidden
 
         # Publicar el comando MQTT
@@ -758,9 +1489,7 @@ def camera_power():
             return jsonify({"msg": "Faltan camera_id o estado de encendido/apagado válido ('ON'/'OFF')."}), 400
 
         # Autenticación adicional: Verificar si current_user_email está autorizado para esta camera_id
-        user_doc_ref = db.collection('usuarios').document(current_user_email)
-        user_doc = user_doc_ref.get()
-        if not user_doc.exists or camera_id not in user_doc.to_dict().get('devices', []):
+        if not usuario_tiene_dispositivo(current_user_email, camera_id):
             return jsonify({"msg": "Usuario no autorizado para esta cámara o cámara no encontrada."}), 403 # Forbidden
 
         # Publicar el comando MQTT
@@ -778,6 +1507,129 @@ def camera_power():
 
 # ------------------------ FIN API PARA CONTROLAR EL ENCENDIDO/APAGADO --------------------------
 
+# ------------------------ API PARA ENVIAR UN COMANDO A VARIAS CÁMARAS --------------------------
+# "Armar todas" o "apagar todas" en una sola petición: autoriza una vez contra la lista de
+# dispositivos del usuario, publica todos los comandos seguidos y espera la confirmación de
+# cada cámara. El comando se publica tal cual, así lo obedecen también las cámaras antiguas.
+# Justo antes se publica un nonce en camera/command_nonce/<id>; las cámaras actualizadas lo
+# devuelven en su estado ({"m", "p", "n"} o "...; Ack: <nonce>") y el proceso líder lo deja en
+# 'ack' de camera_status:<id>. Así la confirmación no depende de comparar relojes.
+# Las cámaras que nunca han devuelto un nonce (sin 'ack') se confirman cuando su estado
+# muestra el modo y encendido pedidos.
+BULK_COMMAND_DEFAULT_TIMEOUT_SECONDS = 5
+BULK_COMMAND_MAX_TIMEOUT_SECONDS = 15 # La petición ocupa un hilo de Flask mientras espera
+BULK_COMMAND_POLL_SECONDS = 0.1
+# Comandos de modo que entiende la cámara -> modo que reportará después
+CAMERA_MODE_COMMANDS = {
+    "STREAMING_MODE": "STREAMING_MODE", "STREAM": "STREAMING_MODE",
+    "CAPTURE_MODE": "CAPTURE_MODE", "CAPTURE": "CAPTURE_MODE"
+}
+
+def esperar_confirmaciones(camera_ids, nonce, expected_mode, expected_is_on, timeout_seconds):
+    """
+    Espera a que cada cámara devuelva 'nonce' en su estado con el modo y encendido esperados.
+    Si la cámara nunca ha devuelto un nonce (cliente antiguo), basta con el modo y encendido.
+    Devuelve { camera_id: {"status": "acknowledged"|"timeout", "confirmed_by": "nonce"|"state", ...} }.
+    """
+    results = {}
+    pending = list(camera_ids)
+    started = time.monotonic()
+    deadline = started + timeout_seconds
+    while pending:
+        pipe = redis_client.pipeline(transaction=False)
+        for camera_id in pending:
+            pipe.hmget(f"camera_status:{camera_id}", 'mode', 'is_on', 'ack')
+        still_pending = []
+        for camera_id, (mode, is_on, ack) in zip(pending, pipe.execute()):
+            mode = mode.decode('utf-8') if mode else None
+            state_matches = ((expected_mode is None or mode == expected_mode)
+                             and (expected_is_on is None or (is_on == b"1") == expected_is_on))
+            if state_matches and (ack is None or ack.decode('utf-8') == nonce):
+                # Latencia medida con el reloj de este proceso (incluye el intervalo de sondeo)
+                results[camera_id] = {"status": "acknowledged", "mode": mode, "is_on": is_on == b"1",
+                                      "confirmed_by": "state" if ack is None else "nonce",
+                                      "latency_ms": int((time.monotonic() - started) * 1000)}
+            else:
+                still_pending.append(camera_id)
+        pending = still_pending
+        if not pending or time.monotonic() >= deadline:
+            break
+        time.sleep(BULK_COMMAND_POLL_SECONDS)
+
+    for camera_id in pending:
+        results[camera_id] = {"status": "timeout"}
+    return results
+
+@app.route('/api/cameras/bulk_command', methods=['POST'])
+@jwt_required()
+def bulk_camera_command():
+    """
+    Envía un comando de modo y/o encendido a varias cámaras del usuario.
+    Cuerpo: {"camera_ids": [...] (opcional, por defecto todas), "mode": "CAPTURE_MODE", "power_state": "ON"|"OFF",
+             "timeout": segundos}
+    Devuelve el resultado por cámara: acknowledged, timeout o forbidden.
+    """
+    try:
+        current_user_email = get_jwt_identity()
+        data = request.json or {}
+        mode = data.get('mode')
+        power_state = data.get('power_state')
+
+        if not mode and not power_state:
+            return jsonify({"msg": "Falta 'mode' o 'power_state'."}), 400
+        if mode and (not isinstance(mode, str) or mode.upper() not in CAMERA_MODE_COMMANDS):
+            return jsonify({"msg": f"Modo no válido. Usa uno de {sorted(CAMERA_MODE_COMMANDS)}."}), 400
+        if power_state and power_state not in ['ON', 'OFF']:
+            return jsonify({"msg": "Estado de encendido no válido ('ON'/'OFF')."}), 400
+        timeout_seconds = data.get('timeout', BULK_COMMAND_DEFAULT_TIMEOUT_SECONDS)
+        if isinstance(timeout_seconds, bool) or not isinstance(timeout_seconds, (int, float)) or timeout_seconds != timeout_seconds:
+            return jsonify({"msg": "'timeout' debe ser un número de segundos."}), 400
+        timeout_seconds = max(0.0, min(float(timeout_seconds), BULK_COMMAND_MAX_TIMEOUT_SECONDS))
+
+        # 1. Autorizamos una sola vez contra la lista de dispositivos del usuario
+        user_data = obtener_usuario(current_user_email)
+        if user_data is None:
+            return jsonify({"msg": "Usuario no encontrado."}), 404
+        user_devices = set(user_data.get('devices', []))
+        requested_ids = data.get('camera_ids') or sorted(user_devices)
+        if not isinstance(requested_ids, list) or not all(isinstance(camera_id, str) for camera_id in requested_ids):
+            return jsonify({"msg": "'camera_ids' debe ser una lista de IDs (texto)."}), 400
+
+        results = {camera_id: {"status": "forbidden"} for camera_id in requested_ids if camera_id not in user_devices}
+        camera_ids = [camera_id for camera_id in dict.fromkeys(requested_ids) if camera_id in user_devices]
+        if not camera_ids:
+            return jsonify({"msg": "Ninguna de las cámaras pertenece al usuario.", "results": results}), 403
+
+        # 2. Publicamos todos los comandos seguidos, cada uno precedido por el nonce común;
+        # paho los envía en orden desde su hilo de red
+        nonce = uuid.uuid4().hex[:12].upper()
+        for camera_id in camera_ids:
+            flask_mqtt_client.publish(f"camera/command_nonce/{camera_id}", payload=nonce, qos=MQTT_QOS_INTERNAL, retain=False)
+            if mode:
+                flask_mqtt_client.publish(f"camera/commands/{camera_id}", payload=mode.upper(), qos=MQTT_QOS_INTERNAL, retain=False)
+            if power_state:
+                flask_mqtt_client.publish(f"camera/power/{camera_id}", payload=power_state, qos=MQTT_QOS_INTERNAL, retain=False)
+        app.logger.info(f"Comando masivo (modo={mode}, power={power_state}) publicado a {len(camera_ids)} cámara(s) por {current_user_email}.")
+
+        # 3. Esperamos la confirmación de cada cámara
+        expected_mode = CAMERA_MODE_COMMANDS[mode.upper()] if mode else None
+        expected_is_on = (power_state == 'ON') if power_state else None
+        results.update(esperar_confirmaciones(camera_ids, nonce, expected_mode, expected_is_on, timeout_seconds))
+
+        acknowledged = sum(1 for r in results.values() if r["status"] == "acknowledged")
+        return jsonify({
+            "results": results,
+            "acknowledged": acknowledged,
+            "timed_out": sum(1 for r in results.values() if r["status"] == "timeout"),
+            "forbidden": sum(1 for r in results.values() if r["status"] == "forbidden")
+        }), 200
+
+    except Exception as e:
+        app.logger.error(f"Error en bulk_camera_command: {e}")
+        return jsonify({"msg": f"Error interno del servidor: {str(e)}"}), 500
+
+# ------------------------ FIN API PARA ENVIAR UN COMANDO A VARIAS CÁMARAS --------------------------
+
 # ------------------------ API PARA OBTENER EL ESTADO DE LA CÁMARA --------------------------
 @app.route('/api/camera_status/<string:camera_id>', methods=['GET'])
 @jwt_required()
@@ -786,13 +1638,10 @@ def get_camera_status(camera_id):
         current_user_email = get_jwt_identity()
 
         # Autenticación: Verificar si el usuario está autorizado para esta camera_id
-        user_doc_ref = db.collection('usuarios').document(current_user_email)
-        user_doc = user_doc_ref.get()
-        if not user_doc.exists or camera_id not in user_doc.to_dict().get('devices', []):
+        if not usuario_tiene_dispositivo(current_user_email, camera_id):
             return jsonify({"msg": "Usuario no autorizado para esta cámara o cámara no encontrada."}), 403
 
-        with camera_status_lock:
-            status_info = camera_status.get(camera_id)
+        status_info = leer_estado_camaras([camera_id])[camera_id]
 
         if status_info:
             # Incluir un timestamp para que la app sepa cuán reciente es el estado
@@ -873,61 +1722,163 @@ def upload_registration_images():
 
     except Exception as e:
         app.logger.error(f"Error crítico al subir imágenes de registro para {current_user_email}: {e}")
-        import traceback
         traceback.print_exc() # Imprime el error completo en el log para debugging
         return jsonify({"msg": "Error interno en el servidor al guardar las imágenes."}), 500
 # --------------------------------------------------------------------------------------------
 
 # ======================== API PARA LIMPIAR HISTORIAL DE EVENTOS ========================
+# Borrar un historial grande puede tardar minutos, así que se hace en segundo plano:
+# el endpoint crea un trabajo, responde de inmediato con su ID y un pool acotado de hilos
+# borra los eventos con el BulkWriter de Firestore (envía las eliminaciones en paralelo).
+# El progreso vive en Redis para que cualquier proceso pueda consultarlo:
+#   clear_job:<job_id>      -> hash {"user", "status", "deleted", "started_at", "finished_at", "error"}
+#   clear_job_user:<email>  -> job_id del trabajo en curso (evita dos borrados simultáneos del mismo usuario)
+CLEAR_HISTORY_MAX_WORKERS = 2        # Trabajos de borrado simultáneos por proceso
+CLEAR_HISTORY_PAGE_SIZE = 500        # Eventos que se leen y borran por vuelta
+CLEAR_HISTORY_JOB_TTL_SECONDS = 86400 # El estado de un trabajo terminado se conserva un día
+CLEAR_HISTORY_LOCK_TTL_SECONDS = 3600 # Si un proceso muere a mitad del borrado, el usuario puede reintentar tras 1 hora
+CLEAR_HISTORY_MAX_ATTEMPTS = 5       # Intentos por eliminación antes de darla por fallida
+clear_history_executor = ThreadPoolExecutor(max_workers=CLEAR_HISTORY_MAX_WORKERS)
+
+def ejecutar_borrado_historial(job_id, user_email, user_devices):
+    """
+    Trabajo en segundo plano: borra todos los eventos del usuario y sus contadores diarios.
+    Solo se cuentan las eliminaciones que Firestore confirmó; si alguna falla tras
+    CLEAR_HISTORY_MAX_ATTEMPTS intentos, el trabajo termina como 'failed'.
+    """
+    job_key = f"clear_job:{job_id}"
+    redis_client.hset(job_key, "status", "running")
+    resultados = {"deleted": 0, "failed": 0, "error": None}
+    resultados_lock = threading.Lock() # Los callbacks del BulkWriter corren en sus propios hilos
+
+    def on_write_result(reference, result, writer):
+        if reference.parent.id != 'events':
+            return  # Los contadores diarios no cuentan como eventos borrados
+        with resultados_lock:
+            resultados["deleted"] += 1
+
+    def on_write_error(error, writer):
+        if error.attempts < CLEAR_HISTORY_MAX_ATTEMPTS:
+            return True  # El BulkWriter lo reintenta con espera exponencial
+        with resultados_lock:
+            resultados["failed"] += 1
+            resultados["error"] = f"{error.code}: {error.message}"
+        return False
+
+    try:
+        bulk_writer = db.bulk_writer(options=BulkWriterOptions(mode=SendMode.parallel))
+        bulk_writer.on_write_result(on_write_result)
+        bulk_writer.on_write_error(on_write_error)
+        # Se pagina con start_after: cada vuelta avanza aunque alguna eliminación haya fallado.
+        # select([]) trae solo las referencias, no el contenido de los eventos.
+        last_doc = None
+        while True:
+            query = consulta_eventos_usuario(user_email, user_devices).select([]).limit(CLEAR_HISTORY_PAGE_SIZE)
+            if last_doc is not None:
+                query = query.start_after(last_doc)
+            page = list(query.stream())
+            if not page:
+                break
+            for doc in page:
+                bulk_writer.delete(doc.reference)
+            bulk_writer.flush()
+            last_doc = page[-1]
+            redis_client.hset(job_key, "deleted", resultados["deleted"])
+
+        # Los contadores del dashboard también se reinician, como antes al borrar los eventos del día.
+        # Una consulta de igualdad por dispositivo (sin 'in', que admite como mucho 30 valores).
+        for device_id in user_devices:
+            for counter_doc in db.collection('daily_event_counts').where('device_id', '==', device_id).select([]).stream():
+                bulk_writer.delete(counter_doc.reference)
+        bulk_writer.close()
+        redis_client.delete(f"latest_alert:{user_email}", f"event_feed:{user_email}")
+
+        if resultados["failed"]:
+            raise RuntimeError(f"{resultados['failed']} eliminación(es) fallaron; la última: {resultados['error']}")
+        redis_client.hset(job_key, mapping={"status": "completed", "deleted": resultados["deleted"], "finished_at": datetime.now(timezone.utc).isoformat()})
+        app.logger.info(f"Se eliminaron {resultados['deleted']} eventos para el usuario {user_email} (trabajo {job_id}).")
+    except Exception as e:
+        redis_client.hset(job_key, mapping={"status": "failed", "deleted": resultados["deleted"], "error": str(e), "finished_at": datetime.now(timezone.utc).isoformat()})
+        app.logger.error(f"Error al limpiar historial para {user_email} (trabajo {job_id}): {e}")
+        traceback.print_exc()
+    finally:
+        redis_client.expire(job_key, CLEAR_HISTORY_JOB_TTL_SECONDS)
+        redis_client.delete(f"clear_job_user:{user_email}")
+
 @app.route('/api/events/clear_history', methods=['DELETE'])
 @jwt_required()
 def clear_event_history():
     """
-    Elimina TODOS los eventos asociados a los dispositivos de un usuario.
-    Usa un proceso por lotes para ser más eficiente con Firestore.
+    Inicia el borrado de TODOS los eventos asociados a los dispositivos de un usuario.
+    Responde 202 con el ID del trabajo; el progreso se consulta en /api/events/clear_history/<job_id>.
     """
     try:
         current_user_email = get_jwt_identity()
         app.logger.info(f"Solicitud para limpiar historial recibida de {current_user_email}")
 
         # 1. Obtenemos los dispositivos del usuario para saber qué eventos borrar
-        user_doc_ref = db.collection('usuarios').document(current_user_email)
-        user_doc = user_doc_ref.get()
-        if not user_doc.exists:
+        user_data = obtener_usuario(current_user_email)
+        if user_data is None:
             return jsonify({"msg": "Usuario no encontrado."}), 404
         
-        user_devices = user_doc.to_dict().get('devices', [])
+        user_devices = user_data.get('devices', [])
         
         # Si el usuario no tiene dispositivos, no hay nada que borrar
         if not user_devices:
             return jsonify({"msg": "El usuario no tiene dispositivos, no hay nada que borrar."}), 200
 
-        # 2. Preparamos la consulta para encontrar todos los eventos relevantes
-        events_query = db.collection('events').where('device_id', 'in', user_devices)
-        docs_to_delete = events_query.stream()
-        
-        # 3. Usamos un lote (batch) para eliminar eficientemente
-        batch = db.batch()
-        deleted_count = 0
-        for doc in docs_to_delete:
-            batch.delete(doc.reference)
-            deleted_count += 1
-            # Firestore recomienda lotes de máximo 500 operaciones. Hacemos commit y empezamos uno nuevo.
-            if deleted_count % 499 == 0:
-                batch.commit()
-                batch = db.batch()
-        
-        # Hacemos commit del último lote (que puede tener menos de 500 documentos)
-        batch.commit()
-        
-        app.logger.info(f"Se eliminaron {deleted_count} eventos para el usuario {current_user_email}.")
-        return jsonify({"msg": f"Historial eliminado correctamente. Se borraron {deleted_count} eventos."}), 200
+        # 2. Evitamos dos borrados simultáneos del mismo usuario
+        job_id = str(uuid.uuid4())
+        if not redis_client.set(f"clear_job_user:{current_user_email}", job_id, nx=True, ex=CLEAR_HISTORY_LOCK_TTL_SECONDS):
+            running_job_id = redis_client.get(f"clear_job_user:{current_user_email}")
+            running_job_id = running_job_id.decode('utf-8') if running_job_id else None
+            return jsonify({"msg": "Ya hay un borrado de historial en curso.", "job_id": running_job_id}), 409
+
+        # 3. Registramos el trabajo y lo lanzamos en segundo plano
+        redis_client.hset(f"clear_job:{job_id}", mapping={
+            "user": current_user_email,
+            "status": "queued",
+            "deleted": 0,
+            "started_at": datetime.now(timezone.utc).isoformat()
+        })
+        clear_history_executor.submit(ejecutar_borrado_historial, job_id, current_user_email, user_devices)
+
+        return jsonify({
+            "msg": "Borrado de historial iniciado.",
+            "job_id": job_id,
+            "status_url": url_for('get_clear_history_status', job_id=job_id)
+        }), 202
 
     except Exception as e:
         app.logger.error(f"Error al limpiar historial para {current_user_email}: {e}")
-        import traceback
         traceback.print_exc()
         return jsonify({"msg": "Error interno del servidor al limpiar el historial."}), 500
+
+@app.route('/api/events/clear_history/<string:job_id>', methods=['GET'])
+@jwt_required()
+def get_clear_history_status(job_id):
+    """Devuelve el estado de un borrado de historial: queued, running, completed o failed."""
+    try:
+        current_user_email = get_jwt_identity()
+        job = redis_client.hgetall(f"clear_job:{job_id}")
+        job = {k.decode('utf-8'): v.decode('utf-8') for k, v in job.items()}
+
+        # Un usuario solo puede ver sus propios trabajos
+        if not job or job.get("user") != current_user_email:
+            return jsonify({"msg": "Trabajo no encontrado."}), 404
+
+        return jsonify({
+            "job_id": job_id,
+            "status": job.get("status"),
+            "deleted": int(job.get("deleted", 0)),
+            "started_at": job.get("started_at"),
+            "finished_at": job.get("finished_at"),
+            "error": job.get("error")
+        }), 200
+
+    except Exception as e:
+        app.logger.error(f"Error al consultar el borrado {job_id}: {e}")
+        return jsonify({"msg": "Error interno del servidor."}), 500
 # =======================================================================================
 
 # ======================== API PARA OBTENER LA ÚLTIMA ALERTA CRÍTICA ========================
@@ -937,55 +1888,47 @@ def get_latest_alert():
     """
     Busca y devuelve el evento de alerta más reciente (persona desconocida, alarma, etc.)
     asociado a los dispositivos de un usuario.
+    Lee el puntero de Redis; solo consulta Firestore si todavía no existe.
     """
     try:
         current_user_email = get_jwt_identity()
 
+        found, cached_alert = leer_ultima_alerta(current_user_email)
+        if found:
+            return jsonify({"latest_alert": cached_alert}), 200
+
         # 1. Obtenemos los dispositivos del usuario
-        user_doc_ref = db.collection('usuarios').document(current_user_email)
-        user_doc = user_doc_ref.get()
-        if not user_doc.exists:
+        user_data = obtener_usuario(current_user_email)
+        if user_data is None:
             return jsonify({"msg": "Usuario no encontrado."}), 404
         
-        user_devices = user_doc.to_dict().get('devices', [])
+        user_devices = user_data.get('devices', [])
         if not user_devices:
             return jsonify({"latest_alert": None}), 200 # No hay dispositivos, por tanto no hay alertas
 
-        # 2. Definimos qué tipos de eventos consideramos una "alerta crítica"
-        critical_event_types = [
-            'unknown_person', 
-            'unknown_person_repeated_alarm', 
-            'unknown_group',
-            'person_no_face_alarm',
-            'alarm' # Un tipo de alarma genérico si lo tuvieras
-        ]
-
-        # 3. Hacemos la consulta a Firestore
-        alert_query = db.collection('events').where('device_id', 'in', user_devices) \
-                                              .where('event_type', 'in', critical_event_types) \
+        # 2. Hacemos la consulta a Firestore (arranque en frío del puntero)
+        alert_query = consulta_eventos_usuario(current_user_email, user_devices) \
+                                              .where('event_type', 'in', CRITICAL_ALERT_EVENT_TYPES) \
                                               .order_by('timestamp', direction=firestore.Query.DESCENDING) \
                                               .limit(1) # ¡Solo queremos la más reciente!
         
         results = alert_query.stream()
         
-        # 4. Procesamos el resultado
+        # 3. Procesamos el resultado y lo dejamos en Redis para las siguientes peticiones
         latest_alert_doc = next(results, None)
         
         if latest_alert_doc:
-            alert_data = latest_alert_doc.to_dict()
-            alert_data['id'] = latest_alert_doc.id
-            # Aseguramos que el timestamp sea un string en formato ISO para JSON
-            if 'timestamp' in alert_data and isinstance(alert_data['timestamp'], datetime):
-                alert_data['timestamp'] = alert_data['timestamp'].isoformat()
-            
+            raw_data = latest_alert_doc.to_dict()
+            alert_data = evento_a_json(latest_alert_doc.id, raw_data)
+            guardar_ultima_alerta(current_user_email, alert_data, raw_data.get('timestamp'))
             return jsonify({"latest_alert": alert_data}), 200
         else:
-            # Si no se encontraron alertas, devolvemos null
+            # Si no se encontraron alertas, lo recordamos también y devolvemos null
+            guardar_ultima_alerta(current_user_email, None, None)
             return jsonify({"latest_alert": None}), 200
 
     except Exception as e:
         app.logger.error(f"Error al obtener última alerta para {current_user_email}: {e}")
-        import traceback
         traceback.print_exc()
         return jsonify({"msg": "Error interno del servidor al obtener la última alerta."}), 500
 # =======================================================================================
@@ -998,13 +1941,11 @@ def get_user_settings():
     """Devuelve las configuraciones de un usuario, como sus preferencias de notificación."""
     try:
         current_user_email = get_jwt_identity()
-        user_doc_ref = db.collection('usuarios').document(current_user_email)
-        user_doc = user_doc_ref.get()
+        user_data = obtener_usuario(current_user_email)
 
-        if not user_doc.exists:
+        if user_data is None:
             return jsonify({"msg": "Usuario no encontrado."}), 404
         
-        user_data = user_doc.to_dict()
         
         # Devolvemos la preferencia, o 'all' si no existe en la base de datos
         settings = {
@@ -1034,6 +1975,7 @@ def update_user_settings():
         user_doc_ref.update({
             'notification_preference': new_preference
         })
+        invalidar_usuario_cache(current_user_email)
 
         return jsonify({"msg": "Ajustes guardados correctamente."}), 200
     except Exception as e:
@@ -1052,13 +1994,11 @@ def get_profile_summary():
     """Recoge y devuelve un resumen de la cuenta, incluyendo los nombres de los rostros registrados."""
     try:
         current_user_email = get_jwt_identity()
-        user_doc_ref = db.collection('usuarios').document(current_user_email)
-        user_doc = user_doc_ref.get()
+        user_data = obtener_usuario(current_user_email)
 
-        if not user_doc.exists:
+        if user_data is None:
             return jsonify({"msg": "Usuario no encontrado."}), 404
 
-        user_data = user_doc.to_dict()
 
         # --- LÓGICA MODIFICADA PARA LEER LOS NOMBRES DE LOS EMBEDDINGS ---
         user_email_safe = "".join([c for c in current_user_email if c.isalnum() or c in ('_', '-')])
@@ -0,0 +1,293 @@
+# ==============================================================================
+# AI SECURITY CAM - ALMACÉN LOCAL DE MODELOS PARA LOS WORKERS
+# ==============================================================================
+# Los workers (fi2.py, fi.py, fire7.py, registration.py) cargan YOLOv5, MTCNN y FaceNet
+# desde una carpeta local, sin red:
+#   <MODELS_DIR>/yolov5/               código de YOLOv5 en la versión fijada (hubconf.py)
+#   <MODELS_DIR>/yolov5x.pt            pesos de YOLOv5
+#   <MODELS_DIR>/keras-facenet/        pesos de FaceNet (caché de keras_facenet)
+#   <MODELS_DIR>/manifest.json         SHA-256 de cada archivo de pesos
+# MTCNN trae sus pesos dentro del paquete pip, así que no necesita descarga.
+#
+# La carpeta se prepara una sola vez, con red, al construir la imagen o la VM:
+#   python model_store.py --download
+# Eso también instala las dependencias de Python del código de YOLOv5 (su requirements.txt);
+# al cargar, la autoinstalación de YOLOv5 queda desactivada para que nunca haga pip install.
+# y se comprueba sin red con:
+#   python model_store.py --verify
+#
+# Al arrancar, cada worker borra los archivos de "listo" de procesos anteriores que ya no
+# existen y verifica los hashes contra el manifiesto. El resultado se guarda por (tamaño, mtime),
+# así que solo se vuelve a calcular si el archivo cambió. Luego carga los modelos una vez, hace
+# una inferencia de calentamiento y deja su archivo de "listo" (<READY_DIR>/<worker>.<pid>.ready).
+# Cada instancia tiene el suyo, así que varias en el mismo host no se pisan. El orquestador o un
+# health check lo comprueban con:
+#   python model_store.py --check-ready <worker> [--pid <pid>]
+# ------------------------------------------------------------------------------
+
+import os
+import sys
+import json
+import time
+import atexit
+import glob
+import signal
+import shutil
+import hashlib
+import zipfile
+import argparse
+import subprocess
+import urllib.request
+
+# ========== CONFIGURACIÓN ==========
+MODELS_DIR = os.environ.get('MODELS_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models'))
+READY_DIR = os.environ.get('READY_DIR', '/tmp')
+YOLOV5_VERSION = 'v7.0'                 # Versión fijada del código y de los pesos de YOLOv5
+YOLOV5_REPO_URL = f'https://github.com/ultralytics/yolov5/archive/refs/tags/{YOLOV5_VERSION}.zip'
+YOLOV5_WEIGHTS_URL = f'https://github.com/ultralytics/yolov5/releases/download/{YOLOV5_VERSION}/{{nombre}}.pt'
+YOLO_MODELS = ['yolov5x']               # Pesos que se descargan con --download
+FACENET_KEY = '20180402-114759'         # Igual que el valor por defecto de keras_facenet
+
+MANIFEST_FILE = os.path.join(MODELS_DIR, 'manifest.json')
+VERIFIED_FILE = os.path.join(MODELS_DIR, '.verificados.json')
+YOLO_REPO_DIR = os.path.join(MODELS_DIR, 'yolov5')
+FACENET_DIR = os.path.join(MODELS_DIR, 'keras-facenet')
+
+
+# ========== VERIFICACIÓN ==========
+def sha256_archivo(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for bloque in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(bloque)
+    return h.hexdigest()
+
+
+def archivos_de_pesos():
+    """Rutas relativas a MODELS_DIR de todos los archivos de pesos (los que van al manifiesto)."""
+    rutas = [f'{nombre}.pt' for nombre in YOLO_MODELS if os.path.exists(os.path.join(MODELS_DIR, f'{nombre}.pt'))]
+    for raiz, _, archivos in os.walk(FACENET_DIR):
+        rutas += [os.path.relpath(os.path.join(raiz, a), MODELS_DIR) for a in archivos]
+    return sorted(rutas)
+
+
+def verificar_modelos(prefijo=''):
+    """
+    Comprueba que los archivos del manifiesto cuya ruta empieza por 'prefijo' existan y
+    coincidan con su hash. Devuelve cuántos se verificaron.
+    Lanza RuntimeError si falta el manifiesto, no hay entradas, falta un archivo o un hash no coincide.
+    """
+    if not os.path.exists(MANIFEST_FILE):
+        raise RuntimeError(f"No existe {MANIFEST_FILE}. Prepara los modelos con: python model_store.py --download")
+    with open(MANIFEST_FILE) as f:
+        manifiesto = json.load(f)['files']
+    rutas = [ruta for ruta in manifiesto if ruta.startswith(prefijo)]
+    if not rutas:
+        raise RuntimeError(f"El manifiesto no tiene archivos '{prefijo}*'. Prepara los modelos con: python model_store.py --download")
+    try:
+        with open(VERIFIED_FILE) as f:
+            verificados = json.load(f)
+    except (OSError, ValueError):
+        verificados = {}
+
+    cambios = False
+    for ruta in rutas:
+        esperado = manifiesto[ruta]
+        path = os.path.join(MODELS_DIR, ruta)
+        if not os.path.exists(path):
+            raise RuntimeError(f"Falta el archivo de modelo {path}.")
+        st = os.stat(path)
+        firma = [st.st_size, st.st_mtime_ns, esperado]
+        if verificados.get(ruta) == firma:
+            continue
+        if sha256_archivo(path) != esperado:
+            raise RuntimeError(f"El hash de {path} no coincide con el manifiesto.")
+        verificados[ruta] = firma
+        cambios = True
+
+    if cambios:
+        try:
+            with open(VERIFIED_FILE, 'w') as f:
+                json.dump(verificados, f)
+        except OSError:
+            pass  # Carpeta de solo lectura: se volverá a calcular el hash en el próximo arranque
+    return len(rutas)
+
+
+# ========== CARGA DE MODELOS ==========
+# Los imports pesados (torch, TensorFlow) se hacen aquí dentro, no al importar el módulo.
+def cargar_yolo(nombre='yolov5x'):
+    """YOLOv5 desde el código y los pesos locales (torch.hub con source='local', sin GitHub)."""
+    import torch
+    # hubconf de YOLOv5 llama a check_requirements() en cada carga y, si falta algo, hace pip
+    # install. Las dependencias ya se instalaron con --download; aquí solo se avisaría.
+    os.environ['YOLOv5_AUTOINSTALL'] = 'False'
+    pesos = f'{nombre}.pt'
+    verificar_modelos(pesos)
+    modelo = torch.hub.load(YOLO_REPO_DIR, 'custom', path=os.path.join(MODELS_DIR, pesos), source='local', verbose=False)
+    modelo.eval()
+    return modelo
+
+
+def cargar_facenet():
+    """FaceNet con los pesos de FACENET_DIR; keras_facenet no descarga nada si ya están ahí."""
+    from keras_facenet import FaceNet
+    verificar_modelos('keras-facenet' + os.sep)
+    return FaceNet(key=FACENET_KEY, cache_folder=FACENET_DIR)
+
+
+def cargar_mtcnn():
+    from mtcnn import MTCNN
+    return MTCNN()
+
+
+def calentar(yolo=None, detector=None, embedder=None):
+    """
+    Una inferencia con imágenes en negro para que la primera imagen real no pague la
+    inicialización perezosa de torch/TensorFlow (grafos, kernels, memoria).
+    """
+    import numpy as np
+    imagen = np.zeros((480, 640, 3), dtype=np.uint8)
+    if yolo is not None:
+        yolo(imagen)
+    if detector is not None:
+        detector.detect_faces(imagen)
+    if embedder is not None:
+        embedder.embeddings(np.zeros((1, 160, 160, 3), dtype=np.uint8))
+
+
+# ========== SEÑAL DE LISTO ==========
+def ruta_listo(worker, pid=None):
+    return os.path.join(READY_DIR, f'{worker}.{pid or os.getpid()}.ready')
+
+
+def proceso_vivo(pid):
+    try:
+        os.kill(pid, 0)  # Señal 0: solo comprueba que el proceso existe
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # Existe, pero es de otro usuario
+    return True
+
+
+def archivos_listo(worker):
+    """{pid: ruta} de los archivos <worker>.<pid>.ready que hay en READY_DIR."""
+    archivos = {}
+    for path in glob.glob(os.path.join(READY_DIR, f'{glob.escape(worker)}.*.ready')):
+        pid = os.path.basename(path)[len(worker) + 1:-len('.ready')]
+        if pid.isdigit():
+            archivos[int(pid)] = path
+    return archivos
+
+
+def borrar_archivo(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def limpiar_listo(worker):
+    """
+    Borra los archivos de "listo" de procesos que ya no existen (p. ej. terminados con SIGKILL,
+    que no ejecuta atexit) y el de este mismo pid. Los de otras instancias vivas no se tocan.
+    Se llama al arrancar, antes de cargar los modelos.
+    """
+    for pid, path in archivos_listo(worker).items():
+        if pid == os.getpid() or not proceso_vivo(pid):
+            borrar_archivo(path)
+
+
+def marcar_listo(worker):
+    """
+    Crea <READY_DIR>/<worker>.<pid>.ready (pid y hora) y lo borra al terminar el proceso.
+    También hace que SIGTERM termine con sys.exit: por defecto Python muere sin ejecutar
+    los atexit (este borrado y los vaciados de colas de fi.py y fi2.py).
+    """
+    path = ruta_listo(worker)
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'pid': os.getpid(), 'ready_at': time.time()}, f)
+    os.replace(path + '.tmp', path)  # Quien lo lea nunca ve un archivo a medio escribir
+    atexit.register(borrar_archivo, path)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print(f"[OK] Worker listo ({path})")
+
+
+def esta_listo(worker, pid=None):
+    """
+    True si la instancia 'pid' del worker está lista y su proceso sigue vivo. Sin 'pid',
+    True si hay al menos una instancia lista y viva.
+    """
+    archivos = archivos_listo(worker)
+    pids = [pid] if pid else list(archivos)
+    return any(p in archivos and proceso_vivo(p) for p in pids)
+
+
+# ========== PREPARACIÓN DE LA CARPETA (CON RED) ==========
+def descargar(url, destino):
+    print(f"[INFO] Descargando {url}...")
+    with urllib.request.urlopen(url) as resp, open(destino + '.tmp', 'wb') as f:
+        shutil.copyfileobj(resp, f)
+    os.replace(destino + '.tmp', destino)
+
+
+def preparar_modelos():
+    """Descarga el código y los pesos fijados y escribe el manifiesto con sus hashes."""
+    os.makedirs(MODELS_DIR, exist_ok=True)
+    if not os.path.exists(os.path.join(YOLO_REPO_DIR, 'hubconf.py')):
+        zip_path = os.path.join(MODELS_DIR, 'yolov5.zip')
+        descargar(YOLOV5_REPO_URL, zip_path)
+        with zipfile.ZipFile(zip_path) as z:
+            raiz = z.namelist()[0].split('/')[0]
+            z.extractall(MODELS_DIR)
+        shutil.rmtree(YOLO_REPO_DIR, ignore_errors=True)
+        os.rename(os.path.join(MODELS_DIR, raiz), YOLO_REPO_DIR)
+        os.remove(zip_path)
+    for nombre in YOLO_MODELS:
+        pesos = os.path.join(MODELS_DIR, f'{nombre}.pt')
+        if not os.path.exists(pesos):
+            descargar(YOLOV5_WEIGHTS_URL.format(nombre=nombre), pesos)
+    # Dependencias del código de YOLOv5: instaladas aquí para que la carga no las instale
+    print("[INFO] Instalando las dependencias de YOLOv5...")
+    subprocess.run([sys.executable, '-m', 'pip', 'install', '-r', os.path.join(YOLO_REPO_DIR, 'requirements.txt')], check=True)
+
+    from keras_facenet import FaceNet
+    FaceNet(key=FACENET_KEY, cache_folder=FACENET_DIR)  # Descarga los pesos a FACENET_DIR
+
+    manifiesto = {'yolov5_version': YOLOV5_VERSION, 'facenet_key': FACENET_KEY,
+                  'files': {ruta: sha256_archivo(os.path.join(MODELS_DIR, ruta)) for ruta in archivos_de_pesos()}}
+    with open(MANIFEST_FILE, 'w') as f:
+        json.dump(manifiesto, f, indent=2)
+    if os.path.exists(VERIFIED_FILE):
+        os.remove(VERIFIED_FILE)
+    print(f"[OK] {len(manifiesto['files'])} archivo(s) de pesos registrados en {MANIFEST_FILE}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Almacén local de modelos de los workers.")
+    accion = parser.add_mutually_exclusive_group(required=True)
+    accion.add_argument('--download', action='store_true', help="Descargar los modelos fijados y escribir el manifiesto.")
+    accion.add_argument('--verify', action='store_true', help="Comprobar los hashes de los modelos locales.")
+    accion.add_argument('--check-ready', metavar='WORKER', help="Salir con 0 si el worker está listo y su proceso vivo, 1 si no.")
+    parser.add_argument('--pid', type=int, help="Con --check-ready: comprobar solo esa instancia del worker.")
+    args = parser.parse_args()
+
+    if args.download:
+        preparar_modelos()
+    elif args.check_ready:
+        if not esta_listo(args.check_ready, args.pid):
+            print(f"[ERROR] El worker '{args.check_ready}' no está listo.")
+            sys.exit(1)
+        print(f"[OK] El worker '{args.check_ready}' está listo.")
+    else:
+        try:
+            total = verificar_modelos()
+        except RuntimeError as e:
+            print(f"[ERROR] {e}")
+            sys.exit(1)
+        print(f"[OK] {total} archivo(s) de pesos verificados en {MODELS_DIR}")
+
+
+if __name__ == '__main__':
+    main()
@@ -8,9 +8,10 @@ import cv2
 import numpy as np
 import firebase_admin
 from firebase_admin import credentials, storage
-from mtcnn import MTCNN
-from keras_facenet import FaceNet
 from PIL import Image, ExifTags
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+import model_store
 
 # ======== CONFIGURACIÓN (ajusta si es necesario) ========
 # Asegúrate de que este archivo de credenciales esté en la misma carpeta o proporciona la ruta completa
@@ -21,6 +22,17 @@ BUCKET_ID = 'security-cam-f322b.firebasestorage.app'
 PENDING_JOBS_PREFIX = 'face_registration_pending/'
 COMPLETED_JOBS_PREFIX = 'embeddings_clientes/'
 
+# Métricas en formato Prometheus en http://localhost:METRICS_PORT/metrics
+METRICS_PORT = 9102
+
+# ======== MÉTRICAS ========
+# Solo se actualizan contadores en memoria; el texto se genera cuando alguien consulta /metrics.
+STAGE_SECONDS = Histogram('registration_stage_seconds', 'Duración de cada etapa del worker de registro', ['stage'],
+                          buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+BATCHES_TOTAL = Counter('registration_batches_total', 'Lotes de registro procesados', ['result'])
+IMAGES_TOTAL = Counter('registration_images_total', 'Imágenes de registro procesadas', ['result'])
+PENDING_BATCHES = Gauge('registration_pending_batches', 'Lotes pendientes en la última revisión de Storage')
+
 # ======== INICIALIZACIÓN DE FIREBASE Y MODELOS DE IA ========
 try:
     cred = credentials.Certificate(SERVICE_ACCOUNT_FILE)
@@ -31,10 +43,12 @@ except Exception as e:
     print(f"[ERROR] No se pudo inicializar Firebase: {e}")
     exit()
 
+model_store.limpiar_listo('registration')
 try:
     print('[INFO] Cargando modelos de IA (MTCNN y FaceNet)...')
-    detector = MTCNN()
-    embedder = FaceNet()
+    detector = model_store.cargar_mtcnn()
+    embedder = model_store.cargar_facenet()  # Pesos locales verificados, sin descarga
+    model_store.calentar(detector=detector, embedder=embedder)
     print('[INFO] Modelos de IA cargados.')
 except Exception as e:
     print(f"[ERROR] No se pudieron cargar los modelos de IA: {e}")
@@ -43,7 +57,8 @@ except Exception as e:
 
 def find_pending_batches():
     """Encuentra lotes de trabajo pendientes agrupando los archivos por su carpeta única (batch_id)."""
-    all_blobs = bucket.list_blobs(prefix=PENDING_JOBS_PREFIX)
+    with STAGE_SECONDS.labels('storage_list').time():
+        all_blobs = list(bucket.list_blobs(prefix=PENDING_JOBS_PREFIX))
     batches = {}
     for blob in all_blobs:
         if blob.name.endswith('/'): # Ignorar las 'carpetas' vacías
@@ -54,6 +69,7 @@ def find_pending_batches():
         if batch_path not in batches:
             batches[batch_path] = []
         batches[batch_path].append(blob)
+    PENDING_BATCHES.set(len(batches))
     return batches
 
 # Reemplaza tu función process_batch completa por esta
@@ -65,6 +81,7 @@ def process_batch(batch_path, blob_list):
     metadata_blob = next((b for b in blob_list if b.name.endswith('metadata.json')), None)
     if not metadata_blob:
         print(f"[ERROR] No se encontró metadata.json. Saltando lote.")
+        BATCHES_TOTAL.labels('failed').inc()
         return
 
     try:
@@ -74,6 +91,7 @@ def process_batch(batch_path, blob_list):
         print(f"[INFO] Procesando registro para '{person_name}'.")
     except Exception as e:
         print(f"[ERROR] No se pudo leer metadata.json: {e}")
+        BATCHES_TOTAL.labels('failed').inc()
         return
 
     embeddings = []
@@ -82,7 +100,8 @@ def process_batch(batch_path, blob_list):
     for image_blob in image_blobs:
         try:
             print(f"  -> Procesando imagen: {os.path.basename(image_blob.name)}...")
-            img_bytes = image_blob.download_as_bytes()
+            with STAGE_SECONDS.labels('download').time():
+                img_bytes = image_blob.download_as_bytes()
 
             # --- INICIO DE LA CORRECCIÓN CON PILLOW ---
             # 1. Abrimos la imagen con Pillow y la rotamos si es necesario
@@ -102,22 +121,28 @@ def process_batch(batch_path, blob_list):
             img_bgr = cv2.cvtColor(img_rgb, cv2.COLOR_RGB2BGR) # OpenCV usa BGR
             # --- FIN DE LA CORRECCIÓN CON PILLOW ---
 
-            faces = detector.detect_faces(img_rgb) # La detección se hace sobre RGB
+            with STAGE_SECONDS.labels('mtcnn').time():
+                faces = detector.detect_faces(img_rgb) # La detección se hace sobre RGB
             if not faces:
                 print(f"  [WARN] No se detectó rostro en {image_blob.name}.")
+                IMAGES_TOTAL.labels('no_face').inc()
                 continue
 
             x, y, w, h = faces[0]['box']
             face = img_rgb[y:y+h, x:x+w]
             face_resized = cv2.resize(face, (160, 160))
-            embedding_vector = embedder.embeddings([face_resized])[0]
+            with STAGE_SECONDS.labels('facenet').time():
+                embedding_vector = embedder.embeddings([face_resized])[0]
             embeddings.append(embedding_vector)
+            IMAGES_TOTAL.labels('ok').inc()
         except Exception as e:
             print(f"  [ERROR] Falló el procesamiento de la imagen {image_blob.name}: {e}")
+            IMAGES_TOTAL.labels('failed').inc()
 
     # 3. Guardar el archivo .npy si se generaron embeddings
     if not embeddings:
         print(f"[ERROR] No se pudo generar ningún embedding para el lote {batch_path}. No se creará archivo .npy.")
+        BATCHES_TOTAL.labels('empty').inc()
     else:
         user_email_safe = os.path.basename(os.path.dirname(os.path.dirname(batch_path)))
         safe_person_name = person_name.replace(" ", "_").lower()
@@ -132,20 +157,26 @@ def process_batch(batch_path, blob_list):
         with io.BytesIO() as npy_buffer:
             np.save(npy_buffer, npy_data, allow_pickle=True)
             npy_buffer.seek(0)
-            bucket.blob(npy_path).upload_from_file(npy_buffer, content_type='application/octet-stream')
+            with STAGE_SECONDS.labels('upload').time():
+                bucket.blob(npy_path).upload_from_file(npy_buffer, content_type='application/octet-stream')
         
         print(f"[SUCCESS] Archivo .npy para '{person_name}' subido correctamente.")
+        BATCHES_TOTAL.labels('ok').inc()
 
     # 4. Limpiar el lote procesado de la carpeta "pending"
     print(f"[INFO] Limpiando lote de trabajo: {batch_path}")
-    for blob in blob_list:
-        blob.delete()
+    with STAGE_SECONDS.labels('cleanup').time():
+        for blob in blob_list:
+            blob.delete()
     print("[INFO] Lote limpiado.")
 
 
 def main():
     """Bucle principal del worker."""
     print("--- Worker de Registro Facial Iniciado ---")
+    start_http_server(METRICS_PORT)
+    print(f"[INFO] Métricas disponibles en http://localhost:{METRICS_PORT}/metrics")
+    model_store.marcar_listo('registration')
     while True:
         try:
             pending_batches = find_pending_batches()
@@ -0,0 +1,430 @@
+# ==============================================================================
+# AI SECURITY CAM - SIMULADOR DE FLOTA DE CÁMARAS VIRTUALES
+# ==============================================================================
+# Lanza N cámaras virtuales que se comportan como camera_stream2.py, pero leen los
+# frames de un video o de una carpeta de imágenes en lugar de una webcam:
+#   - Cada cámara tiene su CAMERA_ID, su cliente MQTT (estado, LWT, comandos de modo,
+#     encendido y conteo de espectadores) y su bucle de envío al FPS y modo configurados.
+#   - Los frames se decodifican y codifican a JPEG una sola vez y se comparten entre cámaras;
+#     cada cámara arranca en un punto distinto del video.
+#   - Un cliente observador publica comandos de modo a cámaras al azar y mide cuánto tarda
+#     su nuevo estado en aparecer en 'camera/status/<id>'. Es solo broker + cámara: no pasa
+#     por main3.py.
+#   - Con --api-email/--api-password se mide además el camino completo que ve la app: el
+#     comando se envía con POST /api/camera_control y se cronometra hasta que
+#     GET /api/camera_status/<id> devuelve el modo nuevo (broker, cola de estados de main3 y
+#     Redis incluidos). El usuario debe tener las cámaras simuladas en su lista 'devices'.
+#
+# Informa latencia de envío de frames (p50/p95/p99, frames/s, errores) y los tiempos de
+# reacción comando -> estado. Con --json se guarda el resultado.
+#
+# Uso:  python simulate_camera_fleet.py --video muestra.mp4 --cameras 50 --fps 5 --duration 120
+#       python simulate_camera_fleet.py --images ./frames --cameras 200 --mode CAPTURE_MODE
+#       python simulate_camera_fleet.py --images ./frames --cameras 20 --api-email sim@example.com --api-password ...
+# ------------------------------------------------------------------------------
+
+import os
+import sys
+import glob
+import json
+import time
+import random
+import argparse
+import threading
+
+import cv2
+import requests
+import paho.mqtt.client as mqtt
+
+from bench_utils import percentil
+
+# ========== CONFIGURACIÓN ==========
+MQTT_BROKER_IP = "localhost"
+MQTT_BROKER_PORT = 1883
+MQTT_QOS = 1                             # Igual que camera_stream2.py
+SERVER_BASE_URL = "http://localhost:5000"
+CAMERA_PREFIX = "simcam"                 # Las cámaras simuladas no chocan con las reales
+CAPTURE_INTERVAL_SECONDS = 5             # Igual que camera_stream2.py
+STATUS_PUBLISH_INTERVAL_SECONDS = 20
+STREAM_IDLE_INTERVAL_SECONDS = 5
+MAX_SOURCE_FRAMES = 300                  # Frames del video que se guardan en memoria
+FRAME_WIDTH = 640
+COMMAND_TIMEOUT_SECONDS = 10             # Sin estado en este tiempo, el comando cuenta como perdido
+API_POLL_SECONDS = 0.05                  # Intervalo de sondeo de /api/camera_status tras un comando por la API
+
+camaras = {}                             # {camera_id: estado de la cámara virtual}
+latencias_envio = []                     # ms por frame enviado con éxito
+errores_envio = 0
+comandos_pendientes = {}                 # {camera_id: (modo esperado, instante del comando)}
+reacciones = []                          # ms de comando a estado (MQTT directo)
+comandos_perdidos = 0
+camaras_en_api = set()                   # Cámaras con un comando por la API en curso
+reacciones_api = []                      # ms de POST /api/camera_control a /api/camera_status con el modo nuevo
+comandos_perdidos_api = 0
+metricas_lock = threading.Lock()
+detener = threading.Event()
+
+
+# ========== FUENTE DE FRAMES ==========
+def cargar_frames(video_path=None, images_dir=None):
+    """Devuelve una lista de JPEG (bytes) leídos del video o de la carpeta, redimensionados a FRAME_WIDTH."""
+    imagenes = []
+    if video_path:
+        captura = cv2.VideoCapture(video_path)
+        while len(imagenes) < MAX_SOURCE_FRAMES:
+            ok, frame = captura.read()
+            if not ok:
+                break
+            imagenes.append(frame)
+        captura.release()
+    else:
+        for path in sorted(glob.glob(os.path.join(images_dir, '*.jpg')))[:MAX_SOURCE_FRAMES]:
+            frame = cv2.imread(path)
+            if frame is not None:
+                imagenes.append(frame)
+
+    frames = []
+    for frame in imagenes:
+        alto, ancho = frame.shape[:2]
+        if ancho > FRAME_WIDTH:
+            frame = cv2.resize(frame, (FRAME_WIDTH, int(alto * FRAME_WIDTH / ancho)))
+        ok, buffer = cv2.imencode('.jpg', frame)
+        if ok:
+            frames.append(buffer.tobytes())
+    return frames
+
+
+# ========== MQTT DE CADA CÁMARA ==========
+def construir_payload_estado(camara):
+    status = {"m": camara["mode"], "p": 1 if camara["is_on"] else 0}
+    if camara["last_command_nonce"]:
+        status["n"] = camara["last_command_nonce"]
+    return json.dumps(status, separators=(",", ":"))
+
+
+def publicar_estado(client, camara):
+    client.publish(f"camera/status/{camara['camera_id']}", payload=construir_payload_estado(camara), qos=MQTT_QOS, retain=True)
+    camara["last_status_publish_time"] = time.time()
+
+
+def on_connect_camara(client, camara, flags, rc):
+    if rc != 0:
+        print(f"[MQTT] {camara['camera_id']}: falló la conexión, código {rc}")
+        return
+    camera_id = camara["camera_id"]
+    client.subscribe([(f"camera/commands/{camera_id}", MQTT_QOS), (f"camera/power/{camera_id}", MQTT_QOS),
+                      (f"camera/viewers/{camera_id}", MQTT_QOS), (f"camera/command_nonce/{camera_id}", MQTT_QOS)])
+    publicar_estado(client, camara)
+
+
+def on_message_camara(client, camara, msg):
+    """Mismo comportamiento que on_message de camera_stream2.py, sin imprimir cada comando."""
+    camera_id = camara["camera_id"]
+    if msg.topic == f"camera/viewers/{camera_id}":
+        try:
+            camara["viewer_count"] = int(msg.payload.decode("utf-8").strip())
+        except ValueError:
+            pass
+        return
+
+    if msg.topic == f"camera/command_nonce/{camera_id}":
+        camara["last_command_nonce"] = msg.payload.decode("utf-8").strip()
+        return
+
+    command = msg.payload.decode("utf-8").strip().upper()
+    if msg.topic == f"camera/commands/{camera_id}":
+        if command in ["STREAMING_MODE", "STREAM"]:
+            camara["mode"] = "STREAMING_MODE"
+        elif command in ["CAPTURE_MODE", "CAPTURE"]:
+            camara["mode"] = "CAPTURE_MODE"
+    elif msg.topic == f"camera/power/{camera_id}":
+        if command in ["ON", "OFF"]:
+            camara["is_on"] = command == "ON"
+    publicar_estado(client, camara)
+
+
+def crear_camara(camera_id, mode, indice_inicial):
+    camara = {
+        "camera_id": camera_id,
+        "mode": mode,
+        "is_on": True,
+        "viewer_count": None,
+        "last_command_nonce": None,
+        "frame_index": indice_inicial,
+        "last_status_publish_time": 0,
+        "last_capture_time": 0,
+        "last_stream_send_time": 0,
+    }
+    client = mqtt.Client(client_id=camera_id, clean_session=True, userdata=camara)
+    client.on_connect = on_connect_camara
+    client.on_message = on_message_camara
+    client.will_set(f"camera/status/{camera_id}", payload="LWT_OFFLINE", qos=MQTT_QOS, retain=True)
+    client.connect(MQTT_BROKER_IP, MQTT_BROKER_PORT, keepalive=10)
+    client.loop_start()
+    camara["mqtt"] = client
+    return camara
+
+
+# ========== BUCLE DE ENVÍO DE CADA CÁMARA ==========
+def enviar_frame(session, camara, jpeg_bytes, raw_upload):
+    global errores_envio
+    camera_id = camara["camera_id"]
+    inicio = time.perf_counter()
+    try:
+        if raw_upload:
+            headers = {'Content-Type': 'application/octet-stream', 'X-Camera-Mode': camara["mode"]}
+            response = session.post(f"{SERVER_BASE_URL}/api/stream_upload_raw/{camera_id}", data=jpeg_bytes,
+                                    headers=headers, timeout=5)
+        else:
+            files = {'frame': ('frame.jpg', jpeg_bytes, 'image/jpeg')}
+            response = session.post(f"{SERVER_BASE_URL}/api/stream_upload", files=files,
+                                    data={'camera_id': camera_id, 'mode': camara["mode"]}, timeout=5)
+        response.raise_for_status()
+        with metricas_lock:
+            latencias_envio.append((time.perf_counter() - inicio) * 1000)
+    except requests.exceptions.RequestException:
+        with metricas_lock:
+            errores_envio += 1
+
+
+def bucle_camara(camara, frames, fps, raw_upload):
+    """Réplica de camera_operation_loop de camera_stream2.py con frames en memoria."""
+    session = requests.Session()
+    client = camara["mqtt"]
+    while not detener.is_set():
+        current_time = time.time()
+        if current_time - camara["last_status_publish_time"] >= STATUS_PUBLISH_INTERVAL_SECONDS:
+            publicar_estado(client, camara)
+
+        if not camara["is_on"]:
+            time.sleep(2)
+            continue
+
+        jpeg_bytes = frames[camara["frame_index"] % len(frames)]
+        camara["frame_index"] += 1
+
+        should_send = False
+        if camara["mode"] == "STREAMING_MODE":
+            viewer_count = camara["viewer_count"]
+            if viewer_count is None or viewer_count > 0:
+                should_send = True
+            elif STREAM_IDLE_INTERVAL_SECONDS > 0 and \
+                    current_time - camara["last_stream_send_time"] >= STREAM_IDLE_INTERVAL_SECONDS:
+                should_send = True
+            if should_send:
+                camara["last_stream_send_time"] = current_time
+        elif current_time - camara["last_capture_time"] >= CAPTURE_INTERVAL_SECONDS:
+            should_send = True
+            camara["last_capture_time"] = current_time
+
+        if should_send:
+            enviar_frame(session, camara, jpeg_bytes, raw_upload)
+
+        if camara["mode"] == "STREAMING_MODE":
+            time.sleep(max(0, 1.0 / fps - (time.time() - current_time)))
+        else:
+            time.sleep(1)
+
+
+# ========== MEDICIÓN COMANDO -> ESTADO ==========
+def on_message_observador(client, userdata, msg):
+    camera_id = msg.topic.rsplit('/', 1)[-1]
+    with metricas_lock:
+        pendiente = comandos_pendientes.get(camera_id)
+        if pendiente is None:
+            return
+        try:
+            modo = json.loads(msg.payload).get("m")
+        except (ValueError, AttributeError):
+            return
+        if modo == pendiente[0]:
+            reacciones.append((time.perf_counter() - pendiente[1]) * 1000)
+            del comandos_pendientes[camera_id]
+
+
+def bucle_comandos(observador, camera_ids, intervalo):
+    """Cada 'intervalo' segundos cambia el modo de una cámara al azar y caduca los comandos sin respuesta."""
+    global comandos_perdidos
+    while not detener.wait(intervalo):
+        ahora = time.perf_counter()
+        with metricas_lock:
+            for camera_id, (_, enviado) in list(comandos_pendientes.items()):
+                if ahora - enviado > COMMAND_TIMEOUT_SECONDS:
+                    del comandos_pendientes[camera_id]
+                    comandos_perdidos += 1
+            libres = [c for c in camera_ids if c not in comandos_pendientes and c not in camaras_en_api]
+            if not libres:
+                continue
+            camera_id = random.choice(libres)
+            nuevo_modo = "CAPTURE_MODE" if camaras[camera_id]["mode"] == "STREAMING_MODE" else "STREAMING_MODE"
+            comandos_pendientes[camera_id] = (nuevo_modo, time.perf_counter())
+        observador.publish(f"camera/commands/{camera_id}", payload=nuevo_modo, qos=MQTT_QOS)
+
+
+def bucle_comandos_api(email, password, camera_ids, intervalo):
+    """
+    Cada 'intervalo' segundos cambia el modo de una cámara al azar a través de main3 y espera
+    a que /api/camera_status/<id> lo refleje. Un comando cada vez: la espera es la medición.
+    """
+    global comandos_perdidos_api
+    session = requests.Session()
+    respuesta = session.post(f"{SERVER_BASE_URL}/api/login", json={"email": email, "password": password}, timeout=10)
+    if respuesta.status_code != 200:
+        print(f"[ERROR] Login en la API fallido ({respuesta.status_code}); no se miden comandos por la API.")
+        return
+    session.headers["Authorization"] = f"Bearer {respuesta.json()['access_token']}"
+
+    while not detener.wait(intervalo):
+        with metricas_lock:
+            libres = [c for c in camera_ids if c not in comandos_pendientes]
+            if not libres:
+                continue
+            camera_id = random.choice(libres)
+            camaras_en_api.add(camera_id)
+        nuevo_modo = "CAPTURE_MODE" if camaras[camera_id]["mode"] == "STREAMING_MODE" else "STREAMING_MODE"
+        try:
+            inicio = time.perf_counter()
+            respuesta = session.post(f"{SERVER_BASE_URL}/api/camera_control",
+                                     json={"camera_id": camera_id, "mode": nuevo_modo}, timeout=10)
+            if respuesta.status_code != 200:
+                print(f"[WARN] /api/camera_control respondió {respuesta.status_code} para {camera_id}: {respuesta.text[:100]}")
+            confirmado = False
+            while respuesta.status_code == 200 and time.perf_counter() - inicio < COMMAND_TIMEOUT_SECONDS:
+                estado = session.get(f"{SERVER_BASE_URL}/api/camera_status/{camera_id}", timeout=10)
+                if estado.status_code == 200 and estado.json().get("mode") == nuevo_modo:
+                    confirmado = True
+                    break
+                time.sleep(API_POLL_SECONDS)
+            with metricas_lock:
+                if confirmado:
+                    reacciones_api.append((time.perf_counter() - inicio) * 1000)
+                else:
+                    comandos_perdidos_api += 1
+        except requests.RequestException as e:
+            print(f"[WARN] Comando por la API a {camera_id} fallido: {e}")
+            with metricas_lock:
+                comandos_perdidos_api += 1
+        finally:
+            with metricas_lock:
+                camaras_en_api.discard(camera_id)
+
+
+# ========== INFORME ==========
+def resumen_latencias(valores):
+    if not valores:
+        return None
+    return {'p50': round(percentil(valores, 50), 1), 'p95': round(percentil(valores, 95), 1),
+            'p99': round(percentil(valores, 99), 1)}
+
+
+def main():
+    global MQTT_BROKER_IP, MQTT_BROKER_PORT, SERVER_BASE_URL, comandos_perdidos
+    parser = argparse.ArgumentParser(description="Simulador de flota de cámaras virtuales.")
+    fuente = parser.add_mutually_exclusive_group(required=True)
+    fuente.add_argument('--video', help="Video del que se toman los frames.")
+    fuente.add_argument('--images', help="Carpeta con los JPEG que se envían.")
+    parser.add_argument('--cameras', type=int, default=10)
+    parser.add_argument('--fps', type=float, default=10, help="Fotogramas por segundo en modo streaming.")
+    parser.add_argument('--mode', default="STREAMING_MODE", choices=["STREAMING_MODE", "CAPTURE_MODE"])
+    parser.add_argument('--duration', type=int, default=60, help="Segundos de simulación.")
+    parser.add_argument('--command-interval', type=float, default=1.0,
+                        help="Segundos entre comandos de modo del observador (0 = no enviar comandos).")
+    parser.add_argument('--multipart', action='store_true', help="Usar /api/stream_upload en lugar del endpoint crudo.")
+    parser.add_argument('--server', default=SERVER_BASE_URL, help="URL base del backend (main3.py).")
+    parser.add_argument('--broker', default=f"{MQTT_BROKER_IP}:{MQTT_BROKER_PORT}", help="Broker MQTT host:puerto.")
+    parser.add_argument('--prefix', default=CAMERA_PREFIX, help="Prefijo de los CAMERA_ID simulados.")
+    parser.add_argument('--api-email', help="Usuario de main3 dueño de las cámaras simuladas: mide también los comandos por la API.")
+    parser.add_argument('--api-password', help="Contraseña de --api-email.")
+    parser.add_argument('--json', help="Archivo donde guardar el resultado.")
+    args = parser.parse_args()
+
+    SERVER_BASE_URL = args.server.rstrip('/')
+    MQTT_BROKER_IP, _, puerto = args.broker.partition(':')
+    MQTT_BROKER_PORT = int(puerto or MQTT_BROKER_PORT)
+
+    frames = cargar_frames(args.video, args.images)
+    if not frames:
+        print(f"[ERROR] No se pudo leer ningún frame de {args.video or args.images}")
+        sys.exit(1)
+    print(f"[INFO] {len(frames)} frame(s) en memoria ({sum(len(f) for f in frames) / len(frames) / 1024:.0f} KB de media).")
+
+    camera_ids = [f"{args.prefix}{i:04d}" for i in range(args.cameras)]
+    for i, camera_id in enumerate(camera_ids):
+        camaras[camera_id] = crear_camara(camera_id, args.mode, i * len(frames) // args.cameras)
+
+    observador = mqtt.Client(client_id=f"{args.prefix}_observer", clean_session=True)
+    observador.on_message = on_message_observador
+    observador.connect(MQTT_BROKER_IP, MQTT_BROKER_PORT, keepalive=10)
+    observador.subscribe("camera/status/+", qos=MQTT_QOS)
+    observador.loop_start()
+
+    hilos = [threading.Thread(target=bucle_camara, args=(camaras[c], frames, args.fps, not args.multipart), daemon=True)
+             for c in camera_ids]
+    if args.command_interval > 0:
+        hilos.append(threading.Thread(target=bucle_comandos, args=(observador, camera_ids, args.command_interval), daemon=True))
+        if args.api_email:
+            hilos.append(threading.Thread(target=bucle_comandos_api, daemon=True,
+                                          args=(args.api_email, args.api_password, camera_ids, args.command_interval)))
+    print(f"[INFO] {args.cameras} cámara(s) en {args.mode} a {args.fps} FPS contra {SERVER_BASE_URL} "
+          f"durante {args.duration} s...")
+    inicio = time.perf_counter()
+    for hilo in hilos:
+        hilo.start()
+
+    try:
+        time.sleep(args.duration)
+    except KeyboardInterrupt:
+        print("\n[INFO] Simulación detenida por el usuario (Ctrl+C).")
+    detener.set()
+    for hilo in hilos:
+        hilo.join(timeout=10)
+    segundos = time.perf_counter() - inicio
+
+    # Las cámaras se despiden publicando LWT_OFFLINE, igual que si se cortaran
+    for camara in camaras.values():
+        camara["mqtt"].publish(f"camera/status/{camara['camera_id']}", payload="LWT_OFFLINE", qos=MQTT_QOS, retain=True)
+        camara["mqtt"].loop_stop()
+        camara["mqtt"].disconnect()
+    observador.loop_stop()
+    observador.disconnect()
+
+    comandos_perdidos += len(comandos_pendientes)
+    resultado = {
+        'cameras': args.cameras,
+        'seconds': round(segundos, 1),
+        'frames_sent': len(latencias_envio),
+        'frames_per_second': round(len(latencias_envio) / segundos, 1),
+        'upload_errors': errores_envio,
+        'upload_ms': resumen_latencias(latencias_envio),
+        'commands_acknowledged': len(reacciones),
+        'commands_lost': comandos_perdidos,
+        'command_to_status_ms': resumen_latencias(reacciones),
+        'api_commands_acknowledged': len(reacciones_api),
+        'api_commands_lost': comandos_perdidos_api,
+        'api_command_to_status_ms': resumen_latencias(reacciones_api),
+    }
+
+    print(f"\n[OK] {resultado['frames_sent']} frames en {resultado['seconds']}s "
+          f"({resultado['frames_per_second']} frames/s), {errores_envio} error(es) de envío.")
+    if resultado['upload_ms']:
+        s = resultado['upload_ms']
+        print(f"     Envío de frame:   p50 {s['p50']}ms | p95 {s['p95']}ms | p99 {s['p99']}ms")
+    if resultado['command_to_status_ms']:
+        s = resultado['command_to_status_ms']
+        print(f"     Comando -> estado (MQTT directo): p50 {s['p50']}ms | p95 {s['p95']}ms | p99 {s['p99']}ms "
+              f"({len(reacciones)} confirmados, {comandos_perdidos} perdidos)")
+    if resultado['api_command_to_status_ms']:
+        s = resultado['api_command_to_status_ms']
+        print(f"     Comando -> estado (API de main3): p50 {s['p50']}ms | p95 {s['p95']}ms | p99 {s['p99']}ms "
+              f"({len(reacciones_api)} confirmados, {comandos_perdidos_api} perdidos)")
+    elif args.api_email:
+        print(f"     Comando -> estado (API de main3): ningún comando confirmado ({comandos_perdidos_api} perdidos)")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(resultado, f, indent=2)
+        print(f"[OK] Resultado guardado en {args.json}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,23 @@
+# ==============================================================================
+# AI SECURITY CAM - URL DE LAS IMÁGENES PROCESADAS
+# ==============================================================================
+# Los workers (fi2.py, fi.py, fire7.py) suben una sola vez cada imagen procesada y construyen
+# su URL en local, sin make_public() ni otra llamada de red. La misma URL va en el evento, en
+# la notificación FCM y en los webhooks. La política se cambia aquí, para todos los workers:
+#   'firebase_public' -> URL de descarga de Firebase; storage.rules permite leer
+#                        alarmas_procesadas/ y alertas_grupales/
+#   'signed'          -> URL firmada V4, generada localmente con la cuenta de servicio (caduca)
+# ------------------------------------------------------------------------------
+
+from datetime import timedelta
+from urllib.parse import quote
+
+IMAGE_URL_STRATEGY    = 'firebase_public'
+SIGNED_URL_EXPIRATION = timedelta(days=7)
+
+
+def url_imagen_procesada(blob):
+    """URL de una imagen procesada ya subida, según IMAGE_URL_STRATEGY."""
+    if IMAGE_URL_STRATEGY == 'signed':
+        return blob.generate_signed_url(version='v4', expiration=SIGNED_URL_EXPIRATION, method='GET')
+    return f"https://firebasestorage.googleapis.com/v0/b/{blob.bucket.name}/o/{quote(blob.name, safe='')}?alt=media"
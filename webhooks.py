@@ -0,0 +1,117 @@
+# ==============================================================================
+# AI SECURITY CAM - WEBHOOKS SALIENTES (IFTTT Y OTROS)
+# ==============================================================================
+# Los webhooks no se envían dentro del bucle de frames de fire7.py: encolar_webhook() deja el
+# aviso en la cola de cada endpoint y sus propios hilos lo envían. Cada endpoint tiene tantos
+# hilos como envíos simultáneos admite ('max_concurrentes'), así uno lento no frena a los demás
+# ni al bucle. Todos comparten una sesión HTTP con pool de conexiones, timeouts y reintentos con
+# espera exponencial. Los hilos se arrancan con iniciar_webhooks().
+#
+# Para probar contra un servidor local, define WEBHOOK_IFTTT_BASE_URL (ej. http://localhost:8000)
+# antes de importar el módulo, o ejecuta:  python check_webhooks.py
+# ------------------------------------------------------------------------------
+
+import os
+import time
+import queue
+import threading
+from collections import Counter
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# ========== CONFIGURACIÓN ==========
+WEBHOOK_IFTTT_BASE_URL = os.environ.get('WEBHOOK_IFTTT_BASE_URL', 'https://maker.ifttt.com')
+IFTTT_KEY = 'lxBuXKITSTN5Gu-bhN_m28waEiJoprM-ClSGvq69n7k'
+
+# Endpoints: 'formato' es 'ifttt' (value1..3 en formulario) o 'json' (el aviso completo en JSON)
+WEBHOOK_ENDPOINTS = {
+    'ifttt_send_alarm': {
+        'url': f'{WEBHOOK_IFTTT_BASE_URL}/trigger/send_alarm/with/key/{IFTTT_KEY}',
+        'formato': 'ifttt',
+        'max_concurrentes': 2,
+    },
+    'ifttt_persona_sin_rostro': {
+        'url': f'{WEBHOOK_IFTTT_BASE_URL}/trigger/persona_sin_rostro/with/key/{IFTTT_KEY}',
+        'formato': 'ifttt',
+        'max_concurrentes': 2,
+    },
+}
+# Rutas: tipo de evento -> endpoints que lo reciben
+WEBHOOK_ROUTES = {
+    'unknown_person': ['ifttt_send_alarm'],
+    'unknown_person_repeated_alarm': ['ifttt_send_alarm'],
+    'person_no_face_alarm': ['ifttt_persona_sin_rostro'],
+}
+WEBHOOK_QUEUE_MAX = 200              # Avisos en espera por endpoint; si se llena, se descartan los nuevos
+WEBHOOK_TIMEOUT = (3, 10)            # (conexión, lectura) en segundos
+WEBHOOK_MAX_RETRIES = 4
+WEBHOOK_BACKOFF_SECONDS = 1          # Espera antes del 1er reintento; se duplica en cada uno
+
+# urllib3 guarda un pool por host. Los endpoints del mismo host (todos los de IFTTT) comparten
+# ese pool, así que su tamaño es la suma de sus 'max_concurrentes': si fuera menor, los hilos
+# que no caben abren conexiones nuevas y urllib3 las descarta al terminar ("pool is full").
+hilos_por_host = Counter()
+for _cfg in WEBHOOK_ENDPOINTS.values():
+    hilos_por_host[urlsplit(_cfg['url']).netloc] += _cfg['max_concurrentes']
+
+webhook_session = requests.Session()
+webhook_adapter = HTTPAdapter(pool_connections=len(hilos_por_host), pool_maxsize=max(hilos_por_host.values()))
+webhook_session.mount('https://', webhook_adapter)
+webhook_session.mount('http://', webhook_adapter)
+webhook_colas = {endpoint: queue.Queue(maxsize=WEBHOOK_QUEUE_MAX) for endpoint in WEBHOOK_ENDPOINTS}
+
+
+# ========== ENVÍO ==========
+def encolar_webhook(event_type, titulo, image_url, detalles):
+    """Encola el aviso para cada endpoint configurado para 'event_type'. No bloquea."""
+    aviso = {'event_type': event_type, 'title': titulo, 'image_url': image_url, 'details': detalles}
+    for endpoint in WEBHOOK_ROUTES.get(event_type, []):
+        try:
+            webhook_colas[endpoint].put_nowait(aviso)
+        except queue.Full:
+            print(f"❌ Cola del webhook '{endpoint}' llena, se descarta el aviso '{event_type}'.")
+
+def enviar_webhook(endpoint, aviso):
+    """Envía un aviso con reintentos. Devuelve True si el endpoint lo aceptó."""
+    cfg = WEBHOOK_ENDPOINTS[endpoint]
+    if cfg['formato'] == 'ifttt':
+        cuerpo = {'data': {'value1': aviso['title'], 'value2': aviso['image_url'], 'value3': aviso['details']}}
+    else:
+        cuerpo = {'json': aviso}
+
+    for intento in range(WEBHOOK_MAX_RETRIES):
+        try:
+            response = webhook_session.post(cfg['url'], timeout=WEBHOOK_TIMEOUT, **cuerpo)
+            if response.status_code < 300:
+                print(f"✅ Aviso '{aviso['event_type']}' enviado correctamente a '{endpoint}'.")
+                return True
+            if 400 <= response.status_code < 500 and response.status_code != 429:
+                # Error del cliente: reintentar no va a ayudar
+                print(f"❌ Webhook '{endpoint}' rechazó el aviso: {response.status_code}, {response.text}")
+                return False
+            print(f"⚠️ Webhook '{endpoint}' respondió {response.status_code} (intento {intento + 1}).")
+        except requests.RequestException as e:
+            print(f"⚠️ Error al enviar a '{endpoint}': {e} (intento {intento + 1}).")
+        time.sleep(WEBHOOK_BACKOFF_SECONDS * 2 ** intento)
+    print(f"❌ Se agotaron los reintentos del webhook '{endpoint}' para '{aviso['event_type']}'.")
+    return False
+
+def webhook_worker(endpoint):
+    """Hilo que vacía la cola de un endpoint."""
+    cola = webhook_colas[endpoint]
+    while True:
+        aviso = cola.get()
+        try:
+            enviar_webhook(endpoint, aviso)
+        except Exception as e:
+            print(f"❌ Error inesperado en el webhook '{endpoint}': {e}")
+        finally:
+            cola.task_done()  # Permite esperar con cola.join() a que se envíe todo lo encolado
+
+def iniciar_webhooks():
+    """Arranca 'max_concurrentes' hilos por endpoint."""
+    for endpoint, cfg in WEBHOOK_ENDPOINTS.items():
+        for _ in range(cfg['max_concurrentes']):
+            threading.Thread(target=webhook_worker, args=(endpoint,), daemon=True).start()